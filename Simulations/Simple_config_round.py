@@ -5,9 +5,12 @@ Created on Mon Apr  8 16:54:31 2024
 @author: Mark
 """
 
+import os
 import time
 import logging
 import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
 from typing import Tuple
 
@@ -21,40 +24,15 @@ from scipy.interpolate import interp1d
 
 from src.particleSystem.ParticleSystem import ParticleSystem
 from src.Sim.simulations import Simulate_Lightsail
+from src.Sim.basin_mapping import polar_ksection
 import src.Mesh.mesh_functions as MF
 import src.ExternalForces.optical_interpolators.interpolators as interp
 from src.ExternalForces.LaserBeam import LaserBeam
-from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator
 from src.ExternalForces.OpticalForceCalculator import ParticleOpticalPropertyType
+from src.ExternalForces.MultiBeamForceCalculator import MultiBeamForceCalculator
 
 
 
-class OpticalForceCalculatorCross():
-    def __init__(self, PS, LB1, LB2):
-        self.ParticleSystem = ParticleSystem
-        self.PS = self.ParticleSystem #alias for convenience
-        self.LaserBeam1 = LB1
-        self.LaserBeam2 = LB2
-        self.OFC1 = OpticalForceCalculator(PS, LB1)
-        self.OFC2 = OpticalForceCalculator(PS, LB2)
-
-    def force_value(self):
-        return self.OFC1.force_value()+self.OFC2.force_value()
-
-    def calculate_restoring_forces(self, **kwargs):
-        f1, m1 = self.OFC1.calculate_restoring_forces(**kwargs)
-        f2, m2 = self.OFC2.calculate_restoring_forces(**kwargs)
-        return f1+f2, m1+m2
-
-    def calculate_stability_coefficients(self, **kwargs):
-        return self.OFC1.calculate_stability_coefficients(**kwargs) + self.OFC2.calculate_stability_coefficients(**kwargs)
-
-    def plot(self,ax, **kwargs):
-        LB1.plot(ax, **kwargs)
-        LB2.plot(ax, **kwargs)
-
-        return ax
-
 def override_constraints(PS: ParticleSystem):
     for p in PS.particles:
         if p.fixed:
@@ -224,24 +202,22 @@ for reg in regions:
     if type(reg[5])==str:
         reg[5] = interp.create_interpolator(reg[5], reg[4]+reg[6])
 
-templog = []
-for p in PS.particles:
-    x,y,z = p.x
-    phi = np.arctan2(y,x)
-    r = np.linalg.norm(p.x)
-    templog.append([phi])
-    for reg in regions:
-        if r >= reg[2] and r <= reg[3] and phi <= reg[1] and phi >= reg[0]:
-            if reg[5] == ParticleOpticalPropertyType.SPECULAR:
-                p.optical_type = ParticleOpticalPropertyType.SPECULAR
-            else:
-                p.optical_type = ParticleOpticalPropertyType.ARBITRARY_PHC
-                p.optical_interpolator = reg[5]
+table = PS.optical_properties
+x, _ = PS.x_v_current_3D
+phi = np.arctan2(x[:,1], x[:,0])
+r = np.linalg.norm(x, axis=1)
+templog = phi[:,np.newaxis]
+for reg in regions:
+    selection = (r >= reg[2]) & (r <= reg[3]) & (phi <= reg[1]) & (phi >= reg[0])
+    if reg[5] == ParticleOpticalPropertyType.SPECULAR:
+        table.set_optical_type(ParticleOpticalPropertyType.SPECULAR, selection)
+    else:
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC, selection)
+        table.set_crystal(reg[5], selection)
 
 specular_override = False
 if specular_override:
-    for p in PS.particles:
-        p.optical_type = ParticleOpticalPropertyType.SPECULAR
+    table.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
 
 # now let's fix the rims
 # Nvm this breaks everything.
@@ -250,7 +226,6 @@ if specular_override:
 #     if p.constraint_type == 'point':
 #         p.optical_interpolator = dummy
 
-templog= np.array(templog)
 # init optical system
 P = 400/2# [W] 400 divided by two because superposition of two orthogonally polarised beams
 
@@ -270,7 +245,7 @@ LB2 = LaserBeam(lambda x, y: I_0 * np.exp(-1/2 *((x-mu_x)/sigma)**2 # gaussian l
                                           -1/2 *((y-mu_y)/sigma)**2),
                 lambda x,y: np.outer(np.ones(x.shape),[1,0]))
 
-OFC = OpticalForceCalculatorCross(PS, LB1, LB2)
+OFC = MultiBeamForceCalculator(PS, [LB1, LB2])
 
 # pick the desired simulation
 SIM = Simulate_Lightsail(PS,OFC,params)
@@ -463,23 +438,23 @@ if trajectory_sweep:
     x0 = np.linspace(0, 1, 31)**3 /8 * radius
     y0 = np.linspace(0, 1, 31)**3 /8 * radius
     x0,y0 = np.meshgrid(x0,y0)
-    results = []
 
-    space = 62
-    for i, initials in enumerate(zip(x0.ravel(), y0.ravel())):
-        progress = round(i/len(x0.ravel()),3)
-        equals = round(progress*space)
-        if progress<0.1:
-            offset = 1
-        else:
-            offset = 0
-        print(f"Progress: {progress*100:.1f}% "+" "*offset+"["+"="*equals+" "*(space-equals)+"]")
-        print(f"Initial conditions: {initials=}")
-        stable, pos = trajectory_from_initial_conditions(*initials)
-        r = np.sqrt(pos[0]**2 + pos[1]**2)
-        converged = r<1
-        results.append((stable, pos))#, PS.history))
-        print(80*"-")
+    # All initial offsets are advanced together as one rigid-body ensemble
+    override_constraints(PS)
+    PS.update_pos_unsafe(PS.initial_positions)
+    PS.update_vel_unsafe(np.zeros(PS.n*3))
+    PS.params['convergence_threshold'] = radius*2e-2
+    initial_conditions = np.zeros((x0.size, 2, 6))
+    initial_conditions[:,0,0] = x0.ravel()
+    initial_conditions[:,0,1] = y0.ravel()
+    stable, ensemble = SIM.simulate_rigid_ensemble(initial_conditions,
+                                                   printframes=100,
+                                                   spin = False,
+                                                   gravity = True,
+                                                   damping = damping,
+                                                   batch_size = 64)
+    positions = (ensemble.initial_states[:,:3] + ensemble.displacement)/length
+    results = list(zip(stable, positions))
 
     current = time.time()
     elapsed = current-start
@@ -540,36 +515,55 @@ if trajectory_sweep:
     ax_x.set_xlabel("$x_0$ [D]")
     ax_x.set_ylabel("$y_0$ [D]")
 
+#%%% Stability basin with an adaptive quadtree
+basin_mapping = False
+if basin_mapping:
+    PS.initial_positions, _ = PS.x_v_current
+    override_constraints(PS)
+    PS.update_pos_unsafe(PS.initial_positions)
+    PS.update_vel_unsafe(np.zeros(PS.n*3))
+    PS.params['convergence_threshold'] = radius*2e-2
+
+    # Only cells on the basin boundary are refined, and the square sail in
+    # the round beam is symmetric under quarter turns
+    extent = radius/8
+    basin = SIM.map_stability_basin([[-extent, extent], [-extent, extent]],
+                                    symmetry = ['C4'],
+                                    max_depth = 6,
+                                    initial_depth = 3,
+                                    path = 'temp/initial_pos_sweep/basin_map.npz',
+                                    printframes = 100,
+                                    spin = False,
+                                    gravity = True,
+                                    damping = damping,
+                                    batch_size = 64)
+
+    fig3 = plt.figure()
+    ax_b = fig3.add_subplot()
+    im = ax_b.imshow(basin.grid(), cmap = 'binary', origin = 'lower',
+                     extent = [-extent/length, extent/length, -extent/length, extent/length])
+    cbar3 = fig3.colorbar(im)
+    cbar3.set_label('Stability (1 = stable)')
+    ax_b.set_xlabel("$x_0$ [D]")
+    ax_b.set_ylabel("$y_0$ [D]")
+
 #%%% Displacement Reaction plots
 def collect_reaction_data(PS, OFC, disp_range, disp_type):
-    reactions = []
     base_range = np.linspace(-1, 1, 101)
     modified_range = abs(base_range)**(1/2)*np.sign(base_range) # concentrates values around 0
     displacements = modified_range * disp_range
-    rotational = True if 'rot' in disp_type else False
-
-    for disp in displacements:
-        if disp_type in ['trans_x', 'trans_y', 'trans_z']:
-            displacement = [disp if disp_type == f'trans_{axis}' else 0 for axis in ['x', 'y', 'z']]
-            displacement += [0, 0, 0]
-        elif disp_type in ['rot_x', 'rot_y', 'rot_z']:
-            displacement = [0, 0, 0]
-            if rotational:
-                displacement += [disp if disp_type == f'rot_{axis}' else 0 for axis in ['x', 'y', 'z']]
-            else:
-                displacement += [0, 0, 0]
-        else:
-            raise ValueError("Invalid displacement type")
 
-        PS.displace(displacement, suppress_warnings=True)
-        f = OFC.force_value()
-        f_res, m_res = OFC.calculate_restoring_forces(forces=f)
-        reaction = np.concatenate((f_res, m_res))
-        reactions.append(reaction)
-        #PS.plot_forces(f, length = 1e6)
-        PS.un_displace()
+    axes = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+    if disp_type not in axes:
+        raise ValueError("Invalid displacement type")
+    displacement_vectors = np.zeros((len(displacements), 6))
+    displacement_vectors[:, axes.index(disp_type)] = displacements
+
+    # All poses in one evaluation, the PS itself is not displaced
+    f_res, m_res = OFC.calculate_restoring_forces_batch(displacement_vectors)
+    reactions = np.hstack((f_res, m_res))
 
-    return displacements, np.array(reactions)
+    return displacements, reactions
 
 def plot_displacement_vs_reaction(PS, OFC, disp_range_trans, disp_range_rot):
     fig, axs = plt.subplots(2, 3, figsize=(18, 10))
@@ -681,41 +675,50 @@ def binary_search_stability(theta: float, r_inner: float, r_outer: float, tolera
     logger.info(f"Solution found after {count+2} iterations. Stable: {stable/length:.4f} [D], Unstable: {unstable/length:.4f} [D]")
     return stable, unstable
 
-def sweep_polar_coordinates(radius: float, d_theta: float, tolerance: float, logger, theta_max= 90) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+def stable_from_initial_offset(point) -> bool:
+    """Stability of one trajectory, used by the worker processes of the sweep"""
+    stable, _ = trajectory_from_initial_conditions(x0=point[0], y0=point[1])
+    return stable
+
+def sweep_polar_coordinates(radius: float, d_theta: float, tolerance: float, logger, theta_max= 90,
+                            k: int = 4, workers: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds the stable radius per angle with a parallel k-section, see polar_ksection
+
+    Every round evaluates k radii of all unresolved angles at once, spread
+    over worker processes. The first batch checks that the sail is stable at
+    the centre and unstable at half the radius; rays still stable there are
+    searched out to the full radius. The worker processes are forked so they
+    share the set-up of this script; where fork is unavailable the
+    trajectories run in this process.
+    """
     start = time.time()
     angles = np.arange(0, theta_max + d_theta, d_theta)
-    stable_radii = []
-    unstable_radii = []
-    positions = []
-
-
-    for theta in angles:
-        logger.info(f"\n\nStarting binary search for theta: {theta:.2f} degrees")
-
-        if len(stable_radii) == 0:
-            r_inner, r_outer = 0, radius*0.5
-        else:
-            r_inner, r_outer = stable_radii[-1] / 1.2, unstable_radii[-1] * 1.2
-
-        # Check if both inner and outer are stable or unstable
-        inner_stable, _ = trajectory_from_initial_conditions(x0=r_inner * np.cos(np.radians(theta)),
-                                                             y0=r_inner * np.sin(np.radians(theta)))
-        outer_stable, _ = trajectory_from_initial_conditions(x0=r_outer * np.cos(np.radians(theta)),
-                                                             y0=r_outer * np.sin(np.radians(theta)))
-
-        if inner_stable == outer_stable:
-            logger.info(f"Theta: {theta:.2f} degrees, pre-check caught: {r_inner/length=:.2f} [D],  {r_outer/length=:.2f} [D]")
-            r_inner, r_outer = 0.00, radius
 
-        stable, unstable = binary_search_stability(theta, r_inner, r_outer, tolerance, logger)
+    pool = None
+    if workers != 1 and 'fork' in multiprocessing.get_all_start_methods():
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    elif workers != 1:
+        logger.warning("Start method fork unavailable, running the sweep in a single process")
+
+    def classify(points):
+        logger.info(f"Running {len(points)} trajectories")
+        if pool is None:
+            return np.array([stable_from_initial_offset(point) for point in points])
+        return np.array(list(pool.map(stable_from_initial_offset, points)))
+
+    try:
+        stable_radii, unstable_radii, rounds = polar_ksection(classify, angles, radius*0.5, tolerance, k = k,
+                                                              verify_ends = True, r_limit = radius)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    positions = np.column_stack((angles, stable_radii, unstable_radii))
 
-        stable_radii.append(stable)
-        unstable_radii.append(unstable)
-        positions.append((theta, stable, unstable))
     end = time.time()
     dt = end-start
-    logger.info(f"All in all that took {dt/60:.0f}m and {dt%60}s")
-    return np.array(stable_radii), np.array(unstable_radii), np.array(positions)
+    logger.info(f"All in all that took {dt/60:.0f}m and {dt%60}s, {rounds} rounds")
+    return stable_radii, unstable_radii, positions
 
 
 def store_results(stable: np.ndarray, positions: np.ndarray, theta: np.ndarray, marking: int) -> None:
@@ -823,7 +826,8 @@ if recursive_trajectory_sweep:
 
     # Running the sweep
     marking = int(time.time())
-    stable_radii, unstable_radii, positions = sweep_polar_coordinates(radius, d_theta, tolerance, logger, theta_max)
+    stable_radii, unstable_radii, positions = sweep_polar_coordinates(radius, d_theta, tolerance, logger, theta_max,
+                                                                      k = 4, workers = os.cpu_count())
 
     # Storing the results
     store_results(stable_radii, positions, np.arange(0, theta_max + d_theta, d_theta), marking)
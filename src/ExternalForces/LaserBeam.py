@@ -19,11 +19,14 @@ class LaserBeam(SystemObject):
         Maps (x, y) to the scalar intensity profile of the beam.
     polarization_map : Callable[[float, float], np.ndarray]
         Maps (x, y) to the polarization profile of the beam represented as a Jones vector.
+    direction : np.ndarray
+        Unit vector of the propagation direction of the beam.
 
     """
     def __init__(self,
                  intensity_profile: Callable[[float, float], float],
-                 polarization_map: Callable[[float, float], list[np.complex_, np.complex_]]
+                 polarization_map: Callable[[float, float], list[np.complex_, np.complex_]],
+                 direction: list[float, float, float] = (0, 0, 1)
                  ):
         """
         Initializes a laserbeam based on input parameters
@@ -41,6 +44,11 @@ class LaserBeam(SystemObject):
         polarization_map : Callable[[float, float], np.ndarray]
             A numpy compatible function that maps x, y to the polarization profile of the beam. [-]
             The polarisation vector should be a unit vector!
+        direction : list[float, float, float], optional
+            Propagation direction of the beam, normalised on input. The
+            intensity and polarization profiles are defined in the plane
+            perpendicular to it, see OpticalForceCalculator.beam_rotation.
+            The default is (0, 0, 1).
         Returns
         -------
         None.
@@ -49,10 +57,16 @@ class LaserBeam(SystemObject):
         self.intensity_profile = intensity_profile
         self.polarization_map = polarization_map
 
+        direction = np.asarray(direction, dtype=np.float64)
+        if direction.shape != (3,) or not np.linalg.norm(direction) > 0:
+            raise AttributeError(f"Expected a nonzero direction vector of length 3, got {direction}")
+        self.direction = direction/np.linalg.norm(direction)
+
     def __str__(self):
         print("LaserBeam instantiated with attributes:")
         print(f"polarisation_map: {self.polarization_map}")
         print(f"intensity_profile: {self.intensity_profile}")
+        print(f"direction: {self.direction}")
         return ""
 
     def plot(self, ax = None,
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Optical force calculation for several beams illuminating the same ParticleSystem
+"""
+import numpy as np
+import numpy.typing as npt
+
+from src.ExternalForces.OpticalForceCalculator import (OpticalForceCalculator,
+                                                       beam_rotation,
+                                                       to_beam_frame,
+                                                       from_beam_frame)
+
+
+class MultiBeamForceCalculator(OpticalForceCalculator):
+    """
+    Handles the calculation of forces arising from optical pressure of several beams
+
+    The surface geometry is computed once per call and shared by all beams.
+    Beams with the same direction also share the rotated geometry. Within
+    such a group, beams with identical polarisation vectors at all nodes are
+    merged into a single evaluation of the force kernels, as the forces are
+    linear in intensity. This is the common case for phased arrays.
+    """
+    def __init__(self, ParticleSystem, LaserBeams, **kwargs):
+        """
+        Parameters
+        ----------
+        ParticleSystem : ParticleSystem
+            system to calculate the optical forces on
+        LaserBeams : list[LaserBeam]
+            beams illuminating the system, each with its own intensity,
+            polarisation and direction
+        **kwargs
+            passed on to OpticalForceCalculator. The intensity_threshold is
+            applied to the intensity of every evaluation of the force
+            kernels, without tracking the footprint of the beams.
+            incremental_tolerance is only effective with a single beam group.
+        """
+        if len(LaserBeams) == 0:
+            raise AttributeError("MultiBeamForceCalculator requires at least one LaserBeam")
+
+        super().__init__(ParticleSystem, LaserBeams[0], **kwargs)
+        self.LaserBeams = list(LaserBeams)
+
+        # Beams with the same direction share the rotated geometry
+        self.beam_groups = {}
+        for i, LB in enumerate(self.LaserBeams):
+            self.beam_groups.setdefault(tuple(LB.direction), []).append(i)
+
+    def __str__(self):
+        print("MultiBeamForceCalculator object instantiated with attributes:")
+        print(f"ParticleSystem: \n {self.ParticleSystem}")
+        for LB in self.LaserBeams:
+            print(f"LaserBeam: \n {LB}")
+        return ""
+
+    def force_value(self, cache = None):
+        """
+        Calculates optical forces of all beams combined
+
+        Parameters
+        ----------
+        cache : GeometryCache, optional
+            geometry of the current step shared with other force components,
+            see ForcePipeline. The default is None, which computes it.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            n_particles x 3 array of optical forces
+        """
+        forces = np.zeros((self.ParticleSystem.n, 3))
+        for group_forces in self.calculate_group_forces(merge = True, cache = cache):
+            forces += group_forces
+        return forces
+
+    def force_value_batch(self, locations, area_vectors, rotations = None):
+        """
+        Calculates optical forces of all beams combined for a batch of K poses
+
+        See OpticalForceCalculator.force_value_batch, the beams are evaluated
+        one after the other.
+        """
+        if self.self_shadowing or self.patch_layer is not None:
+            return super().force_value_batch(locations, area_vectors, rotations)
+        return sum(super(MultiBeamForceCalculator, self).force_value_batch(locations, area_vectors,
+                                                                         rotations, LaserBeam = LB)
+                   for LB in self.LaserBeams)
+
+    def beam_forces(self, cache = None):
+        """
+        Calculates optical forces of every beam separately
+
+        Parameters
+        ----------
+        cache : GeometryCache, optional
+            geometry to evaluate. The default is None, which uses the current state.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            n_beams x n_particles x 3 array of optical forces, in the order of self.LaserBeams
+        """
+        batch_forces = self.calculate_group_forces(merge = False, cache = cache)
+        forces = np.zeros((len(self.LaserBeams), self.ParticleSystem.n, 3))
+        for beams, beam_forces in zip(self.beam_batches, batch_forces):
+            forces[beams] = beam_forces
+        return forces
+
+    def calculate_group_forces(self, merge: bool = True, cache = None):
+        """
+        Evaluates the force kernels once per batch of beams
+
+        Parameters
+        ----------
+        merge : bool, optional
+            Merges beams with the same direction and polarisation into one
+            batch. The default is True. If False every beam is its own batch.
+        cache : GeometryCache, optional
+            geometry of the current step. The default is None, which computes it.
+
+        Returns
+        -------
+        forces : list[npt.NDArray]
+            n_particles x 3 array of optical forces per batch. The beam
+            indices of the batches are stored in self.beam_batches.
+        """
+        area_vectors, locations = self.surface_geometry(cache)
+        n = len(locations)
+
+        self.beam_batches = []
+        forces = []
+        for g, (direction, beams) in enumerate(self.beam_groups.items()):
+            rotation = beam_rotation(direction)
+            beam_locations = to_beam_frame(locations, rotation)
+            beam_area_vectors = to_beam_frame(area_vectors, rotation)
+
+            intensities = np.zeros((len(beams), n))
+            polarisations = []
+            for i, beam in enumerate(beams):
+                LB = self.LaserBeams[beam]
+                intensities[i] = np.broadcast_to(LB.intensity_profile(beam_locations[:,0],
+                                                                      beam_locations[:,1]), n)
+                polarisations.append(LB.polarization_map(beam_locations[:,0], beam_locations[:,1]))
+
+            # The hierarchy only needs to be refitted for the first group
+            shadowed = self.find_shadowed_nodes(locations, np.any(intensities != 0, axis=0),
+                                                np.array(direction), refit = g == 0)
+            if shadowed is not None:
+                intensities[:, shadowed] = 0
+
+            batches = []
+            remaining = list(range(len(beams)))
+            while remaining:
+                first = remaining[0]
+                batch = [i for i in remaining
+                         if i == first or (merge and np.array_equal(polarisations[i], polarisations[first]))]
+                batches.append(batch)
+                remaining = [i for i in remaining if i not in batch]
+
+            for batch in batches:
+                intensity_vectors = np.zeros(locations.shape)
+                intensity_vectors[:,2] = intensities[batch].sum(axis=0)
+                active = None
+                if self.intensity_threshold:
+                    active = intensity_vectors[:,2] >= self.intensity_threshold
+
+                if self.patch_layer is not None:
+                    batch_forces = self.patch_layer.calculate_forces(self,
+                                                                     beam_area_vectors,
+                                                                     intensity_vectors,
+                                                                     polarisations[batch[0]],
+                                                                     locations,
+                                                                     active)
+                else:
+                    batch_forces = self.calculate_forces(beam_area_vectors,
+                                                         intensity_vectors,
+                                                         polarisations[batch[0]],
+                                                         active)
+                forces.append(from_beam_frame(batch_forces, rotation))
+                self.beam_batches.append([beams[i] for i in batch])
+
+        return forces
+
+    def force_jacobian(self, as_linear_operator: bool = False, relative_step: float = 1e-4):
+        """
+        Calculates the derivative of the optical forces of all beams w.r.t. the nodal positions
+
+        The nodal blocks of every beam are summed before assembling, so the
+        derivative of the area vectors is only calculated once. See
+        OpticalForceCalculator.force_jacobian for the parameters.
+        """
+        PS = self.ParticleSystem
+        area_vectors = np.nan_to_num(PS.find_surface())
+        locations, _ = PS.x_v_current_3D
+
+        d_force_d_area = np.zeros((PS.n, 3, 3))
+        d_force_d_location = np.zeros((PS.n, 3, 3))
+        for LB in self.LaserBeams:
+            blocks = self.calculate_jacobian_blocks(area_vectors, locations, LB, relative_step)
+            d_force_d_area += blocks[0]
+            d_force_d_location += blocks[1]
+
+        return self.assemble_jacobian(d_force_d_area, d_force_d_location, as_linear_operator)
+
+    def calculate_stability_coefficients(self, displacement_range = [0.1, 5],
+                                         central_differences = False, per_beam = False):
+        """
+        Calculates the stability coefficients for the particle system
+
+        Parameters
+        ----------
+        displacement_range : list
+            list of length two representing the displacement magnitudes to
+            perform the stability test. First value represents lateral
+            displacement in meters. Second value represents
+            tilt angle around the centre of mass in degrees.
+        central_differences : bool, optional
+            Probes in both directions of every displacement. The default is False.
+        per_beam : bool, optional
+            Returns the coefficients of every beam separately. The displaced
+            geometry is shared by all beams. The default is False.
+
+        Returns
+        -------
+        stability_matrix : npt.arraytype
+            6x6 matrix holding the stability terms of the system using
+            notation convention of Jacobian, or n_beams x 6 x 6 if per_beam.
+            Unit of first three N/m, next three N/deg
+        """
+        if not per_beam:
+            return super().calculate_stability_coefficients(displacement_range, central_differences)
+
+        return self.calculate_probe_jacobian(self.posed_beam_restoring_forces,
+                                             displacement_range,
+                                             central_differences)
+
+    def posed_beam_restoring_forces(self, posed) -> npt.NDArray:
+        """
+        Net forces and moments of every beam for a stack of posed geometries
+
+        Self-shadowing and patches need the combined geometry of every pose,
+        so they are evaluated pose by pose, see beam_restoring_forces.
+
+        Parameters
+        ----------
+        posed : GeometrySnapshot
+            K poses from GeometryCache.pose_batch
+
+        Returns
+        -------
+        restoring_forces : npt.NDArray
+            K x n_beams x 6 array of [F_x, F_y, F_z, M_x, M_y, M_z]
+        """
+        if self.self_shadowing or self.patch_layer is not None:
+            return np.array([self.beam_restoring_forces(pose) for pose in posed.unstack()])
+        restoring_forces = []
+        for LB in self.LaserBeams:
+            forces = super().force_value_batch(posed.locations, posed.area_vectors, LaserBeam = LB)
+            restoring_forces.append(np.hstack(self.calculate_posed_restoring_forces(posed, forces)))
+        return np.stack(restoring_forces, axis=1)
+
+    def beam_restoring_forces(self, cache = None) -> npt.NDArray:
+        """
+        Calculates net forces and moments around the center of mass of every beam
+
+        Parameters
+        ----------
+        cache : GeometryCache, optional
+            geometry to evaluate. The default is None, which uses the current state.
+
+        Returns
+        -------
+        restoring_forces : npt.NDArray
+            n_beams x 6 array of [F_x, F_y, F_z, M_x, M_y, M_z]
+        """
+        return np.array([np.hstack(self.calculate_restoring_forces(forces, cache))
+                         for forces in self.beam_forces(cache)])
+
+    def plot(self, ax = None, **kwargs):
+        """Plots all beams, kwargs are passed to LaserBeam.plot"""
+        for LB in self.LaserBeams:
+            ax = LB.plot(ax, **kwargs)
+        return ax
@@ -7,27 +7,89 @@ Created on Tue Nov  7 14:19:21 2023
 @author: Mark Kalsbeek
 """
 from enum import Enum
-from itertools import compress
-from collections import defaultdict
 
 import numpy as np
 import numpy.typing as npt
 import scipy as sp
+import scipy.sparse as sps
+import scipy.sparse.linalg
 from scipy.constants import c
 from scipy.spatial.transform import Rotation
 from src.particleSystem.Force import Force
+from src.particleSystem.ForcePipeline import GeometryCache, GeometrySnapshot
+from src.ExternalForces.SelfShadowing import TriangleBVH
+from src.ExternalForces.OpticalPatches import OpticalPatchLayer
 import logging
 
 class OpticalForceCalculator(Force):
     """
     Handles the calculation of forces arising from optical pressure
     """
-    def __init__(self, ParticleSystem, LaserBeam):
+    def __init__(self, ParticleSystem, LaserBeam,
+                 intensity_threshold: float = 0,
+                 culling_margin: float = None,
+                 incremental_tolerance: float = 0,
+                 fused_kernel: bool = False,
+                 self_shadowing: bool = False,
+                 patch_size: float = None):
+        """
+        Parameters
+        ----------
+        ParticleSystem : ParticleSystem
+            system to calculate the optical forces on
+        LaserBeam : LaserBeam
+            beam illuminating the system
+        intensity_threshold : float, optional
+            Nodes with an intensity below this value are skipped and get zero
+            force. The default is 0, disabling culling. [W/m^2]
+        culling_margin : float, optional
+            Nodes within this distance of an illuminated node keep having
+            their intensity evaluated, and the footprint is rebuilt once any
+            node moved more than half of it. The default is None, which uses
+            5% of the extent of the mesh. [m]
+        incremental_tolerance : float, optional
+            Enables incremental re-interpolation of photonic crystals. The
+            result of the last interpolation of each node is reused until its
+            incidence angles moved more than this tolerance. Hits and
+            recomputations are counted in self.interpolation_stats.
+            The default is 0, disabling it. [rad]
+        fused_kernel : bool, optional
+            Uses calculate_arbitrary_phc_force_fused for photonic crystals,
+            which interpolates precomputed Cartesian outgoing rays instead of
+            spherical angles. The default is False.
+        self_shadowing : bool, optional
+            Casts a ray from every illuminated node towards the source and
+            sets the intensity of nodes that are shadowed by other parts of
+            the sail to zero. A bounding volume hierarchy over the surface
+            triangles is refitted every call. The default is False.
+        patch_size : float, optional
+            Evaluates the optical response on patches of roughly this size
+            instead of on every node, see OpticalPatchLayer. Intended for
+            very fine meshes, use estimate_patch_error to check the
+            resolution. The default is None, evaluating every node. [m]
+        """
         self.ParticleSystem = ParticleSystem
         self.PS = self.ParticleSystem #alias for convenience
         self.LaserBeam = LaserBeam
-
-        if not hasattr(self.ParticleSystem.particles[0],'optical_type'):
+        self.intensity_threshold = intensity_threshold
+        self.culling_margin = culling_margin
+        self.incremental_tolerance = incremental_tolerance
+        self.fused_kernel = fused_kernel
+        self.self_shadowing = self_shadowing
+        self.bvh = None
+        self.patch_layer = None
+        if patch_size is not None:
+            self.patch_layer = OpticalPatchLayer(patch_size)
+        self.interpolation_stats = {'hits': 0, 'recomputed': 0}
+        self.incidence_cache = None
+
+        # Legacy support: optical properties set as attributes on the particles
+        # are copied into the optical property table of the ParticleSystem
+        table = self.ParticleSystem.optical_properties
+        if hasattr(self.ParticleSystem.particles[0],'optical_type'):
+            table.from_particles(self.ParticleSystem.particles)
+
+        if not table.populated:
             raise AttributeError("ParticleSystem does not have any optical properties set!")
 
         super().__init__()
@@ -40,72 +102,762 @@ class OpticalForceCalculator(Force):
         print(f"LaserBeam: \n {self.LaserBeam}")
         return ""
 
-    def force_value(self):
+    def force_value(self, cache = None):
         """
         Calculates optical forces based on optical properties of ParticleSystem and LaserBeam
 
+        Parameters
+        ----------
+        cache : GeometryCache, optional
+            geometry of the current step shared with other force components,
+            see ForcePipeline. The default is None, which computes it.
+
         Returns
         -------
         forces : npt.NDArray
             flattened array of external forces of length 3 * n_particles.
 
         """
-        PS = self.ParticleSystem
         LB = self.LaserBeam
-        area_vectors = PS.find_surface()
-        area_vectors = np.nan_to_num(area_vectors)
-        locations, _ = PS.x_v_current_3D
-        forces = np.zeros(locations.shape)
+        area_vectors, locations = self.surface_geometry(cache)
+
+        # The force calculations assume a beam along z+, so everything is
+        # evaluated in the frame of the beam and rotated back afterwards
+        rotation = beam_rotation(LB.direction)
+        beam_locations = to_beam_frame(locations, rotation)
+
+        intensity_vectors, active = self.illumination(beam_locations, locations, LB,
+                                                      self.update_footprint(beam_locations))
+        polarisation_vectors = LB.polarization_map(beam_locations[:,0],beam_locations[:,1])
+
+        if self.patch_layer is not None:
+            forces = self.patch_layer.calculate_forces(self,
+                                                       to_beam_frame(area_vectors, rotation),
+                                                       intensity_vectors,
+                                                       polarisation_vectors,
+                                                       locations,
+                                                       active)
+        else:
+            forces = self.calculate_forces(to_beam_frame(area_vectors, rotation),
+                                           intensity_vectors,
+                                           polarisation_vectors,
+                                           active)
+        return from_beam_frame(forces, rotation)
+
+    def illumination(self, beam_locations, locations, LaserBeam, footprint = None):
+        """
+        Evaluates the intensity of a beam on the nodes and finds the nodes to calculate
+
+        Shared by force_value and force_jacobian, so the Jacobian linearises
+        the force over the same nodes.
+
+        Parameters
+        ----------
+        beam_locations : npt.NDArray
+            n_particles x 3 array of node locations in the frame of the beam
+        locations : npt.NDArray
+            n_particles x 3 array of node locations, used for self-shadowing
+        LaserBeam : LaserBeam
+            beam to evaluate
+        footprint : npt.NDArray, optional
+            boolean mask of the nodes to evaluate the intensity of, see
+            update_footprint. The default is None, evaluating all nodes.
+
+        Returns
+        -------
+        intensity_vectors : npt.NDArray
+            n_particles x 3 array of intensity vectors, zero outside the
+            footprint and on shadowed nodes
+        active : npt.NDArray
+            boolean mask of the nodes above intensity_threshold that are not
+            shadowed, or None if culling and self-shadowing are disabled
+        """
+        LB = LaserBeam
+        intensity_vectors = np.zeros(locations.shape)
+        if footprint is None:
+            footprint = np.ones(len(locations), dtype=bool)
+        x, y = beam_locations[footprint,0], beam_locations[footprint,1]
+        intensity_vectors[footprint,2] = np.broadcast_to(LB.intensity_profile(x, y), x.shape)
+
+        active = None
+        if self.intensity_threshold:
+            active = intensity_vectors[:,2] >= self.intensity_threshold
+        shadowed = self.find_shadowed_nodes(locations, intensity_vectors[:,2] != 0, LB.direction)
+        if shadowed is not None:
+            intensity_vectors[shadowed] = 0
+            active = ~shadowed if active is None else active & ~shadowed
+        return intensity_vectors, active
+
+    def surface_geometry(self, cache = None):
+        """Returns the area vectors and locations of the nodes, taken from cache if given"""
+        if cache is not None:
+            return cache.area_vectors, cache.locations
+        area_vectors = np.nan_to_num(self.ParticleSystem.find_surface())
+        locations, _ = self.ParticleSystem.x_v_current_3D
+        return area_vectors, locations
+
+    def force_value_batch(self, locations, area_vectors, rotations = None, LaserBeam = None):
+        """
+        Calculates optical forces for a batch of K poses of the ParticleSystem at once
+
+        All poses are evaluated as one array through the same force kernels.
+        Culling uses intensity_threshold, but without a footprint, and the
+        incremental re-interpolation is bypassed as its cache holds a single
+        pose. Self-shadowing and patches are evaluated pose by pose.
+
+        Parameters
+        ----------
+        locations : npt.NDArray
+            K x n_particles x 3 array of node locations
+        area_vectors : npt.NDArray
+            K x n_particles x 3 array of area vectors
+        rotations : npt.NDArray, optional
+            length K array of crystal rotations around z+ added to each pose,
+            e.g. the spin of a rigid sail. The default is None. [rad]
+        LaserBeam : LaserBeam, optional
+            beam to evaluate. The default is None, using self.LaserBeam.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            K x n_particles x 3 array of optical forces
+        """
+        locations = np.asarray(locations, dtype=np.float64)
+        area_vectors = np.asarray(area_vectors, dtype=np.float64)
+        if self.self_shadowing or self.patch_layer is not None:
+            if rotations is not None:
+                raise AttributeError("rotations are not supported with self_shadowing or patches")
+            masses = np.ones(locations.shape[1])
+            return np.array([self.force_value(GeometrySnapshot(x, np.zeros(x.shape), a,
+                                                               x.mean(axis=0), masses))
+                             for x, a in zip(locations, area_vectors)])
+
+        LB = self.LaserBeam if LaserBeam is None else LaserBeam
+        rotation = beam_rotation(LB.direction)
+        beam_locations = to_beam_frame(locations.reshape((-1,3)), rotation)
+        x, y = beam_locations[:,0], beam_locations[:,1]
+
+        intensity_vectors = np.zeros(beam_locations.shape)
+        intensity_vectors[:,2] = np.broadcast_to(LB.intensity_profile(x, y), x.shape)
+        active = None
+        if self.intensity_threshold:
+            active = (intensity_vectors[:,2] >= self.intensity_threshold).reshape(locations.shape[:2])
+        polarisation_vectors = np.asarray(LB.polarization_map(x, y))
+
+        forces = self.calculate_forces_batch(to_beam_frame(area_vectors.reshape((-1,3)), rotation).reshape(area_vectors.shape),
+                                             intensity_vectors.reshape(locations.shape),
+                                             polarisation_vectors.reshape(locations.shape[:2] + (-1,)),
+                                             active,
+                                             rotations)
+        return from_beam_frame(forces.reshape((-1,3)), rotation).reshape(locations.shape)
+
+    def calculate_forces_batch(self, area_vectors, intensity_vectors, polarisation_vectors,
+                               active = None, rotations = None):
+        """
+        Batched version of calculate_forces for K sets of nodal quantities
+
+        Parameters
+        ----------
+        area_vectors : npt.NDArray
+            K x n_particles x 3 array of area vectors
+        intensity_vectors : npt.NDArray
+            K x n_particles x 3 array of laser beam intensity vectors
+        polarisation_vectors : npt.NDArray
+            K x n_particles x 2 array of polarisation vectors
+        active : npt.NDArray, optional
+            K x n_particles boolean mask of the nodes to calculate, the others
+            get zero force. The default is None, calculating all nodes.
+        rotations : npt.NDArray, optional
+            length K array of crystal rotations added per set. The default is None. [rad]
 
-        if not hasattr(self, 'optical_type_mask'):
+        Returns
+        -------
+        forces : npt.NDArray
+            K x n_particles x 3 array of optical forces
+        """
+        forces = np.zeros(area_vectors.shape)
+        K = area_vectors.shape[0]
+
+        table = self.ParticleSystem.optical_properties
+        if getattr(self, 'optical_table_version', None) != table.version:
             self.create_optical_type_mask()
 
-        # ! Note ! This bakes in implicitly that the orientation of the light
-        # vector is in z+ direction
-        intensity_vectors = np.array([[0,0,LB.intensity_profile(x,y)] for x,y,z in locations])
-        polarisation_vectors = LB.polarization_map(locations[:,0],locations[:,1])
+        for optical_type, mask in self.optical_type_mask.items():
+            m = np.sum(mask)
+            rows = np.ones(K*m, dtype=bool) if active is None else active[:,mask].ravel()
+            if not np.any(rows):
+                continue
+            selected_area_vectors = area_vectors[:,mask].reshape((-1,3))[rows]
+            selected_intensity_vectors = intensity_vectors[:,mask].reshape((-1,3))[rows]
+            result = np.zeros((K*m,3))
+
+            if optical_type == ParticleOpticalPropertyType.SPECULAR:
+                result[rows] = self.calculate_specular_force(selected_area_vectors,
+                                                             selected_intensity_vectors)
+
+            elif optical_type == ParticleOpticalPropertyType.AXICONGRATING:
+                axicon_angle = np.tile(table.axicon_matrix[mask], (K,1,1))[rows]
+                result[rows] = self.calculate_axicongrating_force(selected_area_vectors,
+                                                                  selected_intensity_vectors,
+                                                                  axicon_angle)
+
+            elif optical_type == ParticleOpticalPropertyType.ARBITRARY_PHC:
+                node_rotations = np.tile(table.rotation[mask], (K,1))
+                if rotations is not None:
+                    node_rotations = node_rotations + np.asarray(rotations)[:,np.newaxis]
+                phc_dict = {phc: np.tile(submask, K)[rows] for phc, submask in self.phc_dict.items()}
+                result[rows] = self.phc_kernel(selected_area_vectors,
+                                               selected_intensity_vectors,
+                                               polarisation_vectors[:,mask].reshape((K*m,-1))[rows],
+                                               self.optical_interpolators,
+                                               node_rotations.ravel()[rows],
+                                               phc_dict)
+            forces[:,mask] = result.reshape((K,m,3))
+        return forces
+
+    def update_footprint(self, locations, rebuild = False):
+        """
+        Tracks which nodes lie in or close to the illuminated part of the beam
+
+        A KD-tree of the illuminated nodes is used to find all nodes within
+        culling_margin of them. Only these nodes have their intensity
+        evaluated. The footprint is rebuilt when any node has moved more than
+        half of culling_margin in the xy-plane since the last rebuild.
+
+        A rebuild starts from the nodes of the previous footprint and grows
+        it with the KD-tree until no illuminated node lies within
+        culling_margin, or about one mesh spacing, of an unevaluated node,
+        so only the nodes around the illuminated part are evaluated. The
+        first build, and a rebuild that finds no illuminated node in the
+        previous footprint, evaluate all nodes.
+
+        Parameters
+        ----------
+        locations : npt.NDArray
+            n_particles x 3 array of node locations in the frame of the beam
+        rebuild : bool, optional
+            Forces a rebuild of the footprint. The default is False.
+
+        Returns
+        -------
+        footprint : npt.NDArray
+            boolean mask of the nodes in the footprint, or None if culling is disabled
+        """
+        if not self.intensity_threshold:
+            return None
+
+        footprint_locations = getattr(self, 'footprint_locations', None)
+        if (not rebuild and footprint_locations is not None
+            and footprint_locations.shape == locations.shape):
+            displacement = np.linalg.norm(locations[:,:2]-footprint_locations[:,:2], axis=1)
+            if displacement.max() <= self.footprint_margin/2:
+                return self.footprint_mask
+
+        LB = self.LaserBeam
+        margin = self.culling_margin
+        if margin is None:
+            margin = 0.05*np.ptp(locations[:,:2])
+
+        candidates = np.ones(len(locations), dtype=bool)
+        reach = margin
+        if (not rebuild and footprint_locations is not None
+            and footprint_locations.shape == locations.shape and np.any(self.footprint_mask)):
+            candidates = self.footprint_mask.copy()
+            # The search reaches the neighbouring nodes even if the margin is finer than the mesh
+            spacing, _ = sp.spatial.cKDTree(locations[:,:2]).query(locations[:,:2], k = 2)
+            reach = max(margin, 1.5*spacing[:,1].max())
+
+        illuminated = np.zeros(len(locations), dtype=bool)
+        evaluated = np.zeros(len(locations), dtype=bool)
+        footprint = illuminated
+        while np.any(candidates):
+            x, y = locations[candidates,0], locations[candidates,1]
+            illuminated[candidates] = np.broadcast_to(LB.intensity_profile(x, y),
+                                                      x.shape) >= self.intensity_threshold
+            evaluated |= candidates
+            if not np.any(illuminated):
+                # The beam left the previous footprint
+                candidates = ~evaluated
+                continue
+            tree = sp.spatial.cKDTree(locations[illuminated,:2])
+            distances, _ = tree.query(locations[:,:2], distance_upper_bound = reach)
+            footprint = distances <= margin
+            # Nodes next to the illuminated part can extend it
+            candidates = (distances <= reach) & ~evaluated
+        self.footprint_mask = footprint
+        self.footprint_locations = locations.copy()
+        self.footprint_margin = margin
+        logging.debug(f'Beam footprint rebuilt, {np.sum(illuminated)} illuminated nodes, '
+                      f'{np.sum(self.footprint_mask)} tracked, {np.sum(evaluated)} evaluated')
+
+        return self.footprint_mask
+
+    def find_shadowed_nodes(self, locations, candidates = None, direction = None, refit = True):
+        """
+        Finds the nodes that are shadowed by other parts of the sail
+
+        A ray is cast from each candidate node towards the source of the beam.
+        Triangles that contain the node itself are ignored. The bounding
+        volume hierarchy is built on the first call and refitted on later
+        calls, which keeps this cheap enough to run every timestep.
+
+        Parameters
+        ----------
+        locations : npt.NDArray
+            n_particles x 3 array of node locations
+        candidates : npt.NDArray, optional
+            boolean mask of the nodes to check, e.g. the illuminated nodes.
+            The default is None, which checks all nodes.
+        direction : npt.NDArray, optional
+            propagation direction of the beam. The default is None, which
+            uses the direction of self.LaserBeam.
+        refit : bool, optional
+            Refits the hierarchy to the locations. Can be disabled when
+            casting rays in several directions for the same locations.
+            The default is True.
+
+        Returns
+        -------
+        shadowed : npt.NDArray
+            boolean mask of the shadowed nodes, or None if self_shadowing is disabled
+        """
+        if not self.self_shadowing:
+            return None
+
+        simplices = self.ParticleSystem.simplices
+        if self.bvh is None or self.bvh.simplices is not simplices:
+            self.bvh = TriangleBVH(simplices, locations)
+        elif refit:
+            self.bvh.refit(locations)
+
+        nodes = np.arange(len(locations))
+        if candidates is not None:
+            nodes = nodes[candidates]
+
+        if direction is None:
+            direction = self.LaserBeam.direction
+        extent = np.ptp(locations)
+        self.shadow_mask = np.zeros(len(locations), dtype=bool)
+        self.shadow_mask[nodes] = self.bvh.intersect(locations[nodes], -np.asarray(direction),
+                                                     exclude = nodes,
+                                                     epsilon = 1e-9*(extent if extent>0 else 1))
+        return self.shadow_mask
+
+    def calculate_forces(self, area_vectors, intensity_vectors, polarisation_vectors, active = None):
+        """
+        Calculates the optical forces for given nodal area vectors and beam properties
+
+        Dispatches the nodes to the force calculation of their optical type.
+        Every node is treated independently, so this can also be used to
+        evaluate perturbed area vectors.
+
+        Parameters
+        ----------
+        area_vectors : npt.NDArray
+            n_particles x 3 array of area vectors
+        intensity_vectors : npt.NDArray
+            n_particles x 3 array of laser beam intensity vectors
+        polarisation_vectors : npt.NDArray
+            n_particles x 2 array of polarisation vectors
+        active : npt.NDArray, optional
+            boolean mask of the nodes to calculate, the others get zero force.
+            The default is None, calculating all nodes.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            n_particles x 3 array of optical forces
+        """
+        forces = np.zeros(area_vectors.shape)
+
+        table = self.ParticleSystem.optical_properties
+        if getattr(self, 'optical_table_version', None) != table.version:
+            self.create_optical_type_mask()
 
         for optical_type in self.optical_type_mask.keys():
             if optical_type == ParticleOpticalPropertyType.SPECULAR:
-                mask = self.optical_type_mask[optical_type]
+                mask = self.active_mask(optical_type, active)
                 forces[mask] = self.calculate_specular_force(area_vectors[mask],
                                                              intensity_vectors[mask])
 
             elif optical_type == ParticleOpticalPropertyType.AXICONGRATING:
-                mask = self.optical_type_mask[optical_type]
-                filtered_particles = compress(PS.particles, mask)
-                axicon_angle = [p.axicon_angle for p in filtered_particles]
+                mask = self.active_mask(optical_type, active)
+                axicon_angle = table.axicon_matrix[mask]
                 forces[mask] = self.calculate_axicongrating_force(area_vectors[mask],
                                                                   intensity_vectors[mask],
                                                                   axicon_angle)
 
             elif optical_type == ParticleOpticalPropertyType.ARBITRARY_PHC:
-                mask = self.optical_type_mask[optical_type]
-                if not hasattr(self, 'optical_interpolators'):
-                    self.create_phc_map(mask)
+                mask = self.active_mask(optical_type, active)
+                forces[mask] = self.phc_kernel(area_vectors[mask],
+                                               intensity_vectors[mask],
+                                               polarisation_vectors[mask],
+                                               self.optical_interpolators,
+                                               table.rotation[mask],
+                                               self.active_phc_dict(active),
+                                               np.flatnonzero(mask))
+        return forces
 
+    @property
+    def phc_kernel(self):
+        """force calculation used for photonic crystals, set by self.fused_kernel"""
+        if self.fused_kernel:
+            return self.calculate_arbitrary_phc_force_fused
+        return self.calculate_arbitrary_phc_force
+
+    def active_mask(self, optical_type, active = None):
+        """Returns the mask of optical_type, limited to the active nodes"""
+        mask = self.optical_type_mask[optical_type]
+        if active is None:
+            return mask
+        return mask & active
+
+    def active_phc_dict(self, active = None):
+        """Returns self.phc_dict with the submasks limited to the active nodes"""
+        if active is None:
+            return self.phc_dict
+        active = active[self.optical_type_mask[ParticleOpticalPropertyType.ARBITRARY_PHC]]
+        return {phc: submask[active] for phc, submask in self.phc_dict.items()}
+
+    def force_jacobian(self, as_linear_operator: bool = False, relative_step: float = 1e-4):
+        """
+        Calculates the derivative of the nodal optical forces w.r.t. the nodal positions
 
-                forces[mask] = self.calculate_arbitrary_phc_force(area_vectors[mask],
-                                                                  intensity_vectors[mask],
-                                                                  polarisation_vectors[mask],
-                                                                  self.optical_interpolators)
-        return forces
+        The chain rule is applied as dF/dx = dF/da * da/dx + dF/dI * dI/dx.
+        da/dx is the analytic derivative of ParticleSystem.find_surface. The
+        local derivatives dF/da are analytic for specular and axicon grating
+        nodes. For photonic crystals they are found with central differences
+        of the interpolated crystal response, which captures the change of
+        the incidence angles. dI/dx uses central differences of the intensity
+        profile of the LaserBeam.
+
+        The nodes are culled and shadowed as in force_value. A patch layer is
+        not taken into account, the Jacobian linearises the per-node force.
+
+        Parameters
+        ----------
+        as_linear_operator : bool, optional
+            If True a scipy LinearOperator is returned that does not form the
+            matrix product. The default is False.
+        relative_step : float, optional
+            Step size of the central differences, relative to the area vector
+            magnitude and the extent of the mesh. The default is 1e-4.
+
+        Returns
+        -------
+        jacobian : sps.csr_matrix or sps.linalg.LinearOperator
+            3n x 3n derivative using the same convention as the system
+            Jacobian of the ParticleSystem: entry [3i+k, 3j+l] holds
+            dF_i,k / dx_j,l
+        """
+        PS = self.ParticleSystem
+        area_vectors = np.nan_to_num(PS.find_surface())
+        locations, _ = PS.x_v_current_3D
+
+        d_force_d_area, d_force_d_location = self.calculate_jacobian_blocks(area_vectors,
+                                                                            locations,
+                                                                            self.LaserBeam,
+                                                                            relative_step,
+                                                                            track_footprint = True)
+        return self.assemble_jacobian(d_force_d_area, d_force_d_location, as_linear_operator)
+
+    def calculate_jacobian_blocks(self,
+                                  area_vectors,
+                                  locations,
+                                  LaserBeam,
+                                  relative_step = 1e-4,
+                                  track_footprint = False):
+        """
+        Calculates the nodal blocks of the force Jacobian for a single beam
+
+        See force_jacobian. The blocks are calculated in the frame of the
+        beam and rotated back, B = R^T B' R. The nodes are culled and
+        shadowed as in force_value, see illumination.
+
+        Parameters
+        ----------
+        area_vectors : npt.NDArray
+            n_particles x 3 array of area vectors
+        locations : npt.NDArray
+            n_particles x 3 array of node locations
+        LaserBeam : LaserBeam
+            beam to calculate the derivatives for
+        relative_step : float, optional
+            Step size of the central differences. The default is 1e-4.
+        track_footprint : bool, optional
+            Evaluates the intensity only in the footprint of the beam, see
+            update_footprint. Only valid for self.LaserBeam. The default is False.
+
+        Returns
+        -------
+        d_force_d_area : npt.NDArray
+            n_particles x 3 x 3 array holding dF/da of every node
+        d_force_d_location : npt.NDArray
+            n_particles x 3 x 3 array holding dF/dI * dI/dx of every node
+        """
+        LB = LaserBeam
+        rotation = beam_rotation(LB.direction)
+        beam_locations = to_beam_frame(locations, rotation)
+        beam_area_vectors = to_beam_frame(area_vectors, rotation)
+
+        polarisation_vectors = LB.polarization_map(beam_locations[:,0],beam_locations[:,1])
+
+        # Culled and shadowed nodes have zero force, so also a zero derivative
+        footprint = self.update_footprint(beam_locations) if track_footprint else None
+        intensity_vectors, active = self.illumination(beam_locations, locations, LB, footprint)
+
+        d_force_d_area = self.calculate_area_derivatives(beam_area_vectors,
+                                                         intensity_vectors,
+                                                         polarisation_vectors,
+                                                         relative_step,
+                                                         active)
+
+        # Forces are linear in intensity, so dF/dI follows from a unit beam
+        unit_intensity_vectors = np.zeros(locations.shape)
+        unit_intensity_vectors[:,2] = 1
+        unit_forces = self.calculate_forces(beam_area_vectors,
+                                            unit_intensity_vectors,
+                                            polarisation_vectors,
+                                            active)
+
+        extent = np.ptp(beam_locations[:,:2])
+        h = relative_step * (extent if extent>0 else 1)
+        intensity_gradient = np.zeros(locations.shape)
+        for i in range(2):
+            offset = np.zeros(2)
+            offset[i] = h
+            intensity_gradient[:,i] = (LB.intensity_profile(beam_locations[:,0]+offset[0],
+                                                            beam_locations[:,1]+offset[1])
+                                       - LB.intensity_profile(beam_locations[:,0]-offset[0],
+                                                              beam_locations[:,1]-offset[1]))/(2*h)
+        d_force_d_location = np.einsum('ni,nj->nij', unit_forces, intensity_gradient)
+
+        if rotation is not None:
+            d_force_d_area = rotation.T @ d_force_d_area @ rotation
+            d_force_d_location = rotation.T @ d_force_d_location @ rotation
+
+        return d_force_d_area, d_force_d_location
+
+    def assemble_jacobian(self, d_force_d_area, d_force_d_location, as_linear_operator = False):
+        """
+        Combines the nodal blocks into the 3n x 3n force Jacobian, see force_jacobian
+
+        Parameters
+        ----------
+        d_force_d_area : npt.NDArray
+            n_particles x 3 x 3 array holding dF/da of every node
+        d_force_d_location : npt.NDArray
+            n_particles x 3 x 3 array holding dF/dI * dI/dx of every node
+        as_linear_operator : bool, optional
+            If True a scipy LinearOperator is returned that does not form the
+            matrix product. The default is False.
+
+        Returns
+        -------
+        jacobian : sps.csr_matrix or sps.linalg.LinearOperator
+        """
+        PS = self.ParticleSystem
+        n = PS.n
+
+        indices = np.arange(n)
+        indptr = np.arange(n+1)
+        d_force_d_area = sps.bsr_matrix((d_force_d_area, indices, indptr), shape=(3*n, 3*n))
+        d_force_d_location = sps.bsr_matrix((d_force_d_location, indices, indptr), shape=(3*n, 3*n))
+        d_area_d_location = PS.find_surface_jacobian()
+
+        if as_linear_operator:
+            return sps.linalg.LinearOperator((3*n, 3*n),
+                                             matvec = lambda v: d_force_d_area.dot(d_area_d_location.dot(v))
+                                                                + d_force_d_location.dot(v),
+                                             dtype = np.float64)
+
+        jacobian = d_force_d_area.dot(d_area_d_location) + d_force_d_location
+        return sps.csr_matrix(jacobian)
+
+    def calculate_area_derivatives(self,
+                                   area_vectors,
+                                   intensity_vectors,
+                                   polarisation_vectors,
+                                   relative_step = 1e-4,
+                                   active = None):
+        """
+        Calculates the derivatives of the nodal forces w.r.t. their own area vector
+
+        Parameters
+        ----------
+        area_vectors : npt.NDArray
+            n_particles x 3 array of area vectors
+        intensity_vectors : npt.NDArray
+            n_particles x 3 array of laser beam intensity vectors
+        polarisation_vectors : npt.NDArray
+            n_particles x 2 array of polarisation vectors
+        relative_step : float, optional
+            step size of the central differences for photonic crystals,
+            relative to the magnitude of the area vector. The default is 1e-4.
+        active : npt.NDArray, optional
+            boolean mask of the nodes to calculate, the others get zero
+            derivatives. The default is None, calculating all nodes.
+
+        Returns
+        -------
+        derivatives : npt.NDArray
+            n_particles x 3 x 3 array holding dF_i/da_i for every node
+        """
+        derivatives = np.zeros(area_vectors.shape + (3,))
+
+        table = self.ParticleSystem.optical_properties
+        if getattr(self, 'optical_table_version', None) != table.version:
+            self.create_optical_type_mask()
+
+        for optical_type in self.optical_type_mask.keys():
+            mask = self.active_mask(optical_type, active)
+            if optical_type == ParticleOpticalPropertyType.SPECULAR:
+                derivatives[mask] = specular_force_derivative(area_vectors[mask],
+                                                              intensity_vectors[mask])
+
+            elif optical_type == ParticleOpticalPropertyType.AXICONGRATING:
+                axicon_angle = table.axicon_matrix[mask]
+                scaling_factor = axicon_angle[:,2,2]
+                derivatives[mask] = np.matmul(axicon_angle,
+                                              specular_force_derivative(area_vectors[mask],
+                                                                        intensity_vectors[mask]))
+                derivatives[mask] *= scaling_factor[:,np.newaxis,np.newaxis]
+
+            elif optical_type == ParticleOpticalPropertyType.ARBITRARY_PHC:
+                phc_dict = self.active_phc_dict(active)
+                if self.fused_kernel and all(hasattr(phc, 'outgoing_vectors_gradient')
+                                             for phc in phc_dict):
+                    derivatives[mask] = self.calculate_phc_area_derivatives(area_vectors[mask],
+                                                                            intensity_vectors[mask],
+                                                                            polarisation_vectors[mask],
+                                                                            table.rotation[mask],
+                                                                            phc_dict)
+                    continue
+
+                sub_area_vectors = area_vectors[mask]
+                h = relative_step * np.linalg.norm(sub_area_vectors, axis=1)
+                h[h==0] = relative_step
+                for j in range(3):
+                    perturbation = np.zeros(sub_area_vectors.shape)
+                    perturbation[:,j] = h
+                    forces = []
+                    for sign in [1,-1]:
+                        forces.append(self.phc_kernel(sub_area_vectors + sign*perturbation,
+                                                      intensity_vectors[mask],
+                                                      polarisation_vectors[mask],
+                                                      self.optical_interpolators,
+                                                      table.rotation[mask],
+                                                      phc_dict))
+                    derivatives[mask,:,j] = (forces[0]-forces[1])/(2*h[:,np.newaxis])
+
+        return derivatives
+
+    def calculate_phc_area_derivatives(self,
+                                       area_vectors,
+                                       intensity_vectors,
+                                       polarisation_vectors,
+                                       rotations = None,
+                                       phc_dict = None):
+        """
+        Calculates the analytic derivative of the fused photonic crystal force w.r.t. the area vector
+
+        Requires interpolators that provide outgoing_vectors_gradient, like
+        spline_interpolator. With G = e_z + cos(theta) r + sin(theta) r_perp
+        and F = a_z I G / c this evaluates
+        dF/da = I/c (G e_z^T + a_z (dG/dtheta dtheta/da^T + dG/dphi dphi/da^T))
+
+        Parameters
+        ----------
+        area_vectors : npt.NDArray
+            An array of shape (n_particles, 3) representing the area vectors of n particles.
+        intensity_vectors : npt.NDArray
+            An array of shape (n_particles, 3) representing the intensity vectors of laser beams for
+            n particles.
+        polarisation_vectors : npt.NDArray
+            An array of shape (n_particles, 2) representing the polarisation vectors of laser beams
+            for n particles.
+        rotations : npt.NDArray, optional
+            An array of shape (n_particles,) holding the rotation of the crystal around z+ of each
+            particle [rad].
+        phc_dict : dict, optional
+            dict formatted as {interpolator: submask} into the passed particles.
+            The default is None, using self.phc_dict.
+
+        Returns
+        -------
+        derivatives : npt.NDArray
+            An array of shape (n_particles, 3, 3) holding dF/da for every particle.
+        """
+        norms = np.linalg.norm(area_vectors, axis=1)
+        norms[norms==0] = np.inf
+        lateral = np.hypot(area_vectors[:,0], area_vectors[:,1])
+        cos_in = area_vectors[:,2]/norms
+        sin_in = lateral/norms
+
+        pol = np.arccos(polarisation_vectors[:,0])
+        incoming_ray = np.column_stack((np.arctan2(lateral, area_vectors[:,2]),
+                                        np.arctan2(area_vectors[:,1], area_vectors[:,0]) % (2*np.pi),
+                                        np.arctan2(np.abs(np.sin(pol)), np.abs(np.cos(pol)))))
+        if rotations is not None:
+            incoming_ray[:,1] -= rotations
+            incoming_ray[:,2] -= rotations
+
+        if phc_dict is None:
+            phc_dict = self.phc_dict
+        out = np.zeros((len(incoming_ray), 6))
+        gradient = np.zeros((len(incoming_ray), 6, 3))
+        for phc, submask in phc_dict.items():
+            out[submask] = phc.outgoing_vectors(incoming_ray[submask])
+            gradient[submask] = phc.outgoing_vectors_gradient(incoming_ray[submask])
+        if rotations is not None:
+            out = rotate_outgoing_vectors(out, rotations)
+            for l in range(3):
+                gradient[:,:,l] = rotate_outgoing_vectors(gradient[:,:,l], rotations)
+
+        cos_in = cos_in[:,np.newaxis]
+        sin_in = sin_in[:,np.newaxis]
+        G = cos_in*out[:,:3] + sin_in*out[:,3:]
+        G[:,2] += 1
+        dG_dtheta = (-sin_in*out[:,:3] + cos_in*out[:,3:]
+                     + cos_in*gradient[:,:3,0] + sin_in*gradient[:,3:,0])
+        dG_dphi = cos_in*gradient[:,:3,1] + sin_in*gradient[:,3:,1]
+
+        # The incidence angles are not differentiable at normal incidence
+        lateral[lateral==0] = np.inf
+        dtheta_da = np.column_stack((area_vectors[:,2]*area_vectors[:,0]/lateral,
+                                     area_vectors[:,2]*area_vectors[:,1]/lateral,
+                                     -np.where(np.isinf(lateral), 0, lateral)))/norms[:,np.newaxis]**2
+        dphi_da = np.column_stack((-area_vectors[:,1],
+                                   area_vectors[:,0],
+                                   np.zeros(len(area_vectors))))/lateral[:,np.newaxis]**2
+
+        derivatives = np.zeros(area_vectors.shape + (3,))
+        derivatives[:,:,2] = G
+        derivatives += area_vectors[:,2,np.newaxis,np.newaxis]*(np.einsum('ni,nj->nij', dG_dtheta, dtheta_da)
+                                                                + np.einsum('ni,nj->nij', dG_dphi, dphi_da))
+        derivatives *= (intensity_vectors[:,2]/c)[:,np.newaxis,np.newaxis]
+        return derivatives
 
     def create_phc_map(self, mask):
-        filtered_particles = compress(self.PS.particles, mask)
-        original_indices = [i for i, m in enumerate(mask) if m]
+        """
+        sets a dict formatted as {interpolator: submask} onto self
 
-        self.optical_interpolators = []
+        The submasks index into the particles selected by mask, so they can be
+        applied directly to the filtered arrays in calculate_arbitrary_phc_force
+        """
+        table = self.PS.optical_properties
+        if np.any(table.crystal_id[mask] < 0):
+            missing = np.flatnonzero(mask & (table.crystal_id < 0))
+            raise AttributeError("All particles of optical type ARBITRARY_PHC should have a"
+                                 " crystal set. Currently the particles with indices"
+                                 f" {missing} have no crystal set")
 
-        # let's check if it's one or multiple PHC's
-        self.phc_dict = defaultdict(list)
-        for i, p in enumerate(filtered_particles):
-            self.optical_interpolators.append(p.optical_interpolator)
-            #build dict of mask entries and which PhC they belong to.
-            self.phc_dict[p.optical_interpolator].append(original_indices[i])
+        self.optical_interpolators = [table.crystals[i] for i in table.crystal_id[mask]]
 
-        for key in self.phc_dict.keys():
-            self.phc_dict[key] = self.create_submask(self.phc_dict[key])
+        # let's check if it's one or multiple PHC's
+        self.phc_dict = {}
+        for phc, submask in table.crystal_masks().items():
+            self.phc_dict[phc] = submask[mask]
 
     def create_submask(self, indice_list):
         length = len(self.PS.particles)
@@ -171,11 +923,8 @@ class OpticalForceCalculator(Force):
         forces : npt.NDArray
             flattened array of external forces of length 3 * n_particles.
         """
-        rotation_super_matrix = sp.linalg.block_diag(*axicon_angle)
-
         forces = self.calculate_specular_force(area_vectors, intensity_vectors)
-        forces = rotation_super_matrix.dot(np.hstack(forces).T)
-        forces = np.reshape(forces, [int(forces.shape[0]/3),3])
+        forces = np.einsum('nij,nj->ni', axicon_angle, forces)
 
         # The forces need to be scaled to account for the fact that
         # |[1,1]| != |[1]|+|[1]|
@@ -194,7 +943,10 @@ class OpticalForceCalculator(Force):
                                               area_vectors,
                                               intensity_vectors,
                                               polarisation_vectors,
-                                              optical_interpolators):
+                                              optical_interpolators,
+                                              rotations = None,
+                                              phc_dict = None,
+                                              node_indices = None):
         """
         Calculates forces for particles of optical type 'axicon grating'
 
@@ -208,6 +960,15 @@ class OpticalForceCalculator(Force):
         polarisation_vectors : npt.NDArray
             An array of shape (n_particles, 3) representing the polarisation vectors of laser beams
             for n particles.
+        rotations : npt.NDArray, optional
+            An array of shape (n_particles,) holding the rotation of the crystal around z+ of each
+            particle [rad]. Applied on top of the rotation of the interpolators.
+        phc_dict : dict, optional
+            dict formatted as {interpolator: submask} into the passed particles.
+            The default is None, using self.phc_dict.
+        node_indices : npt.NDArray, optional
+            indices of the passed particles in the ParticleSystem. Required
+            to use incremental re-interpolation. The default is None.
 
 
         Returns
@@ -234,13 +995,23 @@ class OpticalForceCalculator(Force):
                                   azimuth_angles,
                                   polarisation_angles)).T
 
+        # Per particle crystal rotation, same convention as the interpolators
+        if rotations is not None:
+            incoming_ray[:,1] -= rotations
+            incoming_ray[:,2] -= rotations
+
         # Find directions of outgoing rays
         # Interpolator([polar_in, azimuth_in, polarization_in])->[polar_out, azimuth_out, magnitude]
         reflected_ray = np.zeros(incoming_ray.shape)
 
-        for phc in self.phc_dict:
-            submask = self.phc_dict[phc]
-            reflected_ray[submask] = phc(incoming_ray[submask])
+        if phc_dict is None:
+            phc_dict = self.phc_dict
+        if self.incremental_tolerance and node_indices is not None:
+            reflected_ray = self.interpolate_incremental(incoming_ray, phc_dict, node_indices)
+        else:
+            for phc in phc_dict:
+                submask = phc_dict[phc]
+                reflected_ray[submask] = phc(incoming_ray[submask])
 
 
         # reflected_ray = [interp(incoming_ray[i])
@@ -248,6 +1019,8 @@ class OpticalForceCalculator(Force):
         #                  for i, interp
         #                  in enumerate(optical_interpolators)] # [polar_out, azimuth_out, magnitude]
         polar_angles_out, azimuth_angles_out, magnitudes = np.array(reflected_ray).T
+        if rotations is not None:
+            azimuth_angles_out += rotations
 
         # Switch reference frame again; made easier becasue we are going to [0,0,1]
         polar_angles_out += polar_angles
@@ -268,12 +1041,162 @@ class OpticalForceCalculator(Force):
 
         return forces
 
+    def calculate_arbitrary_phc_force_fused(self,
+                                            area_vectors,
+                                            intensity_vectors,
+                                            polarisation_vectors,
+                                            optical_interpolators = None,
+                                            rotations = None,
+                                            phc_dict = None,
+                                            node_indices = None):
+        """
+        Calculates forces for particles of optical type 'arbitrary phc' in a single pass
+
+        Equivalent to calculate_arbitrary_phc_force, but interpolates the
+        outgoing rays as Cartesian vectors in the local frame. The tilt of the
+        area vector is applied as out = cos(theta_in) r + sin(theta_in) r_perp,
+        which avoids the round trip through spherical coordinates.
+
+        Parameters
+        ----------
+        area_vectors : npt.NDArray
+            An array of shape (n_particles, 3) representing the area vectors of n particles.
+        intensity_vectors : npt.NDArray
+            An array of shape (n_particles, 3) representing the intensity vectors of laser beams for
+            n particles.
+        polarisation_vectors : npt.NDArray
+            An array of shape (n_particles, 2) representing the polarisation vectors of laser beams
+            for n particles.
+        optical_interpolators : list, optional
+            Unused, kept for a call signature identical to calculate_arbitrary_phc_force.
+        rotations : npt.NDArray, optional
+            An array of shape (n_particles,) holding the rotation of the crystal around z+ of each
+            particle [rad]. Applied on top of the rotation of the interpolators.
+        phc_dict : dict, optional
+            dict formatted as {interpolator: submask} into the passed particles.
+            The default is None, using self.phc_dict.
+        node_indices : npt.NDArray, optional
+            indices of the passed particles in the ParticleSystem. Required
+            to use incremental re-interpolation. The default is None.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            An array of shape (n_particles, 3) of optical forces.
+        """
+        norms = np.linalg.norm(area_vectors, axis=1)
+        norms[norms==0] = np.inf
+        lateral = np.hypot(area_vectors[:,0], area_vectors[:,1])
+        cos_in = area_vectors[:,2]/norms
+        sin_in = lateral/norms
+
+        pol = np.arccos(polarisation_vectors[:,0])
+        incoming_ray = np.column_stack((np.arctan2(lateral, area_vectors[:,2]),
+                                        np.arctan2(area_vectors[:,1], area_vectors[:,0]) % (2*np.pi),
+                                        np.arctan2(np.abs(np.sin(pol)), np.abs(np.cos(pol)))))
+        if rotations is not None:
+            incoming_ray[:,1] -= rotations
+            incoming_ray[:,2] -= rotations
+
+        if phc_dict is None:
+            phc_dict = self.phc_dict
+        if self.incremental_tolerance and node_indices is not None:
+            out = self.interpolate_incremental(incoming_ray, phc_dict, node_indices, cartesian = True)
+        else:
+            out = np.zeros((len(incoming_ray), 6))
+            for phc, submask in phc_dict.items():
+                out[submask] = outgoing_vectors(phc, incoming_ray[submask])
+        if rotations is not None:
+            out = rotate_outgoing_vectors(out, rotations)
+
+        incident_power = area_vectors[:,2] * intensity_vectors[:,2] # assumes z+ poynting vector
+        forces = cos_in[:,np.newaxis]*out[:,:3] + sin_in[:,np.newaxis]*out[:,3:]
+        forces *= (incident_power/c)[:,np.newaxis]
+        forces[:,2] += incident_power/c
+
+        return forces
+
+    def interpolate_incremental(self, incoming_ray, phc_dict, node_indices, cartesian = False):
+        """
+        Interpolates the crystal response, reusing cached results of nodes that barely moved
+
+        The incidence is cached in the frame of the crystal, so a rotating
+        interpolator (see simulate_trajectory) invalidates the cache of its
+        nodes automatically.
+
+        Parameters
+        ----------
+        incoming_ray : npt.NDArray
+            n_particles x 3 array of [polar, azimuth, polarisation] angles [rad]
+        phc_dict : dict
+            dict formatted as {interpolator: submask} into the passed particles
+        node_indices : npt.NDArray
+            indices of the passed particles in the ParticleSystem
+        cartesian : bool, optional
+            If True the outgoing rays are interpolated as Cartesian vectors,
+            see outgoing_vectors. The default is False.
+
+        Returns
+        -------
+        reflected_ray : npt.NDArray
+            n_particles x 3 array of [polar_out, azimuth_out, magnitude], or
+            n_particles x 6 array of outgoing vectors if cartesian is True
+        """
+        n = self.PS.n
+        width = 6 if cartesian else 3
+        if (self.incidence_cache is None or len(self.incidence_cache) != n
+            or self.reflection_cache.shape[1] != width):
+            self.incidence_cache = np.full((n,3), np.nan)
+            self.reflection_cache = np.zeros((n,width))
+
+        reflected_ray = np.zeros((len(incoming_ray), width))
+        hits = 0
+        recomputed = 0
+        for phc, submask in phc_dict.items():
+            rotation = getattr(phc, 'rotation', 0)
+            nodes = node_indices[submask]
+            incidence = incoming_ray[submask] - np.array([0, rotation, rotation])
+
+            # Azimuth differences are scaled by sin(polar), as the azimuth is
+            # ill-defined close to normal incidence
+            delta = np.abs(incidence - self.incidence_cache[nodes])
+            delta[:,1:] = np.abs((delta[:,1:] + np.pi) % (2*np.pi) - np.pi)
+            delta[:,1] *= np.abs(np.sin(incidence[:,0]))
+            stale = ~(np.max(delta, axis=1) <= self.incremental_tolerance)
+
+            if np.any(stale):
+                if cartesian:
+                    result = rotate_outgoing_vectors(outgoing_vectors(phc, incoming_ray[submask][stale]),
+                                                     -rotation)
+                else:
+                    result = phc(incoming_ray[submask][stale])
+                    result[:,1] -= rotation
+                self.incidence_cache[nodes[stale]] = incidence[stale]
+                self.reflection_cache[nodes[stale]] = result
+
+            if cartesian:
+                reflected_ray[submask] = rotate_outgoing_vectors(self.reflection_cache[nodes], rotation)
+            else:
+                result = self.reflection_cache[nodes].copy()
+                result[:,1] += rotation
+                reflected_ray[submask] = result
+
+            recomputed += np.sum(stale)
+            hits += len(nodes) - np.sum(stale)
+
+        self.interpolation_stats['hits'] += int(hits)
+        self.interpolation_stats['recomputed'] += int(recomputed)
+        logging.debug(f'Incremental interpolation: {hits=}, {recomputed=}')
+        return reflected_ray
+
     def create_optical_type_mask(self):
         """
-        loops over particles and sets a dict of masks onto self formatted as {type:mask}
+        sets a dict of masks onto self formatted as {type:mask}
 
         This is used to efficiently split computation of the different particle
-        types without resorting to repeated looping.
+        types without resorting to repeated looping. The masks are read from the
+        optical property table of the ParticleSystem and are rebuilt whenever
+        the version of that table changes.
 
         Raises
         ------
@@ -281,32 +1204,36 @@ class OpticalForceCalculator(Force):
             Raises error when particles have no optical type set.
 
         """
-        optical_type_list = []
-        error_index_list = []
-        for i, particle in enumerate(self.ParticleSystem.particles):
-            if hasattr(particle, 'optical_type'):
-                optical_type_list.append(particle.optical_type)
-            else:
-                error_index_list.append(i)
+        table = self.ParticleSystem.optical_properties
+        error_index_list = table.unset
         if len(error_index_list)>0:
             raise AttributeError("All particles should have an optical type"
                                  " set prior to calculation of optical forces."
                                  " Currently the particles with indices"
                                  f" {error_index_list} have no property set")
-        optical_type_list = np.array(optical_type_list)
 
         self.optical_type_mask = {}
 
         for optical_type in ParticleOpticalPropertyType:
-            mask = optical_type_list == optical_type
+            mask = table.type_mask(optical_type)
             if sum(mask)>0:
                 self.optical_type_mask[optical_type] = mask
 
+        if ParticleOpticalPropertyType.ARBITRARY_PHC in self.optical_type_mask:
+            self.create_phc_map(self.optical_type_mask[ParticleOpticalPropertyType.ARBITRARY_PHC])
+
+        self.optical_table_version = table.version
+        self.incidence_cache = None
 
-    def calculate_stability_coefficients(self, displacement_range = [0.1, 5]):
+
+    def calculate_stability_coefficients(self, displacement_range = [0.1, 5],
+                                         central_differences = False):
         """
         Calculates the stability coefficients for the particle system
 
+        The probes are rigidly posed copies of the current geometry, so the
+        ParticleSystem itself is never displaced.
+
         Parameters
         ----------
         displacement_range : list
@@ -314,6 +1241,9 @@ class OpticalForceCalculator(Force):
             perform the stability test. First value represents lateral
             displacement in meters. Second value represents
             tilt angle around the centre of mass in degrees.
+        central_differences : bool, optional
+            Probes in both directions of every displacement. Twice the
+            evaluations, but second order accurate. The default is False.
 
         Returns
         -------
@@ -323,20 +1253,55 @@ class OpticalForceCalculator(Force):
             Unit of first three N/m, next three N/deg
 
         """
-        q, alpha = displacement_range
-        displacement_vectors = np.array([[q,0,0,0,0,0],
-                                         [0,q,0,0,0,0],
-                                         [0,0,q,0,0,0],
-                                         [0,0,0,alpha,0,0],
-                                         [0,0,0,0,alpha,0],
-                                         [0,0,0,0,0,alpha]])
+        def reaction(posed):
+            forces = self.force_value_batch(posed.locations, posed.area_vectors)
+            return np.hstack(self.calculate_posed_restoring_forces(posed, forces))
+        return self.calculate_probe_jacobian(reaction, displacement_range, central_differences)
+
+    def calculate_probe_jacobian(self, reaction, displacement_range = [0.1, 5],
+                                 central_differences = False):
+        """
+        Finite difference derivative of a reaction w.r.t. rigid displacements
 
-        jacobian = np.zeros((6,6))
-        for i, vector in enumerate(displacement_vectors):
-            jacobian[:,i] =np.hstack(self.calculate_force_gradient(vector))
+        The current geometry is captured once and all probes, including the
+        unperturbed one for forward differences, are posed from it in one
+        stack, see GeometryCache.pose_batch, so the reaction evaluates them
+        in a single batch.
 
-        return jacobian
+        Parameters
+        ----------
+        reaction : Callable[[GeometrySnapshot], npt.NDArray]
+            maps a stack of K posed geometries to an array of shape
+            (K, ..., 6) of forces and moments
+        displacement_range : list
+            lateral displacement in meters and tilt angle in degrees of the probes
+        central_differences : bool, optional
+            Uses central instead of forward differences. The default is False.
 
+        Returns
+        -------
+        jacobian : npt.NDArray
+            array of shape (..., 6, 6), entry [..., i, j] holds the derivative
+            of reaction component i w.r.t. displacement j
+        """
+        q, alpha = displacement_range
+        steps = np.array([q, q, q, alpha, alpha, alpha], dtype=np.float64)
+        displacement_vectors = np.diag(steps)
+        if central_differences:
+            probes = np.vstack((displacement_vectors, -displacement_vectors))
+        else:
+            probes = np.vstack((displacement_vectors, np.zeros(6)))
+
+        cache = GeometryCache(self.ParticleSystem)
+        reactions = np.asarray(reaction(cache.pose_batch(probes)))
+        steps = steps.reshape((6,) + (1,)*(reactions.ndim-1))
+        if central_differences:
+            differences = (reactions[:6] - reactions[6:])/(2*steps)
+        else:
+            differences = (reactions[:6] - reactions[6])/steps
+
+        # Probes are stacked along the first axis, the jacobian has them as columns
+        return np.moveaxis(differences, 0, -1)
 
     def calculate_force_gradient(self, displacement_vector : npt.ArrayLike):
         """
@@ -359,22 +1324,22 @@ class OpticalForceCalculator(Force):
         k_rot : TYPE
             lenght 3 list of translational reaction coefficients [dM_x/dx__i, dM_y/dx__i, dM_z/dx__i]
         """
+        displacement_vector = np.asarray(displacement_vector)
         displacement =  displacement_vector[displacement_vector !=0]
         if len(displacement)>1:
             raise AttributeError("Expected vector with only one nonzero value,"
                                  f"instead got {displacement_vector}")
 
-        original = self.calculate_restoring_forces()
-        self.PS.displace(displacement_vector)
-        reaction = self.calculate_restoring_forces()
-        self.PS.un_displace()
+        cache = GeometryCache(self.ParticleSystem)
+        original = self.calculate_restoring_forces(cache = cache)
+        reaction = self.calculate_restoring_forces(cache = cache.pose(displacement_vector))
 
         k_trans = (reaction[0] - original[0])/displacement
         k_rot = (reaction[1] - original[1])/displacement
         return k_trans, k_rot
 
 
-    def calculate_restoring_forces(self, forces : npt.ArrayLike= None):
+    def calculate_restoring_forces(self, forces : npt.ArrayLike= None, cache = None):
         """
         calculates net forces and moments around the center of mass
 
@@ -383,6 +1348,9 @@ class OpticalForceCalculator(Force):
         forces : npt.Arraylike
             Allows inputting the forces directly, but is calculated automatically when ommitted.
             Prevents doing double work in simulation context.
+        cache : GeometryCache, optional
+            geometry to evaluate, e.g. a posed copy from GeometryCache.pose.
+            The default is None, which uses the current state.
 
         Returns
         -------
@@ -394,17 +1362,112 @@ class OpticalForceCalculator(Force):
         """
         PS = self.ParticleSystem
         if type(forces) == type(None):
-            forces = self.force_value()
+            forces = self.force_value(cache)
         net_force = np.sum(forces,axis=0)
 
-        COM =PS.calculate_center_of_mass()
-        locations, _ = PS.x_v_current_3D
-        moment_arms = PS.translate_mesh(locations, -COM) # note: this doesn't displace the PS, just applies a transformation on the 'locations' variable
+        if cache is not None:
+            moment_arms = cache.locations - cache.center_of_mass
+        else:
+            COM =PS.calculate_center_of_mass()
+            locations, _ = PS.x_v_current_3D
+            moment_arms = PS.translate_mesh(locations, -COM) # note: this doesn't displace the PS, just applies a transformation on the 'locations' variable
         moments = np.cross(moment_arms, forces)
         net_moments = np.sum(moments,axis=0)
 
         return net_force, net_moments
 
+    def calculate_restoring_forces_batch(self, displacements : npt.ArrayLike, batch_size = 256):
+        """
+        Net forces and moments of the rigidly displaced sail for a set of displacements
+
+        The current geometry is captured once and posed for all displacements
+        at once, see GeometryCache.pose_batch, after which force_value_batch
+        evaluates every pose in the same array. The ParticleSystem itself is
+        never displaced. As with ParticleSystem.displace, the crystals are not
+        rotated with the sail.
+
+        Parameters
+        ----------
+        displacements : npt.ArrayLike
+            K x 6 array of displacements [x, y, z, rx, ry, rz] in meters and
+            degrees, with the same convention as ParticleSystem.displace
+        batch_size : int, optional
+            number of poses evaluated per call of force_value_batch, limits
+            the memory use for large K. The default is 256.
+
+        Returns
+        -------
+        net_force : npt.NDArray
+            K x 3 array of net forces on the center of mass
+        net_moments : npt.NDArray
+            K x 3 array of net moments around the displaced center of mass
+        """
+        displacements = np.array(displacements, dtype=np.float64, ndmin=2)
+        cache = GeometryCache(self.ParticleSystem)
+        net_force = np.zeros((len(displacements), 3))
+        net_moments = np.zeros((len(displacements), 3))
+        for i in range(0, len(displacements), batch_size):
+            batch = slice(i, i+batch_size)
+            posed = cache.pose_batch(displacements[batch])
+            forces = self.force_value_batch(posed.locations, posed.area_vectors)
+            net_force[batch], net_moments[batch] = self.calculate_posed_restoring_forces(posed, forces)
+        return net_force, net_moments
+
+    def calculate_posed_restoring_forces(self, posed, forces : npt.ArrayLike):
+        """
+        Net forces and moments of a stack of posed geometries
+
+        Parameters
+        ----------
+        posed : GeometrySnapshot
+            K poses from GeometryCache.pose_batch
+        forces : npt.ArrayLike
+            K x n_particles x 3 array of nodal forces on the poses, e.g. from
+            force_value_batch
+
+        Returns
+        -------
+        net_force : npt.NDArray
+            K x 3 array of net forces on the center of mass
+        net_moments : npt.NDArray
+            K x 3 array of net moments around the center of mass of every pose
+        """
+        forces = np.asarray(forces)
+        moment_arms = posed.locations - posed.center_of_mass[:,np.newaxis]
+        return np.sum(forces, axis=1), np.sum(np.cross(moment_arms, forces), axis=1)
+
+    def estimate_patch_error(self) -> dict:
+        """
+        Compares the optical patch evaluation against a full per-node evaluation
+
+        Returns
+        -------
+        errors : dict
+            'force' and 'moment' hold the norm of the error of the net force
+            and the net moment around the center of mass, relative to the
+            norm of the full evaluation. 'nodal' holds the root mean square
+            error of the nodal forces relative to the root mean square of the
+            full nodal forces.
+        """
+        if self.patch_layer is None:
+            raise AttributeError("OpticalForceCalculator has no patch layer, set patch_size")
+
+        patch_forces = self.force_value()
+        patch_layer = self.patch_layer
+        self.patch_layer = None
+        try:
+            forces = self.force_value()
+        finally:
+            self.patch_layer = patch_layer
+
+        relative = lambda error, reference: (np.linalg.norm(error)
+                                             / (np.linalg.norm(reference) if np.any(reference) else 1))
+        net_force, net_moment = self.calculate_restoring_forces(forces)
+        patch_net_force, patch_net_moment = self.calculate_restoring_forces(patch_forces)
+        return {'force': relative(patch_net_force-net_force, net_force),
+                'moment': relative(patch_net_moment-net_moment, net_moment),
+                'nodal': relative(patch_forces-forces, forces)}
+
 class ParticleOpticalPropertyType(Enum):
     """
     Enumeration representing the various types of optical properties for the Particles
@@ -415,14 +1478,15 @@ class ParticleOpticalPropertyType(Enum):
         Indicates that the particle reflects light specularly
     ARBITRARY_PHC : str
         Indicates that the particle represents an arbitrary photonic crystal
-        NOTE: scipy.interpolate.interpnd.LinearNDInterpolator has to be set on
-        particle.optical_interpolator(elevation, azimuth, polarisation_angle)
-        ->(elevation, azimuth, magnitude)
+        NOTE: an interpolator(elevation, azimuth, polarisation_angle)
+        ->(elevation, azimuth, magnitude) has to be assigned with
+        ParticleSystem.optical_properties.set_crystal (legacy: particle.optical_interpolator)
     AXICONGRATING : str
         Indicates that the particle scatter light like a cone
         NOTE: Directing angle should be set in the format of a rotation matrix
         for the relevant particles that represents [rx, ry] rotations of area
-        vector on property particle.axicon_angle
+        vector with ParticleSystem.optical_properties.set_axicon_matrix
+        (legacy: particle.axicon_angle)
     """
 
     SPECULAR = "specular"
@@ -431,6 +1495,87 @@ class ParticleOpticalPropertyType(Enum):
 
 vectorized_optical_type_retriever = np.vectorize(lambda  p: p.optical_type)
 
+def beam_rotation(direction: npt.ArrayLike) -> npt.NDArray:
+    """
+    Finds the rotation from the global frame into the frame of a beam
+
+    The force calculations assume a beam along z+. For other directions
+    vectors are rotated with the smallest rotation that maps the direction
+    onto z+. The x and y axes of this frame are the ones the intensity and
+    polarization profiles of the LaserBeam are evaluated in.
+
+    Parameters
+    ----------
+    direction : npt.ArrayLike
+        unit vector of the propagation direction of the beam
+
+    Returns
+    -------
+    rotation : npt.NDArray
+        3x3 rotation matrix, or None for a beam along z+
+    """
+    direction = np.asarray(direction, dtype=np.float64)
+    unit_z = np.array([0,0,1])
+    if np.all(direction == unit_z):
+        return None
+
+    axis = np.cross(direction, unit_z)
+    sine = np.linalg.norm(axis)
+    cosine = direction.dot(unit_z)
+    if sine < 1e-12:
+        # Anti-parallel, rotate half a turn around x
+        return np.diag([1., -1., -1.]) if cosine < 0 else np.identity(3)
+
+    skew = np.array([[0, -axis[2], axis[1]],
+                     [axis[2], 0, -axis[0]],
+                     [-axis[1], axis[0], 0]])
+    return np.identity(3) + skew + skew.dot(skew)*(1-cosine)/sine**2
+
+def to_beam_frame(vectors: npt.NDArray, rotation: npt.NDArray) -> npt.NDArray:
+    """Rotates n x 3 vectors into the frame of a beam, see beam_rotation"""
+    if rotation is None:
+        return vectors
+    return vectors.dot(rotation.T)
+
+def from_beam_frame(vectors: npt.NDArray, rotation: npt.NDArray) -> npt.NDArray:
+    """Rotates n x 3 vectors from the frame of a beam back into the global frame"""
+    if rotation is None:
+        return vectors
+    return vectors.dot(rotation)
+
+def specular_force_derivative(area_vectors: npt.NDArray,
+                              intensity_vectors: npt.NDArray) -> npt.NDArray:
+    """
+    Computes the derivative of the specular force w.r.t. the area vector
+
+    The specular force is F = 2 I a_z a / (c |a|), with the beam along z+.
+
+    Parameters
+    ----------
+    area_vectors : npt.NDArray
+        An array of shape (n_particles, 3) representing the area vectors of n particles.
+    intensity_vectors : npt.NDArray
+        An array of shape (n_particles, 3) representing the intensity vectors of laser beams for
+        n particles.
+
+    Returns
+    -------
+    derivatives : npt.NDArray
+        An array of shape (n_particles, 3, 3) holding dF/da for every particle.
+    """
+    norms = np.linalg.norm(area_vectors, axis=1)
+    norms[norms==0] = np.inf
+    units = area_vectors / norms[:,np.newaxis]
+
+    derivatives = np.zeros(area_vectors.shape + (3,))
+    derivatives[:,:,2] = units
+    derivatives += (units[:,2,np.newaxis,np.newaxis]
+                    *(np.identity(3) - np.einsum('ni,nj->nij', units, units)))
+    derivatives *= (2*intensity_vectors[:,2]/c)[:,np.newaxis,np.newaxis]
+
+    return derivatives
+
+
 def compute_spherical_coordinates(area_vectors: npt.NDArray,
                                   polarisation_vectors: npt.NDArray) -> (
                                       npt.NDArray, npt.NDArray, npt.NDArray):
@@ -472,6 +1617,69 @@ def compute_spherical_coordinates(area_vectors: npt.NDArray,
     return polar_angles, azimuth_angles, polarisation_angles
 
 
+def cartesian_outgoing_vectors(reflected_rays: npt.NDArray) -> npt.NDArray:
+    """
+    Converts interpolator output to outgoing vectors in the local frame of the crystal
+
+    Parameters
+    ----------
+    reflected_rays : npt.NDArray
+        An array of shape (n, 3) of [polar_out, azimuth_out, magnitude].
+
+    Returns
+    -------
+    vectors : npt.NDArray
+        An array of shape (n, 6). The first three columns hold the outgoing
+        ray r, the last three its derivative w.r.t. the polar angle r_perp.
+        A ray tilted by theta_in is then cos(theta_in) r + sin(theta_in) r_perp.
+    """
+    polar, azimuth, magnitude = reflected_rays.T
+    cos_azimuth = np.cos(azimuth)
+    sin_azimuth = np.sin(azimuth)
+    in_plane = magnitude*np.sin(polar)
+    vertical = magnitude*np.cos(polar)
+
+    return np.column_stack((in_plane*cos_azimuth, in_plane*sin_azimuth, vertical,
+                            vertical*cos_azimuth, vertical*sin_azimuth, -in_plane))
+
+
+def rotate_outgoing_vectors(vectors: npt.NDArray, angles) -> npt.NDArray:
+    """
+    Rotates outgoing vectors as returned by cartesian_outgoing_vectors around z+
+
+    Parameters
+    ----------
+    vectors : npt.NDArray
+        An array of shape (n, 6) of outgoing vectors.
+    angles : float | npt.NDArray
+        Rotation angle(s) [rad].
+
+    Returns
+    -------
+    vectors : npt.NDArray
+        Rotated copy of the vectors.
+    """
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    rotated = vectors.copy()
+    for i in [0,3]:
+        rotated[:,i] = cos*vectors[:,i] - sin*vectors[:,i+1]
+        rotated[:,i+1] = sin*vectors[:,i] + cos*vectors[:,i+1]
+    return rotated
+
+
+def outgoing_vectors(interpolator, incoming_ray: npt.NDArray) -> npt.NDArray:
+    """
+    Looks up the outgoing vectors of a crystal for an array of incoming rays
+
+    Uses the precomputed Cartesian table of the interpolator when available,
+    otherwise converts its spherical output.
+    """
+    if hasattr(interpolator, 'outgoing_vectors'):
+        return interpolator.outgoing_vectors(incoming_ray)
+    return cartesian_outgoing_vectors(interpolator(incoming_ray))
+
+
 def spherical_to_cartesian(polar_angles: npt.NDArray,
                            azimuth_angles: npt.NDArray,
                            magnitudes: npt.NDArray) -> npt.NDArray:
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Coarse level-of-detail layer for the optical force calculation of fine meshes
+"""
+import logging
+
+import numpy as np
+import numpy.typing as npt
+import scipy.sparse as sps
+
+
+class OpticalPatchLayer:
+    """
+    Aggregates clusters of nodes into optical patches
+
+    The nodes are binned into square patches in the plane of the sail. Only
+    nodes with identical optical properties share a patch. Each patch is
+    evaluated once with the summed area vector of its nodes and their
+    intensity averaged over area. The patch force is then divided over its
+    nodes in proportion to their incident power. As the patch centroid is
+    weighted the same way, the nodal forces reproduce both the force and the
+    moment of every patch exactly.
+
+    The polarisation of a patch is the power weighted mean direction of the
+    polarisation of its nodes, normalised to unit length.
+
+    The patches are assigned on the first evaluation and kept while the
+    optical property table is unchanged, so they move along with the mesh.
+    The incremental re-interpolation of the calculator caches the response
+    of each patch at its representative node. These can change when the
+    patches are reassigned, so the cache is reset then.
+    """
+    def __init__(self, patch_size: float):
+        """
+        Parameters
+        ----------
+        patch_size : float
+            edge length of the patches in the plane of the sail. [m]
+        """
+        if patch_size <= 0:
+            raise AttributeError(f"patch_size should be positive, got {patch_size}")
+        self.patch_size = patch_size
+        self.labels = None
+        return
+
+    def __str__(self):
+        if self.labels is None:
+            return f"OpticalPatchLayer with patch size {self.patch_size}, not yet assigned"
+        return (f"OpticalPatchLayer with patch size {self.patch_size}, "
+                f"{len(self.labels)} nodes in {self.n_patches} patches")
+
+    def assign_patches(self, locations: npt.NDArray, table):
+        """
+        Bins the nodes into patches
+
+        Parameters
+        ----------
+        locations : npt.NDArray
+            n_particles x 3 array of node locations
+        table : OpticalPropertyTable
+            optical properties of the nodes
+        """
+        # Normal of the plane of the sail is the direction of least spread,
+        # the patch grid is aligned with the x-axis projected onto the plane
+        centered = locations - locations.mean(axis=0)
+        normal = np.linalg.svd(centered, full_matrices=False)[2][-1]
+        axis = np.eye(3)[0] if abs(normal[0]) < 0.9 else np.eye(3)[1]
+        axis -= axis.dot(normal)*normal
+        axis /= np.linalg.norm(axis)
+        in_plane = centered.dot(np.vstack((axis, np.cross(normal, axis))).T)
+
+        # The last patch in each direction absorbs the remainder of the extent
+        in_plane -= in_plane.min(axis=0)
+        n_cells = np.maximum(np.ceil(in_plane.max(axis=0)/self.patch_size - 1e-9), 1)
+        cells = np.minimum(np.floor(in_plane/self.patch_size), n_cells-1)
+
+        keys = np.column_stack((cells,
+                                table.type_code,
+                                table.crystal_id,
+                                table.rotation,
+                                table.axicon_matrix.reshape((-1, 9))))
+        _, representatives, labels = np.unique(keys, axis=0,
+                                               return_index=True,
+                                               return_inverse=True)
+        n = len(locations)
+        self.labels = labels.ravel()
+        self.representatives = representatives
+        self.n_patches = len(representatives)
+        self.aggregation = sps.csr_matrix((np.ones(n), (self.labels, np.arange(n))),
+                                          shape=(self.n_patches, n))
+        self.table_version = table.version
+        logging.debug(f'Optical patches assigned, {n} nodes in {self.n_patches} patches')
+
+    def calculate_forces(self,
+                         OpticalForceCalculator,
+                         area_vectors: npt.NDArray,
+                         intensity_vectors: npt.NDArray,
+                         polarisation_vectors: npt.NDArray,
+                         locations: npt.NDArray,
+                         active: npt.NDArray = None) -> npt.NDArray:
+        """
+        Calculates the optical forces per patch and distributes them over the nodes
+
+        Parameters
+        ----------
+        OpticalForceCalculator : OpticalForceCalculator
+            calculator whose force kernels evaluate the patches
+        area_vectors : npt.NDArray
+            n_particles x 3 array of area vectors in the frame of the beam
+        intensity_vectors : npt.NDArray
+            n_particles x 3 array of laser beam intensity vectors
+        polarisation_vectors : npt.NDArray
+            n_particles x 2 array of polarisation vectors
+        locations : npt.NDArray
+            n_particles x 3 array of node locations, used to assign the patches
+        active : npt.NDArray, optional
+            boolean mask of the nodes to include, the others get zero force.
+            The default is None, including all nodes.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            n_particles x 3 array of optical forces in the frame of the beam
+        """
+        table = OpticalForceCalculator.ParticleSystem.optical_properties
+        if (self.labels is None or self.table_version != table.version
+            or len(self.labels) != len(area_vectors)):
+            self.assign_patches(locations, table)
+            OpticalForceCalculator.incidence_cache = None
+
+        intensity = intensity_vectors[:,2]
+        if active is not None:
+            intensity = np.where(active, intensity, 0)
+        magnitudes = np.linalg.norm(area_vectors, axis=1)
+        power = intensity*magnitudes
+
+        patch_magnitudes = self.aggregation.dot(magnitudes)
+        patch_power = self.aggregation.dot(power)
+        illuminated = patch_power > 0
+        safe_power = np.where(illuminated, patch_power, 1)
+
+        # Patch quantities are stored at a representative node, so the
+        # kernels can look up the optical properties of the patch
+        representatives = self.representatives
+        patch_area_vectors = np.zeros(area_vectors.shape)
+        patch_area_vectors[representatives] = self.aggregation.dot(area_vectors)
+        patch_intensity_vectors = np.zeros(intensity_vectors.shape)
+        patch_intensity_vectors[representatives,2] = patch_power/np.where(patch_magnitudes>0,
+                                                                          patch_magnitudes, 1)
+        polarisation_vectors = np.asarray(polarisation_vectors)
+        patch_polarisation_vectors = np.zeros(polarisation_vectors.shape, dtype=polarisation_vectors.dtype)
+        # Polarisation varying within a patch shortens the mean, which is
+        # renormalised. Where it cancels, the representative node is used.
+        mean_polarisation = self.aggregation.dot(polarisation_vectors*power[:,np.newaxis])
+        lengths = np.linalg.norm(mean_polarisation, axis=1)
+        mean_polarisation = np.where((lengths > 0)[:,np.newaxis],
+                                     mean_polarisation/np.where(lengths > 0, lengths, 1)[:,np.newaxis],
+                                     polarisation_vectors[representatives])
+        patch_polarisation_vectors[representatives] = mean_polarisation
+        patch_active = np.zeros(len(area_vectors), dtype=bool)
+        patch_active[representatives] = illuminated
+
+        patch_forces = OpticalForceCalculator.calculate_forces(patch_area_vectors,
+                                                               patch_intensity_vectors,
+                                                               patch_polarisation_vectors,
+                                                               patch_active)[representatives]
+
+        share = power/safe_power[self.labels]
+        return share[:,np.newaxis]*patch_forces[self.labels]
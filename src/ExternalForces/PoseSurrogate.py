@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Response surface of the net optical force and moment over the pose of an undeformed sail
+"""
+import logging
+import time
+
+import numpy as np
+import numpy.typing as npt
+from scipy.interpolate import RegularGridInterpolator
+from scipy.spatial.transform import Rotation
+
+from src.particleSystem.Force import Force
+from src.particleSystem.ForcePipeline import GeometryCache
+
+
+POSE_NAMES = ['x', 'y', 'rx', 'ry', 'rz']
+
+
+class PoseSurrogate(Force):
+    """
+    Lookup table of the net force and moment of a rigid sail as function of its pose
+
+    The full force model is sampled once on a grid over the pose
+    [x, y, rx, ry, rz] relative to the reference pose, the translations in
+    meters and the angles in degrees as in ParticleSystem.displace. The grid
+    points are clustered around the reference pose, where trajectories spend
+    most of their time. Axes with a single point are held at zero.
+
+    Afterwards the surrogate is a drop-in replacement of the force
+    calculator for trajectories without deformation. The pose is recovered
+    from the node locations by a least squares fit, and force_value returns
+    nodal forces that reproduce the interpolated net force and moment.
+    """
+    def __init__(self, ForceCalculator,
+                 translation_range: float = None,
+                 rotation_range: float = 5,
+                 spin_range: float = 0,
+                 n_points: tuple = (9, 9, 9, 9, 9),
+                 clustering: float = 2,
+                 method: str = 'linear',
+                 rotate_crystals: bool = False,
+                 batch_size: int = 256):
+        """
+        Parameters
+        ----------
+        ForceCalculator : OpticalForceCalculator
+            full force model, its ParticleSystem sets the reference pose
+        translation_range : float, optional
+            half width of the sampled x and y translation. The default is
+            None, which uses the extent of the sail in x, the perimeter of
+            simulate_trajectory. [m]
+        rotation_range : float, optional
+            half width of the sampled rx and ry angles. The default is 5,
+            the attitude limit of simulate_trajectory. [deg]
+        spin_range : float, optional
+            half width of the sampled rz angle. The default is 0, leaving rz
+            out of the table. [deg]
+        n_points : tuple, optional
+            number of grid points along x, y, rx, ry and rz. The default is (9, 9, 9, 9, 9).
+        clustering : float, optional
+            exponent p of the grid spacing, the points are placed at
+            range*sign(u)*|u|^p for u evenly spaced in [-1, 1]. Values above
+            1 refine the grid around the reference pose. The default is 2.
+        method : str, optional
+            interpolation method of RegularGridInterpolator, e.g. 'linear' or
+            'cubic'. The default is 'linear'.
+        rotate_crystals : bool, optional
+            Turns the photonic crystals along with rz, see RigidBody. Requires
+            a force calculator with force_value_batch. The default is False.
+        batch_size : int, optional
+            number of poses evaluated per call of force_value_batch. The default is 256.
+        """
+        self.ForceCalculator = ForceCalculator
+        self.ParticleSystem = ForceCalculator.ParticleSystem
+        self.PS = self.ParticleSystem
+        self.method = method
+        self.rotate_crystals = rotate_crystals
+        self.batch_size = batch_size
+        if rotate_crystals and not hasattr(ForceCalculator, 'force_value_batch'):
+            raise AttributeError("rotate_crystals requires a ForceCalculator with force_value_batch")
+
+        self.reference = GeometryCache(self.ParticleSystem)
+        self.masses = np.array(self.reference.masses, dtype=np.float64)
+        self.reference_arms = self.reference.locations - self.reference.center_of_mass
+
+        if translation_range is None:
+            translation_range = np.ptp(self.reference.locations[:,0])
+        ranges = np.array([translation_range, translation_range,
+                           rotation_range, rotation_range, spin_range], dtype=np.float64)
+        n_points = np.where(ranges > 0, n_points, 1)
+        if np.any(n_points < 1) or np.any(n_points[ranges > 0] == 1):
+            raise AttributeError(f"Every sampled axis needs at least 2 points, got {n_points}")
+        self.ranges = ranges
+        self.grid = [np.zeros(1) if n == 1 else r*np.sign(u)*np.abs(u)**clustering
+                     for r, n, u in zip(ranges, n_points, [np.linspace(-1, 1, n) for n in n_points])]
+        self.axes = np.flatnonzero(n_points > 1)
+
+        start_time = time.time()
+        mesh = np.meshgrid(*self.grid, indexing='ij')
+        poses = np.column_stack([m.ravel() for m in mesh])
+        net_force, net_moment = self.sample(poses)
+        self.table = np.hstack((net_force, net_moment)).reshape(tuple(n_points) + (6,))
+        self.interpolator = RegularGridInterpolator([self.grid[axis] for axis in self.axes],
+                                                    np.squeeze(self.table, axis=tuple(np.flatnonzero(n_points == 1))),
+                                                    method = method,
+                                                    bounds_error = False,
+                                                    fill_value = None)
+        delta_time = time.time() - start_time
+        logging.info(f'Pose surrogate of {len(poses)} poses over {[POSE_NAMES[a] for a in self.axes]} '
+                     f'built in {delta_time:.2f}s')
+        super().__init__()
+        return
+
+    def __str__(self):
+        return (f"PoseSurrogate over {[POSE_NAMES[a] for a in self.axes]}, "
+                f"{self.table.shape[:-1]} grid, ranges {self.ranges}, {self.method} interpolation")
+
+    def sample(self, poses: npt.NDArray):
+        """
+        Evaluates the full force model for poses relative to the reference
+
+        Parameters
+        ----------
+        poses : npt.NDArray
+            K x 5 array of poses [x, y, rx, ry, rz]
+
+        Returns
+        -------
+        net_force : npt.NDArray
+            K x 3 array of net forces
+        net_moment : npt.NDArray
+            K x 3 array of net moments around the center of mass
+        """
+        FC = self.ForceCalculator
+        poses = np.array(poses, dtype=np.float64, ndmin=2)
+        net_force = np.zeros((len(poses), 3))
+        net_moment = np.zeros((len(poses), 3))
+        for i in range(0, len(poses), self.batch_size):
+            batch = slice(i, i+self.batch_size)
+            posed = self.reference.pose_batch(np.insert(poses[batch], 2, 0, axis=1))
+            locations = posed.locations
+            if hasattr(FC, 'force_value_batch'):
+                rotations = np.deg2rad(poses[batch,4]) if self.rotate_crystals else None
+                forces = FC.force_value_batch(locations, posed.area_vectors, rotations)
+            else:
+                forces = np.array([np.reshape(FC.force_value(self.reference.pose(np.insert(pose, 2, 0))), (-1,3))
+                                   for pose in poses[batch]])
+            arms = locations - posed.center_of_mass[:,np.newaxis]
+            net_force[batch] = np.sum(forces, axis=1)
+            net_moment[batch] = np.sum(np.cross(arms, forces), axis=1)
+        return net_force, net_moment
+
+    def pose_loads(self, poses: npt.ArrayLike):
+        """
+        Interpolated net force and moment of poses
+
+        Parameters
+        ----------
+        poses : npt.ArrayLike
+            K x 5 array of poses [x, y, rx, ry, rz]. Poses outside the grid are extrapolated.
+
+        Returns
+        -------
+        net_force : npt.NDArray
+            K x 3 array of net forces
+        net_moment : npt.NDArray
+            K x 3 array of net moments around the center of mass
+        """
+        poses = np.array(poses, dtype=np.float64, ndmin=2)
+        loads = self.interpolator(poses[:,self.axes])
+        return loads[:,:3], loads[:,3:]
+
+    def find_poses(self, locations: npt.NDArray):
+        """
+        Fits the rigid motion of the reference pose to node locations
+
+        Parameters
+        ----------
+        locations : npt.NDArray
+            K x n_particles x 3 array of node locations
+
+        Returns
+        -------
+        poses : npt.NDArray
+            K x 5 array of poses [x, y, rx, ry, rz]
+        """
+        center_of_mass = np.einsum('n,kni->ki', self.masses, locations)/np.sum(self.masses)
+        arms = locations - center_of_mass[:,np.newaxis]
+
+        # Kabsch: rotation R minimising sum m |R r_ref - r|^2
+        covariance = np.einsum('n,ni,knj->kij', self.masses, self.reference_arms, arms)
+        U, _, Vt = np.linalg.svd(covariance)
+        sign = np.sign(np.linalg.det(np.einsum('kji,klj->kil', Vt, U)))
+        U[:,:,2] *= sign[:,np.newaxis]
+        rotations = np.einsum('kji,klj->kil', Vt, U)
+
+        poses = np.zeros((len(locations), 5))
+        poses[:,:2] = (center_of_mass - self.reference.center_of_mass)[:,:2]
+        poses[:,2:] = Rotation.from_matrix(rotations).as_euler('xyz', degrees=True)
+        return poses
+
+    def distribute(self, locations: npt.NDArray, net_force: npt.NDArray, net_moment: npt.NDArray):
+        """
+        Smallest nodal forces with a given net force and moment
+
+        The forces are F/n + c x r, with r relative to the centroid of the
+        nodes, and c solved to match the moment around the center of mass.
+
+        Parameters
+        ----------
+        locations : npt.NDArray
+            K x n_particles x 3 array of node locations
+        net_force : npt.NDArray
+            K x 3 array of net forces
+        net_moment : npt.NDArray
+            K x 3 array of net moments around the center of mass
+
+        Returns
+        -------
+        forces : npt.NDArray
+            K x n_particles x 3 array of nodal forces
+        """
+        n = locations.shape[1]
+        centroid = np.mean(locations, axis=1)
+        center_of_mass = np.einsum('n,kni->ki', self.masses, locations)/np.sum(self.masses)
+        r = locations - centroid[:,np.newaxis]
+
+        inertia = (np.einsum('kni,kni->k', r, r)[:,np.newaxis,np.newaxis]*np.identity(3)
+                   - np.einsum('kni,knj->kij', r, r))
+        moment = net_moment - np.cross(centroid - center_of_mass, net_force)
+        c = np.linalg.solve(inertia, moment[...,np.newaxis])[...,0]
+        return net_force[:,np.newaxis]/n + np.cross(c[:,np.newaxis], r)
+
+    def current_locations(self, cache = None):
+        """Node locations of cache, or of the ParticleSystem if cache is None"""
+        if cache is not None:
+            return np.asarray(cache.locations)
+        locations, _ = self.ParticleSystem.x_v_current_3D
+        return locations
+
+    def force_value(self, cache = None):
+        """
+        Nodal forces reproducing the interpolated net force and moment of the current pose
+
+        Parameters
+        ----------
+        cache : GeometryCache, optional
+            geometry to evaluate, e.g. a GeometrySnapshot of a RigidBody. The
+            default is None, using the ParticleSystem.
+
+        Returns
+        -------
+        forces : npt.NDArray
+            n_particles x 3 array of forces
+        """
+        return self.force_value_batch(self.current_locations(cache)[np.newaxis])[0]
+
+    def force_value_batch(self, locations, area_vectors = None, rotations = None):
+        """
+        Batched version of force_value, same signature as OpticalForceCalculator.force_value_batch
+
+        The area vectors and crystal rotations are unused, both follow from
+        the pose.
+        """
+        locations = np.asarray(locations, dtype=np.float64)
+        return self.distribute(locations, *self.pose_loads(self.find_poses(locations)))
+
+    def calculate_restoring_forces(self, forces = None, cache = None):
+        """
+        Interpolated net force and moment of the current pose
+
+        Parameters
+        ----------
+        forces : npt.NDArray, optional
+            Unused, kept for a call signature identical to OpticalForceCalculator.
+        cache : GeometryCache, optional
+            geometry to evaluate. The default is None, using the ParticleSystem.
+
+        Returns
+        -------
+        net_force : npt.NDArray
+        net_moment : npt.NDArray
+        """
+        net_force, net_moment = self.pose_loads(self.find_poses(self.current_locations(cache)[np.newaxis]))
+        return net_force[0], net_moment[0]
+
+    def estimate_error(self, n_samples: int = 100, seed: int = 0) -> dict:
+        """
+        Compares the surrogate with the full model at random poses within the grid
+
+        Parameters
+        ----------
+        n_samples : int, optional
+            number of random poses. The default is 100.
+        seed : int, optional
+            seed of the random poses. The default is 0.
+
+        Returns
+        -------
+        errors : dict
+            root mean square error of the net 'force' and 'moment', relative
+            to the root mean square of the full model
+        """
+        rng = np.random.default_rng(seed)
+        poses = rng.uniform(-1, 1, (n_samples, 5))*self.ranges
+
+        net_force, net_moment = self.sample(poses)
+        surrogate_force, surrogate_moment = self.pose_loads(poses)
+
+        errors = {}
+        for key, reference, value in [('force', net_force, surrogate_force),
+                                      ('moment', net_moment, surrogate_moment)]:
+            scale = np.sqrt(np.mean(np.sum(reference**2, axis=1)))
+            errors[key] = np.sqrt(np.mean(np.sum((value-reference)**2, axis=1)))/(scale if scale > 0 else 1)
+        logging.info(f'Pose surrogate error: {errors}')
+        return errors
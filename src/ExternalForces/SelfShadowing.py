@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Bounding volume hierarchy over the surface triangles, used to find nodes that
+are shadowed by other parts of the sail
+"""
+import numpy as np
+import numpy.typing as npt
+
+
+class TriangleBVH:
+    """
+    Bounding volume hierarchy of axis aligned boxes over a triangulated surface
+
+    The hierarchy is built once from the simplices of
+    ParticleSystem.find_surface. As the mesh deforms only the boxes are
+    updated with refit(), the tree structure is kept. Rays are traversed
+    breadth first for all rays at once, so the number of python iterations
+    equals the depth of the tree.
+
+    Nodes are stored as flat arrays in depth first order, so children always
+    have a larger index than their parent:
+
+    left, right : npt.NDArray
+        indices of the child nodes, -1 for leaves
+    start, end : npt.NDArray
+        range of self.triangles covered by the node
+    depth : npt.NDArray
+        depth of the node in the tree
+    box_min, box_max : npt.NDArray
+        n_nodes x 3 corners of the bounding boxes
+    """
+    def __init__(self,
+                 simplices: npt.ArrayLike,
+                 points: npt.ArrayLike,
+                 leaf_size: int = 4):
+        """
+        Parameters
+        ----------
+        simplices : npt.ArrayLike
+            n_triangles x 3 array of node indices
+        points : npt.ArrayLike
+            n_particles x 3 array of node locations
+        leaf_size : int, optional
+            maximum number of triangles in a leaf. The default is 4.
+        """
+        self.simplices = np.asarray(simplices)
+        self.leaf_size = leaf_size
+        self.__build(np.asarray(points, dtype=np.float64))
+        self.refit(points)
+
+    def __build(self, points):
+        """Splits the triangles at the median of the centroids along the longest axis"""
+        centroids = points[self.simplices].mean(axis=1)
+        order = np.arange(len(self.simplices))
+        left, right, start, end, depth = [], [], [], [], []
+
+        def add_node(node_start, node_end, node_depth):
+            index = len(left)
+            left.append(-1)
+            right.append(-1)
+            start.append(node_start)
+            end.append(node_end)
+            depth.append(node_depth)
+            if node_end - node_start <= self.leaf_size:
+                return index
+
+            selection = order[node_start:node_end]
+            axis = np.argmax(np.ptp(centroids[selection], axis=0))
+            order[node_start:node_end] = selection[np.argsort(centroids[selection, axis], kind='stable')]
+            middle = (node_start + node_end)//2
+            left[index] = add_node(node_start, middle, node_depth+1)
+            right[index] = add_node(middle, node_end, node_depth+1)
+            return index
+
+        add_node(0, len(order), 0)
+
+        # Triangles are stored in leaf order, so each node covers a contiguous range
+        self.triangles = self.simplices[order]
+        self.left = np.array(left)
+        self.right = np.array(right)
+        self.start = np.array(start)
+        self.end = np.array(end)
+        self.depth = np.array(depth)
+        self.leaf = self.left == -1
+
+        leaves = np.flatnonzero(self.leaf)
+        self.__leaves = leaves[np.argsort(self.start[leaves])]
+        self.__levels = [np.flatnonzero(~self.leaf & (self.depth == d))
+                         for d in range(self.depth.max()-1, -1, -1)]
+
+    def refit(self, points: npt.ArrayLike):
+        """
+        Updates the bounding boxes to the current node locations
+
+        Parameters
+        ----------
+        points : npt.ArrayLike
+            n_particles x 3 array of node locations
+        """
+        self.triangle_points = np.asarray(points, dtype=np.float64)[self.triangles]
+        triangle_min = self.triangle_points.min(axis=1)
+        triangle_max = self.triangle_points.max(axis=1)
+
+        self.box_min = np.empty((len(self.left), 3))
+        self.box_max = np.empty((len(self.left), 3))
+        leaf_starts = self.start[self.__leaves]
+        self.box_min[self.__leaves] = np.minimum.reduceat(triangle_min, leaf_starts)
+        self.box_max[self.__leaves] = np.maximum.reduceat(triangle_max, leaf_starts)
+
+        # Bottom up, one level of the tree at a time
+        for nodes in self.__levels:
+            self.box_min[nodes] = np.minimum(self.box_min[self.left[nodes]],
+                                             self.box_min[self.right[nodes]])
+            self.box_max[nodes] = np.maximum(self.box_max[self.left[nodes]],
+                                             self.box_max[self.right[nodes]])
+
+    def intersect(self,
+                  origins: npt.ArrayLike,
+                  direction: npt.ArrayLike,
+                  exclude: npt.ArrayLike = None,
+                  epsilon: float = 1e-9) -> npt.NDArray:
+        """
+        Finds which rays hit any of the triangles
+
+        Parameters
+        ----------
+        origins : npt.ArrayLike
+            n_rays x 3 array of ray origins
+        direction : npt.ArrayLike
+            direction of all rays, length 3
+        exclude : npt.ArrayLike, optional
+            node index per ray. Triangles containing that node are ignored,
+            which prevents rays starting on the surface from hitting the
+            triangles around their origin. The default is None.
+        epsilon : float, optional
+            Hits closer to the origin than this distance are ignored. [m]
+            The default is 1e-9.
+
+        Returns
+        -------
+        hit : npt.NDArray
+            boolean array of length n_rays
+        """
+        origins = np.asarray(origins, dtype=np.float64)
+        direction = np.asarray(direction, dtype=np.float64)
+        direction = direction/np.linalg.norm(direction)
+        hit = np.zeros(len(origins), dtype=bool)
+
+        # Large but finite inverse avoids 0*inf for axis aligned rays
+        inverse_direction = 1/np.where(direction == 0, 1e-300, direction)
+
+        rays = np.arange(len(origins))
+        nodes = np.zeros(len(origins), dtype=int)
+        while len(rays):
+            # Slab test of the rays against the boxes of their nodes. The boxes
+            # are padded by epsilon, so rays grazing an edge of a triangle on
+            # the boundary of a box are still passed on to the triangle test.
+            lower = (self.box_min[nodes] - epsilon - origins[rays])*inverse_direction
+            upper = (self.box_max[nodes] + epsilon - origins[rays])*inverse_direction
+            t_near = np.minimum(lower, upper).max(axis=1)
+            t_far = np.maximum(lower, upper).min(axis=1)
+            keep = (t_far >= np.maximum(t_near, 0)) & ~hit[rays]
+            rays, nodes = rays[keep], nodes[keep]
+
+            leaf = self.leaf[nodes]
+            if np.any(leaf):
+                leaf_rays, leaf_nodes = rays[leaf], nodes[leaf]
+                counts = self.end[leaf_nodes] - self.start[leaf_nodes]
+                triangle_rays = np.repeat(leaf_rays, counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                triangles = np.repeat(self.start[leaf_nodes], counts) + offsets
+
+                if exclude is not None:
+                    own = np.any(self.triangles[triangles] == np.asarray(exclude)[triangle_rays, None],
+                                 axis=1)
+                    triangle_rays, triangles = triangle_rays[~own], triangles[~own]
+
+                triangle_hit = self.__ray_triangle(origins[triangle_rays], direction,
+                                                   self.triangle_points[triangles], epsilon)
+                hit[triangle_rays[triangle_hit]] = True
+
+            internal = ~leaf
+            rays = np.concatenate((rays[internal], rays[internal]))
+            nodes = np.concatenate((self.left[nodes[internal]], self.right[nodes[internal]]))
+
+        return hit
+
+    @staticmethod
+    def __ray_triangle(origins, direction, triangle_points, epsilon):
+        """Vectorised Moller-Trumbore intersection test"""
+        edge_1 = triangle_points[:,1] - triangle_points[:,0]
+        edge_2 = triangle_points[:,2] - triangle_points[:,0]
+        p = np.cross(direction, edge_2)
+        determinant = np.einsum('ij,ij->i', edge_1, p)
+        parallel = np.abs(determinant) < 1e-300
+        inverse_determinant = 1/np.where(parallel, 1, determinant)
+
+        s = origins - triangle_points[:,0]
+        u = np.einsum('ij,ij->i', s, p)*inverse_determinant
+        q = np.cross(s, edge_1)
+        v = q.dot(direction)*inverse_determinant
+        t = np.einsum('ij,ij->i', edge_2, q)*inverse_determinant
+
+        return ~parallel & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > epsilon)
@@ -1,2 +1,4 @@
 from .LaserBeam import LaserBeam
-from .OpticalForceCalculator import OpticalForceCalculator
\ No newline at end of file
+from .OpticalForceCalculator import OpticalForceCalculator
+from .MultiBeamForceCalculator import MultiBeamForceCalculator
+from .PoseSurrogate import PoseSurrogate
@@ -1,3 +1,5 @@
 from .interpolators import linear_interpolator
 from .interpolators import create_interpolator_specular
 from .interpolators import create_interpolator
+from .interpolators import spline_interpolator
+from .interpolators import create_spline_interpolator
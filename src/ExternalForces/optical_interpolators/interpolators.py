@@ -13,11 +13,13 @@ import numpy as np
 import numpy.typing as npt
 from scipy.interpolate import LinearNDInterpolator, RegularGridInterpolator
 from scipy.interpolate import griddata
+from scipy.interpolate import make_interp_spline, BSpline
 from scipy.spatial import KDTree
 import matplotlib.pyplot as plt
 
 from src.particleSystem.ParticleSystem import ParticleSystem
 from src.ExternalForces.OpticalForceCalculator import wrap_spherical_coordinates
+from src.ExternalForces.OpticalForceCalculator import cartesian_outgoing_vectors, rotate_outgoing_vectors
 
 # Setup path for abs. file imports
 my_path = os.path.abspath(os.path.dirname(__file__))
@@ -76,6 +78,48 @@ def create_interpolator(fname: str, rotation:float = 0)-> Callable:
         Interpolator for optical behaviour.
 
     """
+    incidence, out = load_crystal_data(fname)
+    return linear_interpolator(incidence,out,rotation, name=fname)
+
+def create_spline_interpolator(fname: str, rotation:float = 0, degree: int = 3)-> Callable:
+    """
+    create smooth spline fit of simulation data
+
+    Parameters
+    ----------
+    fname : string
+        Path to the data.
+    rotation : float
+        Rotation around z+ axis of photonic crystal. Allows to represent crystal in different
+        oriantations. [rad]
+    degree : int
+        Degree of the spline along each axis. Lowered automatically for axes with few samples.
+
+    Returns
+    -------
+    Callable
+        Interpolator for optical behaviour, with analytic gradients.
+
+    """
+    incidence, out = load_crystal_data(fname)
+    return spline_interpolator(incidence, out, rotation, degree, name=fname)
+
+def load_crystal_data(fname: str):
+    """
+    loads simulation data of a crystal, duplicating phi = 0 to phi = 2 pi
+
+    Parameters
+    ----------
+    fname : string
+        Path to the data.
+
+    Returns
+    -------
+    incidence : npt.NDArray
+        n x 3 array of [theta, phi, pol]
+    out : npt.NDArray
+        n x 3 array of [theta_out, phi_out, mag]
+    """
     path = os.path.join(my_path, fname)
     data = np.loadtxt(path, delimiter = ',',comments='#')
     incidence = data[:,:3]
@@ -90,12 +134,15 @@ def create_interpolator(fname: str, rotation:float = 0)-> Callable:
         incidence = np.vstack((incidence,in_dupes))
         out = np.vstack((out,out_dupes))
 
-    return linear_interpolator(incidence,out,rotation, name=fname)
+    return incidence, out
 
 class linear_interpolator():
     """
     maps [theta, phi, pol] to [theta, phi, mag]
 
+    Queries outside of the convex hull of the samples get the value of the
+    nearest sample. They are counted in out_of_range_count.
+
     cache_values : bool
         enables lru caching for call function.  Note, you only want to use caching if you are
         feeding coordinate tuples. Breaks when numpy arrays are fed in!
@@ -106,7 +153,9 @@ class linear_interpolator():
         self.values = values
         self.tree = KDTree(coordinates)
         self.rotation = rotation
+        self.name = name
         self.interp = LinearNDInterpolator(coordinates, values)
+        self.out_of_range_count = 0
 
         if self.cache_values:
             self.__call__ =  lru_cache(maxsize=None)(self.__call__)
@@ -124,13 +173,9 @@ class linear_interpolator():
             coordinates[:,2] = np.arctan(y/x)
 
             v = self.interp(coordinates)
+            v = self.fill_out_of_range(coordinates, v, self.values)
             v[:,1]+=self.rotation
             v[:,1]%=2*np.pi
-            if np.any(np.isnan(v)):
-                for i, line in enumerate(v):
-                    if np.any(np.isnan(line)):
-                        logging.warning("Interpolation error resulting in nan values for input "+str(coordinates[i,:]))
-            v = np.nan_to_num(v)
 
         else:
             coordinates[1]%=2*np.pi
@@ -139,13 +184,93 @@ class linear_interpolator():
             y = abs(np.sin(pol))
             coordinates[2] = np.arctan(y/x)
 
-            v = self.interp(coordinates)[0]
+            v = self.interp(coordinates)
+            v = self.fill_out_of_range(np.atleast_2d(coordinates), v, self.values)[0]
             v[1]+=self.rotation
             v[1]%=2*np.pi
-            if any(np.isnan(v)):
-                logging.warning("Interpolation error resulting in nan values for input "+str(coordinates))
         return v
 
+    def fill_out_of_range(self, coordinates, v, values):
+        """
+        replaces interpolation results outside of the convex hull with the nearest sample
+
+        Parameters
+        ----------
+        coordinates : npt.NDArray
+            n x 3 array of conditioned [theta, phi, pol] queries
+        v : npt.NDArray
+            interpolation results, NaN rows are outside of the convex hull
+        values : npt.NDArray
+            sampled values in the same order as self.coordinates
+
+        Returns
+        -------
+        v : npt.NDArray
+            interpolation results without NaN rows
+        """
+        out_of_range = np.isnan(v).any(axis=1)
+        n_out_of_range = np.count_nonzero(out_of_range)
+        if n_out_of_range:
+            _, nearest = self.tree.query(coordinates[out_of_range])
+            v[out_of_range] = values[nearest]
+
+            # Only the first occurence is a warning, the counter keeps track of the rest
+            log = logging.debug if self.out_of_range_count else logging.warning
+            self.out_of_range_count += n_out_of_range
+            log(f"{n_out_of_range} queries outside of the range of {self.name}, filled from nearest"
+                f" samples. Total: {self.out_of_range_count}")
+        return v
+
+    def outgoing_vectors(self, coordinates):
+        """
+        maps [theta, phi, pol] to the outgoing ray as Cartesian vectors
+
+        The Cartesian table is computed once from the spherical values. If the
+        samples form a full regular grid it is interpolated trilinearly,
+        otherwise the triangulation of self.interp is reused.
+
+        Parameters
+        ----------
+        coordinates : npt.NDArray
+            n x 3 array of [theta, phi, pol] [rad]
+
+        Returns
+        -------
+        vectors : npt.NDArray
+            n x 6 array of [r, r_perp], see cartesian_outgoing_vectors
+        """
+        if not hasattr(self, 'cartesian_interp'):
+            self.cartesian_interp = self.create_cartesian_interpolator()
+
+        coordinates = coordinates-np.array([0,self.rotation,self.rotation])
+        coordinates = np.round(coordinates, 8)
+        coordinates[:,1]%=2*np.pi
+        pol = coordinates[:,2]
+        x = np.abs(np.cos(pol))
+        y = np.abs(np.sin(pol))
+        coordinates[:,2] = np.arctan(y/x)
+
+        v = self.cartesian_interp(coordinates)
+        v = self.fill_out_of_range(coordinates, v, self.cartesian_values)
+
+        return rotate_outgoing_vectors(v, self.rotation)
+
+    def create_cartesian_interpolator(self) -> Callable:
+        """creates the interpolator of the outgoing rays as Cartesian vectors"""
+        values = cartesian_outgoing_vectors(self.values)
+        self.cartesian_values = values
+        coordinates = np.round(self.coordinates, 8)
+        axes = [np.unique(coordinates[:,i]) for i in range(3)]
+        shape = tuple(len(axis) for axis in axes)
+
+        if np.prod(shape) != len(np.unique(coordinates, axis=0)):
+            return LinearNDInterpolator(self.interp.tri, values)
+
+        grid = np.zeros(shape + (6,))
+        indices = tuple(np.searchsorted(axes[i], coordinates[:,i]) for i in range(3))
+        grid[indices] = values
+        return RegularGridInterpolator(axes, grid, bounds_error = False, fill_value = np.nan)
+
     def old__call__(self, coordinates):
         coordinates = coordinates.copy()-np.array([0,self.rotation,self.rotation])
         coordinates[1]%=2*np.pi
@@ -172,6 +297,150 @@ class linear_interpolator():
 
 
 
+class spline_interpolator():
+    """
+    maps [theta, phi, pol] to [theta, phi, mag] with a smooth tensor-product spline
+
+    The outgoing rays are fitted as Cartesian vectors (see cartesian_outgoing_vectors),
+    as these are continuous where the angles wrap. The fit is periodic in phi
+    and interpolates the samples exactly. Unlike linear_interpolator it has
+    continuous derivatives, available through outgoing_vectors_gradient.
+    Requires the samples to form a full regular grid in [theta, phi, pol].
+    """
+    def __init__(self, coordinates, values, rotation, degree = 3, name = None):
+        self.coordinates = coordinates
+        self.values = values
+        self.rotation = rotation
+        self.name = name
+
+        coordinates = np.round(coordinates, 8)
+        axes = [np.unique(coordinates[:,i]) for i in range(3)]
+        shape = tuple(len(axis) for axis in axes)
+        if np.prod(shape) != len(np.unique(coordinates, axis=0)):
+            raise AttributeError(f"Samples of {name} do not form a full regular grid,"
+                                 " use linear_interpolator instead")
+
+        grid = np.zeros(shape + (6,))
+        indices = tuple(np.searchsorted(axes[i], coordinates[:,i]) for i in range(3))
+        grid[indices] = cartesian_outgoing_vectors(values)
+        grid[:,-1] = grid[:,0] # phi = 2 pi is identical to phi = 0
+
+        # Fit one axis at a time, the coefficients of the previous axis are
+        # the samples of the next
+        self.bounds = [(axis[0], axis[-1]) for axis in axes]
+        self.knots = []
+        coefficients = grid
+        for i, axis in enumerate(axes):
+            k = min(degree, len(axis)-1)
+            bc_type = 'periodic' if i == 1 else None
+            spline = make_interp_spline(axis, np.moveaxis(coefficients, i, 0), k = k, bc_type = bc_type)
+            coefficients = np.moveaxis(spline.c, 0, i)
+            self.knots.append((spline.t, k))
+        self.coefficients = coefficients
+
+    def __call__(self, coordinates):
+        vectors = self.outgoing_vectors(np.atleast_2d(coordinates))[:,:3]
+        magnitude = np.linalg.norm(vectors, axis=1)
+        theta = np.arccos(np.divide(vectors[:,2], magnitude,
+                                    out = np.ones(magnitude.shape), where = magnitude>0))
+        phi = np.arctan2(vectors[:,1], vectors[:,0]) % (2*np.pi)
+        v = np.column_stack((theta, phi, magnitude))
+        if np.ndim(coordinates) == 1:
+            return v[0]
+        return v
+
+    def __condition(self, coordinates):
+        # Same conditioning as linear_interpolator, theta and pol are clamped to the samples
+        coordinates = np.array(coordinates, dtype=float)-np.array([0,self.rotation,self.rotation])
+        pol = coordinates[:,2]
+        pol_sign = np.sign(np.sin(2*pol))
+        coordinates[:,1] %= 2*np.pi
+        coordinates[:,2] = np.arctan2(np.abs(np.sin(pol)), np.abs(np.cos(pol)))
+
+        inside = np.ones(coordinates.shape)
+        for i in [0,2]:
+            lower, upper = self.bounds[i]
+            inside[:,i] = (coordinates[:,i] >= lower) & (coordinates[:,i] <= upper)
+            coordinates[:,i] = np.clip(coordinates[:,i], lower, upper)
+        inside[:,2] *= pol_sign
+        return coordinates, inside
+
+    def __basis(self, axis, x, nu = 0):
+        # Returns the k+1 nonzero basis functions and the index of the first one
+        t, k = self.knots[axis]
+        n_coefficients = len(t) - k - 1
+        extrapolate = 'periodic' if axis == 1 else True
+        basis = BSpline(t, np.identity(n_coefficients), k, extrapolate = extrapolate)(x, nu)
+        if axis == 1:
+            x = t[k] + (x - t[k]) % (t[n_coefficients] - t[k])
+        span = np.clip(np.searchsorted(t, x, side = 'right') - 1, k, n_coefficients - 1)
+        start = span - k
+        window = start[:,np.newaxis] + np.arange(k+1)
+        return np.take_along_axis(basis, window, axis=1), start
+
+    def __evaluate(self, coordinates, derivatives):
+        bases = [self.__basis(i, coordinates[:,i], nu) for i, nu in enumerate(derivatives)]
+        (b0, s0), (b1, s1), (b2, s2) = bases
+        window = [np.arange(b.shape[1]) for b in (b0, b1, b2)]
+        local = self.coefficients[(s0[:,None,None,None] + window[0][:,None,None],
+                                   s1[:,None,None,None] + window[1][:,None],
+                                   s2[:,None,None,None] + window[2])]
+        return np.einsum('ma,mb,mc,mabcd->md', b0, b1, b2, local)
+
+    def outgoing_vectors(self, coordinates, chunk_size = 10000):
+        """
+        maps [theta, phi, pol] to the outgoing ray as Cartesian vectors
+
+        Parameters
+        ----------
+        coordinates : npt.NDArray
+            n x 3 array of [theta, phi, pol] [rad]
+        chunk_size : int
+            number of coordinates evaluated at once, limits memory usage
+
+        Returns
+        -------
+        vectors : npt.NDArray
+            n x 6 array of [r, r_perp], see cartesian_outgoing_vectors
+        """
+        coordinates, _ = self.__condition(coordinates)
+        v = np.zeros((len(coordinates), 6))
+        for start in range(0, len(coordinates), chunk_size):
+            chunk = slice(start, start+chunk_size)
+            v[chunk] = self.__evaluate(coordinates[chunk], (0,0,0))
+        return rotate_outgoing_vectors(v, self.rotation)
+
+    def outgoing_vectors_gradient(self, coordinates, chunk_size = 10000):
+        """
+        derivative of outgoing_vectors w.r.t. [theta, phi, pol]
+
+        Outside of the sampled range of theta the fit is clamped, so the
+        derivative w.r.t. theta is zero there.
+
+        Parameters
+        ----------
+        coordinates : npt.NDArray
+            n x 3 array of [theta, phi, pol] [rad]
+        chunk_size : int
+            number of coordinates evaluated at once, limits memory usage
+
+        Returns
+        -------
+        gradient : npt.NDArray
+            n x 6 x 3 array, where [i, j, l] holds d vector_j / d coordinate_l
+        """
+        coordinates, inside = self.__condition(coordinates)
+        gradient = np.zeros((len(coordinates), 6, 3))
+        for start in range(0, len(coordinates), chunk_size):
+            chunk = slice(start, start+chunk_size)
+            for l, derivatives in enumerate([(1,0,0), (0,1,0), (0,0,1)]):
+                gradient[chunk,:,l] = self.__evaluate(coordinates[chunk], derivatives)
+        gradient *= inside[:,np.newaxis,:]
+        for l in range(3):
+            gradient[:,:,l] = rotate_outgoing_vectors(gradient[:,:,l], self.rotation)
+        return gradient
+
+
 def check_interpolator(interp, coordinates, ax = None):
     theta, phi, pol = coordinates
     theta_out, phi_out, pol_out = wrap_spherical_coordinates(*[np.array(i,dtype=float) for i in coordinates])
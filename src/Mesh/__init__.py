@@ -4,4 +4,5 @@ from .mesh_functions import mesh_square_cross_sparse
 from .mesh_functions import mesh_airbag_square_cross
 from .mesh_functions import mesh_square_concentric
 from .mesh_functions import mesh_circle_square_cross
-from .mesh_functions import mesh_round_phc_square_cross
\ No newline at end of file
+from .mesh_functions import mesh_round_phc_square_cross
+from .mesh_functions import grid_triangles
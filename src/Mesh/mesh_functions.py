@@ -20,7 +20,54 @@ params = {
     }
 
 
-def mesh_square(length, width, mesh_edge_length, params = params):
+def grid_triangles(n_long, n_wide, mask = None, renumber = False):
+    """
+    Triangulates a grid of nodes numbered row by row, index = row*n_long + column
+
+    Every grid cell is split into two triangles with counterclockwise vertex
+    order, so the area vectors from ParticleSystem.find_surface point in +z
+    for an undisplaced mesh.
+
+    Parameters
+    ----------
+    n_long : int
+        number of nodes per row
+    n_wide : int
+        number of rows
+    mask : npt.ArrayLike, optional
+        boolean per grid node. Cells with one corner outside the mask are
+        covered by the triangle of the other three, so the nodes on the
+        tips of a trimmed grid get an area as well; cells with more corners
+        outside are skipped. The default is None, which keeps all cells.
+    renumber : bool, optional
+        Numbers the nodes of the mask consecutively, for meshes that only
+        contain the nodes inside the mask. The default is False.
+
+    Returns
+    -------
+    triangles : npt.NDArray
+        n_triangles x 3 array of node indices
+    """
+    corners = np.arange(n_long*n_wide).reshape((n_wide, n_long))[:-1,:-1].ravel()
+    cells = np.column_stack((corners, corners+1, corners+n_long+1, corners+n_long))
+
+    corner_triangles = np.zeros((0, 3), dtype=cells.dtype)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        inside = mask[cells]
+        # Dropping the outside corner keeps the counterclockwise order
+        partial = np.sum(inside, axis=1) == 3
+        corner_triangles = cells[partial][inside[partial]].reshape((-1, 3))
+        cells = cells[np.all(inside, axis=1)]
+        if renumber:
+            cells = (np.cumsum(mask)-1)[cells]
+            corner_triangles = (np.cumsum(mask)-1)[corner_triangles]
+
+    return np.vstack((cells[:,[0,1,2]], cells[:,[0,2,3]], corner_triangles))
+
+
+
+def mesh_square(length, width, mesh_edge_length, params = params, return_triangles = False):
     n_wide = int(width/ mesh_edge_length + 1)
     n_long = int(length/ mesh_edge_length + 1)
 
@@ -45,10 +92,12 @@ def mesh_square(length, width, mesh_edge_length, params = params):
         if (i+1)%(n_long): # Using modulus operator to exclude the nodes at the end of a row
             connections.append([i, i+1, params['k'], params['c']])
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_wide)
     return connections, initial_conditions
 
 
-def mesh_square_cross(length, width, mesh_edge_length, params = params):
+def mesh_square_cross(length, width, mesh_edge_length, params = params, return_triangles = False):
     n_wide = int(width/ mesh_edge_length + 1)
     n_long = int(length/ mesh_edge_length + 1)
 
@@ -76,9 +125,11 @@ def mesh_square_cross(length, width, mesh_edge_length, params = params):
         if (i+1)%(n_long): # Using modulus operator to exclude the nodes at the end of a row
             connections.append([i, i+1, params['k'], params['c']])
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_wide)
     return connections, initial_conditions
 
-def mesh_square_cross_sparse(length, width, mesh_edge_length, params = params):
+def mesh_square_cross_sparse(length, width, mesh_edge_length, params = params, return_triangles = False):
     n_wide = int(width/ mesh_edge_length + 1)
     n_long = int(length/ mesh_edge_length + 1)
 
@@ -114,9 +165,11 @@ def mesh_square_cross_sparse(length, width, mesh_edge_length, params = params):
         if (i+1)%(n_long): # Using modulus operator to exclude the nodes at the end of a row
             connections.append([i, i+1, params['k'], params['c']])
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_wide)
     return connections, initial_conditions
 
-def mesh_square_concentric(length, mesh_edge_length, params = params ,fix_outer = False):
+def mesh_square_concentric(length, mesh_edge_length, params = params ,fix_outer = False, return_triangles = False):
     n_long = int(length/ mesh_edge_length + 1)
 
     x_space = np.linspace(-length/2, length/2, n_long)
@@ -159,9 +212,11 @@ def mesh_square_concentric(length, mesh_edge_length, params = params ,fix_outer
         elif (i+1)%(n_long) and abs(node[0][0])<abs(node[0][1]) and node[0][0]>=0: # Using modulus operator to exclude the nodes at the end of a row
             connections.append([i, i+1, params['k'], params['c']])
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_long)
     return connections, initial_conditions
 
-def mesh_airbag_square_cross(length, width= 0, mesh_edge_length = 1/10,  params = params, noncompressive = False, sparse = False):
+def mesh_airbag_square_cross(length, width= 0, mesh_edge_length = 1/10,  params = params, noncompressive = False, sparse = False, return_triangles = False):
 
     if sparse:
         meshfunct = mesh_square_cross_sparse
@@ -171,10 +226,12 @@ def mesh_airbag_square_cross(length, width= 0, mesh_edge_length = 1/10,  params
     if width==0:
         width = length
 
-    initial_conditions, connections = meshfunct(length,
-                                                width,
-                                                mesh_edge_length,
-                                                params)
+    mesh = meshfunct(length,
+                     width,
+                     mesh_edge_length,
+                     params,
+                     return_triangles = return_triangles)
+    initial_conditions, connections = mesh[:2]
 
     # We iterate over the particle and set specific constraint conditions
     # to match the symmetry of the airbag being cut into 8 pieces
@@ -224,6 +281,8 @@ def mesh_airbag_square_cross(length, width= 0, mesh_edge_length = 1/10,  params
         for link in connections:
             link.append(linktype)
 
+    if return_triangles:
+        return connections, initial_conditions, mesh[2]
     return connections, initial_conditions
 
 def mesh_phc_square_cross(length, 
@@ -233,7 +292,8 @@ def mesh_phc_square_cross(length,
                             noncompressive = False, 
                             sparse = False,
                             fix_outer = True,
-                            center_lightsail = True):
+                            center_lightsail = True,
+                            return_triangles = False):
     required = ['E_x', 'E_y', "G", "thickness"]
 
     for key in required:
@@ -301,10 +361,12 @@ def mesh_phc_square_cross(length,
         for p in initial_conditions:
             p[0] -= offset
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_wide)
     return connections, initial_conditions
 
 
-def mesh_circle_square_cross(radius, mesh_edge_length, params = params, fix_outer = False, edge = 0):
+def mesh_circle_square_cross(radius, mesh_edge_length, params = params, fix_outer = False, edge = 0, return_triangles = False):
     n_wide = int(radius/ mesh_edge_length + 1)
     n_long = n_wide
 
@@ -368,9 +430,11 @@ def mesh_circle_square_cross(radius, mesh_edge_length, params = params, fix_oute
             if not freeit:
                 initial_conditions[i][3]= True
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_wide, mask)
     return connections, initial_conditions
 
-def mesh_round_phc_square_cross(radius, mesh_edge_length=1/10, params=None, noncompressive=False, sparse=False, fix_outer=True, edge=0):
+def mesh_round_phc_square_cross(radius, mesh_edge_length=1/10, params=None, noncompressive=False, sparse=False, fix_outer=True, edge=0, return_triangles=False):
     if params is None:
         params = {}
     required = ['E_x', 'E_y', "G", "thickness", "m_segment", "c"]
@@ -429,12 +493,17 @@ def mesh_round_phc_square_cross(radius, mesh_edge_length=1/10, params=None, nonc
             if np.linalg.norm(cond[0][:2]) >= radius - edge:
                 initial_conditions[i][3] = True  # Mark as fixed/non-movable
 
+    if return_triangles:
+        return connections, initial_conditions, grid_triangles(n_long, n_wide, mask, renumber = True)
     return connections, initial_conditions
 
 
-def mesh_rotate_and_trim(initial_conditions, connections, angle):
+def mesh_rotate_and_trim(initial_conditions, connections, angle, triangles = None):
     """
     NOTE: Input mesh is expected to be square!
+
+    If triangles are passed, the triangles with a trimmed node are removed
+    and returned as the third output.
     """
     center_of_mass = np.array([0,0,0],dtype ='float64')
     for particle in initial_conditions:
@@ -475,6 +544,11 @@ def mesh_rotate_and_trim(initial_conditions, connections, angle):
     for i in dumplist[::-1]:
         del connections[i]
 
+    if triangles is not None:
+        xyz = np.array([particle[0] for particle in initial_conditions])
+        inside = (np.abs(xyz[:,0]) <= x_range/2) & (np.abs(xyz[:,1]) <= y_range/2)
+        triangles = np.asarray(triangles)
+        return connections, initial_conditions, triangles[np.all(inside[triangles], axis=1)]
     return connections, initial_conditions
 
 
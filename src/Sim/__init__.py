@@ -3,4 +3,7 @@ from .simulations import Simulate_1d_Stretch
 from .simulations import Simulate_1d_Shear
 from .simulations import Simulate_airbag
 from .simulations import SimulateTripleChainWithMass
-from .simulations import Simulate_Lightsail
\ No newline at end of file
+from .simulations import Simulate_Lightsail
+from .rigid_body import RigidBody, RigidEnsemble
+from .stability import LinearStability
+from .basin_mapping import BasinMap
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive mapping of the basin of stability in the plane of initial offsets
+
+The plane is covered by a quadtree whose vertices lie on a lattice of
+2**max_depth cells per side. Cells are refined only where their corners
+disagree on stability, and vertices related by a declared symmetry are
+classified once.
+"""
+import os
+import logging
+
+import numpy as np
+import numpy.typing as npt
+
+
+SYMMETRIES = {'mirror_x': lambda u, v: (-u, v),
+              'mirror_y': lambda u, v: (u, -v),
+              'diagonal': lambda u, v: (v, u),
+              'C2': lambda u, v: (-u, -v),
+              'C4': lambda u, v: (-v, u)}
+
+
+class BasinMap:
+    """
+    Resumable quadtree map of the stability of initial offsets
+
+    Cells are stored as rows [i, j, size] of integer lattice coordinates of
+    their lower left corner and their size, and the classified vertices as a
+    dict from the canonical lattice coordinates to their stability.
+    """
+    def __init__(self,
+                 classify,
+                 bounds: npt.ArrayLike,
+                 symmetry: list = (),
+                 max_depth: int = 6,
+                 initial_depth: int = 2,
+                 path: str = None):
+        """
+        Parameters
+        ----------
+        classify : Callable[[npt.NDArray], npt.NDArray]
+            maps a K x 2 array of points to a boolean array of length K, True
+            for stable. Every level of refinement is passed as one batch.
+        bounds : npt.ArrayLike
+            [[x_min, x_max], [y_min, y_max]] of the mapped region
+        symmetry : list, optional
+            names of the symmetries of the stability around the origin, out of
+            'mirror_x' (x to -x), 'mirror_y', 'diagonal' (x to y), 'C2' and
+            'C4'. The region must be symmetric under them. The default is ().
+        max_depth : int, optional
+            number of halvings of the region, the finest cells are
+            2**-max_depth of the region. The default is 6.
+        initial_depth : int, optional
+            depth up to which all cells are refined, which sets the smallest
+            feature that is reliably found. The default is 2.
+        path : str, optional
+            .npz file the map is saved to after every level, see load. The
+            default is None.
+        """
+        self.classify = classify
+        self.bounds = np.array(bounds, dtype=np.float64)
+        self.symmetry = list(symmetry)
+        self.max_depth = max_depth
+        self.initial_depth = min(initial_depth, max_depth)
+        self.path = path
+
+        unknown = [name for name in self.symmetry if name not in SYMMETRIES]
+        if unknown:
+            raise AttributeError(f"Unknown symmetries {unknown}, expected any of {list(SYMMETRIES)}")
+        self.n = 2**max_depth
+        corners = self.coordinates([[0, 0], [0, self.n], [self.n, 0], [self.n, self.n]])
+        for name in self.symmetry:
+            images = np.array(SYMMETRIES[name](*corners.T)).T
+            if not all(np.any(np.all(np.isclose(image, corners), axis=1)) for image in images):
+                raise AttributeError(f"Bounds {self.bounds.tolist()} are not symmetric "
+                                     f"under {name} around the origin")
+
+        self.values = {}
+        self.leaves = np.array([[0, 0, self.n]])
+        self.depth = 0
+        self.evaluations = 0
+
+    def __str__(self):
+        return (f"BasinMap at depth {self.depth}/{self.max_depth} with {len(self.leaves)} cells "
+                f"and {self.evaluations} classified points")
+
+    def orbit(self, vertex: tuple) -> set:
+        """All lattice vertices related to a vertex by the symmetries"""
+        vertex = tuple(int(index) for index in vertex)
+        orbit = {vertex}
+        front = [vertex]
+        while front:
+            i, j = front.pop()
+            for name in self.symmetry:
+                u, v = SYMMETRIES[name](2*i - self.n, 2*j - self.n)
+                image = ((u + self.n)//2, (v + self.n)//2)
+                if image not in orbit:
+                    orbit.add(image)
+                    front.append(image)
+        return orbit
+
+    def canonical(self, vertex: tuple) -> tuple:
+        """Representative of the orbit of a vertex under which it is stored"""
+        return min(self.orbit(vertex))
+
+    def coordinates(self, vertices: npt.ArrayLike) -> npt.NDArray:
+        """K x 2 points of lattice vertices"""
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        return self.bounds[:, 0] + vertices*np.ptp(self.bounds, axis=1)/self.n
+
+    def value(self, vertex: tuple) -> bool:
+        """Stability of a classified vertex"""
+        return self.values[self.canonical(vertex)]
+
+    def evaluate(self, vertices: npt.ArrayLike):
+        """Classifies the vertices whose orbit is not classified yet, as one batch"""
+        new = sorted({self.canonical(tuple(vertex)) for vertex in np.asarray(vertices).reshape(-1, 2)}
+                     - set(self.values))
+        if not new:
+            return
+        stable = np.asarray(self.classify(self.coordinates(new)), dtype=bool)
+        self.values.update(zip(new, stable.tolist()))
+        self.evaluations += len(new)
+        logging.info(f"BasinMap classified {len(new)} points, {int(np.sum(stable))} stable")
+
+    def corners(self, leaves: npt.NDArray) -> npt.NDArray:
+        """M x 4 x 2 lattice vertices of the corners of cells"""
+        offsets = np.array([[0, 0], [1, 0], [0, 1], [1, 1]])
+        return leaves[:, np.newaxis, :2] + offsets*leaves[:, np.newaxis, 2:]
+
+    def corner_values(self, leaves: npt.NDArray) -> npt.NDArray:
+        """M x 4 stability of the corners of cells"""
+        return np.array([[self.value(tuple(vertex)) for vertex in cell]
+                         for cell in self.corners(leaves)], dtype=bool).reshape(-1, 4)
+
+    def refine(self, levels: int = None):
+        """
+        Refines the map, level by level, up to max_depth
+
+        Parameters
+        ----------
+        levels : int, optional
+            maximum number of levels to refine in this call. The default is
+            None, which refines up to max_depth.
+        """
+        self.evaluate(self.corners(self.leaves))
+        target = self.max_depth if levels is None else min(self.depth + levels, self.max_depth)
+        while self.depth < target:
+            size = self.n//2**self.depth
+            current = self.leaves[:, 2] == size
+            split = current.copy()
+            if self.depth >= self.initial_depth:
+                values = self.corner_values(self.leaves[current])
+                split[current] = np.any(values != values[:, :1], axis=1)
+
+            half = size//2
+            parents = self.leaves[split]
+            children = np.concatenate([parents + [di*half, dj*half, -half]
+                                       for di in (0, 1) for dj in (0, 1)])
+            self.leaves = np.concatenate((self.leaves[~split], children))
+            self.evaluate(self.corners(children))
+            self.depth += 1
+            logging.info(f"{self}")
+            if self.path is not None:
+                self.save()
+
+    def boundary(self) -> npt.NDArray:
+        """Cells whose corners disagree on stability, as rows [i, j, size]"""
+        values = self.corner_values(self.leaves)
+        return self.leaves[np.any(values != values[:, :1], axis=1)]
+
+    def grid(self) -> npt.NDArray:
+        """
+        Stability on the full lattice
+
+        Cells with agreeing corners are filled with their value, and the
+        lattice points in other cells take the value of the nearest corner.
+
+        Returns
+        -------
+        stable : npt.NDArray
+            (n+1) x (n+1) boolean array indexed [j, i], i.e. y along the rows
+            as from np.meshgrid, see lattice
+        """
+        stable = np.zeros((self.n + 1, self.n + 1), dtype=bool)
+        for (i, j, size), values in zip(self.leaves, self.corner_values(self.leaves)):
+            half = size//2 + 1
+            stable[j:j+half, i:i+half] = values[0]
+            stable[j:j+half, i+size-half+1:i+size+1] = values[1]
+            stable[j+size-half+1:j+size+1, i:i+half] = values[2]
+            stable[j+size-half+1:j+size+1, i+size-half+1:i+size+1] = values[3]
+        return stable
+
+    def lattice(self) -> tuple:
+        """x, y coordinates of the lattice as from np.meshgrid, see grid"""
+        x = np.linspace(*self.bounds[0], self.n + 1)
+        y = np.linspace(*self.bounds[1], self.n + 1)
+        return np.meshgrid(x, y)
+
+    def save(self, path: str = None):
+        """Stores the map in an .npz file, from which load resumes it"""
+        path = self.path if path is None else path
+        vertices = np.array(list(self.values), dtype=int).reshape(-1, 2)
+        np.savez(path,
+                 bounds = self.bounds,
+                 symmetry = np.array(self.symmetry, dtype=str),
+                 depths = np.array([self.max_depth, self.initial_depth, self.depth, self.evaluations]),
+                 leaves = self.leaves,
+                 vertices = vertices,
+                 values = np.array(list(self.values.values()), dtype=bool))
+
+    @classmethod
+    def load(cls, path: str, classify):
+        """
+        Resumes a map stored by save
+
+        Parameters
+        ----------
+        path : str
+            .npz file, further levels are saved to it as well
+        classify : Callable[[npt.NDArray], npt.NDArray]
+            classifier of the points of further levels, see BasinMap
+        """
+        data = np.load(path)
+        max_depth, initial_depth, depth, evaluations = data['depths']
+        basin = cls(classify, data['bounds'], data['symmetry'].tolist(), int(max_depth),
+                    int(initial_depth), path)
+        basin.depth = int(depth)
+        basin.evaluations = int(evaluations)
+        basin.leaves = data['leaves']
+        basin.values = dict(zip(map(tuple, data['vertices'].tolist()), data['values'].tolist()))
+        return basin
+
+    @classmethod
+    def resume(cls, path: str, classify, *args, **kwargs):
+        """Loads the map at path if it exists, otherwise starts a new one saved there"""
+        if os.path.exists(path):
+            return cls.load(path, classify)
+        return cls(classify, *args, path = path, **kwargs)
+
+
+def polar_ksection(classify,
+                   angles: npt.ArrayLike,
+                   r_max: float,
+                   tolerance: float,
+                   k: int = 4,
+                   stride: int = 4,
+                   r_min: float = 0,
+                   margin: float = 1,
+                   verify_ends: bool = False,
+                   r_limit: float = None) -> tuple:
+    """
+    Finds the radius of stability along rays with a k-section search
+
+    Every round evaluates k radii inside the bracket of every unresolved
+    angle, and all of them are passed to classify as one batch. The bracket
+    shrinks by a factor k + 1 per round, where bisection halves it. Along
+    each ray the sail is assumed stable at r_min and unstable at r_max, and
+    the first unstable radius bounds the bracket.
+
+    With verify_ends the first batch classifies r_min and r_max of every
+    angle instead. Rays that are unstable at r_min are not searched, and
+    rays that are stable at r_max are searched up to r_limit, after one
+    more batch that checks r_limit on those rays only.
+
+    Every stride-th angle is searched first. The seeds of the other angles
+    are centred on the interpolated radius of their searched neighbours,
+    widened to either side by margin times the difference between the
+    neighbours plus the tolerance. The k radii
+    of the first round of a seeded angle include the ends of its seed, so
+    a wrong seed falls back to the part of [r_min, r_max] that holds the
+    transition.
+
+    Parameters
+    ----------
+    classify : Callable[[npt.NDArray], npt.NDArray]
+        maps a K x 2 array of points to a boolean array of length K, True
+        for stable, e.g. evaluated over worker processes or as an ensemble
+    angles : npt.ArrayLike
+        angles of the rays in ascending order. [deg]
+    r_max : float
+        outer radius, assumed unstable unless verify_ends
+    tolerance : float
+        width of the final brackets
+    k : int, optional
+        number of radii per angle and round, at least 2. The default is 4.
+    stride : int, optional
+        spacing of the angles of the first wave. The default is 4.
+    r_min : float, optional
+        inner radius, assumed stable unless verify_ends. The default is 0.
+    margin : float, optional
+        widening of the seeds, see above. The default is 1.
+    verify_ends : bool, optional
+        classifies r_min and r_max before the search. The default is False.
+    r_limit : float, optional
+        outer radius of the rays found stable at r_max, only with
+        verify_ends. The default is None, which leaves those rays at r_max.
+
+    Returns
+    -------
+    stable : npt.NDArray
+        largest radius per angle found stable. Equal to unstable where the
+        verified ends do not bracket the transition
+    unstable : npt.NDArray
+        smallest radius per angle found unstable
+    rounds : int
+        number of batches passed to classify
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    directions = np.column_stack((np.cos(np.radians(angles)), np.sin(np.radians(angles))))
+    low = np.full(len(angles), r_min, dtype=np.float64)
+    high = np.full(len(angles), r_max, dtype=np.float64)
+
+    rounds = 0
+    r_outer = r_max
+    if verify_ends:
+        # All rays share the origin
+        inner_points = r_min*directions if r_min > 0 else np.zeros((1, 2))
+        stable = np.asarray(classify(np.concatenate((inner_points, r_max*directions))), dtype=bool)
+        rounds += 1
+        inner = np.broadcast_to(stable[:len(inner_points)], len(angles))
+        outer = stable[len(inner_points):]
+        # Unstable from the start, there is nothing to search
+        high[~inner] = r_min
+        widened = np.flatnonzero(inner & outer)
+        low[widened] = r_max
+        if r_limit is not None and r_limit > r_max and len(widened):
+            r_outer = r_limit
+            stable = np.asarray(classify(r_limit*directions[widened]), dtype=bool)
+            rounds += 1
+            high[widened] = r_limit
+            low[widened[stable]] = r_limit
+        logging.info(f"k-section ends: {np.sum(~inner)} angles unstable at r_min, "
+                     f"{len(widened)} stable at r_max")
+
+    first = np.arange(0, len(angles), stride)
+    second = np.setdiff1d(np.arange(len(angles)), first)
+
+    # The seeds of the second wave interpolate the closest searched angles on either side
+    def seed(indices):
+        position = np.searchsorted(first, indices)
+        previous = first[np.clip(position - 1, 0, len(first) - 1)]
+        following = first[np.clip(position, 0, len(first) - 1)]
+        middle = (low + high)/2
+        span = np.where(following != previous, angles[following] - angles[previous], 1)
+        weight = np.clip((angles[indices] - angles[previous])/span, 0, 1)
+        centre = (1 - weight)*middle[previous] + weight*middle[following]
+        widening = margin*(np.abs(middle[following] - middle[previous]) + tolerance)
+        return np.clip(np.column_stack((centre - widening, centre + widening)), r_min, r_outer)
+
+    for wave, seeded in ((first, False), (second, True)):
+        extra = {i: list(bounds) for i, bounds in zip(wave, seed(wave))} if seeded and len(wave) else {}
+        active = [i for i in wave if high[i] - low[i] > tolerance]
+        while active:
+            radii = {}
+            for i in active:
+                if i in extra:
+                    radii[i] = np.linspace(*extra.pop(i), k)
+                    radii[i] = radii[i][(low[i] < radii[i]) & (radii[i] < high[i])]
+                else:
+                    radii[i] = np.linspace(low[i], high[i], k + 2)[1:-1]
+            points = np.concatenate([radii[i][:, np.newaxis]*directions[i] for i in active])
+            stable = np.asarray(classify(points), dtype=bool)
+            rounds += 1
+
+            offset = 0
+            for i in active:
+                outcome = stable[offset:offset + len(radii[i])]
+                offset += len(radii[i])
+                unstable = np.flatnonzero(~outcome)
+                if len(unstable):
+                    high[i] = radii[i][unstable[0]]
+                    outcome = outcome[:unstable[0]]
+                if np.any(outcome):
+                    low[i] = radii[i][np.flatnonzero(outcome)[-1]]
+            active = [i for i in active if high[i] - low[i] > tolerance]
+            logging.info(f"k-section round {rounds}: {len(points)} points, {len(active)} angles left")
+
+    return low, high, rounds
@@ -0,0 +1,671 @@
+# -*- coding: utf-8 -*-
+"""
+Rigid-body dynamics of an undeformed ParticleSystem, with the attitude kept as a quaternion
+
+Quaternions are stored scalar-last, [x, y, z, w], the same convention as
+scipy.spatial.transform.Rotation. All functions broadcast over leading axes.
+"""
+import logging
+from functools import partial
+
+import numpy as np
+import numpy.typing as npt
+from scipy.integrate import solve_ivp
+from scipy.spatial.transform import Rotation
+
+from ..particleSystem.ForcePipeline import GeometryCache, GeometrySnapshot
+from .stability import DivergencePredictor
+
+
+def quaternion_multiply(p: npt.NDArray, q: npt.NDArray) -> npt.NDArray:
+    """Hamilton product p*q of scalar-last quaternions"""
+    p_vector, p_scalar = p[...,:3], p[...,3:]
+    q_vector, q_scalar = q[...,:3], q[...,3:]
+    vector = p_scalar*q_vector + q_scalar*p_vector + np.cross(p_vector, q_vector)
+    scalar = p_scalar*q_scalar - np.sum(p_vector*q_vector, axis=-1, keepdims=True)
+    return np.concatenate((vector, scalar), axis=-1)
+
+
+def quaternion_to_matrix(q: npt.NDArray) -> npt.NDArray:
+    """Rotation matrices of unit quaternions, shape (..., 3, 3)"""
+    x, y, z, w = np.moveaxis(q, -1, 0)
+    return np.stack((np.stack((1-2*(y*y+z*z), 2*(x*y-z*w), 2*(x*z+y*w)), axis=-1),
+                     np.stack((2*(x*y+z*w), 1-2*(x*x+z*z), 2*(y*z-x*w)), axis=-1),
+                     np.stack((2*(x*z-y*w), 2*(y*z+x*w), 1-2*(x*x+y*y)), axis=-1)), axis=-2)
+
+
+def rotation_vector_to_quaternion(rotation_vector: npt.NDArray) -> npt.NDArray:
+    """Exponential map of rotation vectors [rad] to unit quaternions"""
+    angle = np.linalg.norm(rotation_vector, axis=-1, keepdims=True)
+    # sin(angle/2)/angle, with its limit of 1/2 for small angles
+    factor = np.where(angle > 1e-8, np.sin(angle/2)/np.where(angle > 1e-8, angle, 1), 0.5 - angle**2/48)
+    return np.concatenate((factor*rotation_vector, np.cos(angle/2)), axis=-1)
+
+
+def quaternion_from_euler(angles: npt.ArrayLike) -> npt.NDArray:
+    """Quaternion of x, y, z rotation angles in degrees, same convention as ParticleSystem.displace"""
+    return Rotation.from_euler('xyz', angles, degrees=True).as_quat()
+
+
+def quaternion_to_euler(q: npt.NDArray) -> npt.NDArray:
+    """x, y, z rotation angles in degrees of a quaternion, inverse of quaternion_from_euler"""
+    return Rotation.from_quat(q).as_euler('xyz', degrees=True)
+
+
+def perimeter_event(length_scale: float):
+    """
+    Terminal event for the center of mass leaving the square |x|, |y| < length_scale
+
+    Parameters
+    ----------
+    length_scale : float
+        half width of the square. [m]
+    """
+    def event(t, state):
+        return length_scale - np.max(np.abs(state[:2]))
+    event.terminal = True
+    event.direction = -1
+    return event
+
+
+def attitude_event(limit: float = 5):
+    """
+    Terminal event for the x or y rotation angle reaching a limit
+
+    Parameters
+    ----------
+    limit : float, optional
+        limit of the x, y rotation angles, see quaternion_to_euler. The default is 5. [deg]
+    """
+    def event(t, state):
+        angles = quaternion_to_euler(state[3:7]/np.linalg.norm(state[3:7]))
+        return limit - np.max(np.abs(angles[:2]))
+    event.terminal = True
+    event.direction = -1
+    return event
+
+
+def convergence_event(speed_threshold: float, t_min: float = 0):
+    """
+    Terminal event for the in-plane motion settling after t_min
+
+    Triggers when the sum of the absolute x and y velocities drops below the
+    threshold, or at t_min if it is already below it then.
+
+    Parameters
+    ----------
+    speed_threshold : float
+        threshold of |v_x| + |v_y|. [m/s]
+    t_min : float, optional
+        time before which the event cannot trigger. The default is 0. [s]
+    """
+    def event(t, state):
+        return max(np.sum(np.abs(state[7:9])) - speed_threshold, t_min - t)
+    event.terminal = True
+    event.direction = -1
+    return event
+
+
+class RigidBody:
+    """
+    Six degree of freedom rigid-body model of an undeformed ParticleSystem
+
+    The geometry is captured once in the body frame, centred on the center
+    of mass. The pose is kept as the position of the center of mass and a
+    unit quaternion rotating the body frame into the world frame, so no node
+    of the ParticleSystem is moved while integrating. Loads are evaluated on
+    GeometrySnapshots built with vector operations only, and the mesh is
+    only written back by materialize.
+
+    The state vector has 13 entries: position (3), quaternion (4), velocity
+    (3) and angular velocity in the body frame (3). Units are SI, angles in
+    radians.
+    """
+    def __init__(self, ParticleSystem, ForceCalculator,
+                 gravity: bool = False,
+                 g: float = 9.80665,
+                 damping: npt.ArrayLike = None,
+                 rotate_crystals: bool = False):
+        """
+        Parameters
+        ----------
+        ParticleSystem : ParticleSystem
+            system to model, in the pose the body frame is attached to
+        ForceCalculator : Force
+            external force component with a force_value(cache) method, e.g.
+            an OpticalForceCalculator
+        gravity : bool, optional
+            Adds the weight of the sail along -z. The default is False.
+        g : float, optional
+            gravitational acceleration. The default is 9.80665. [m/s^2]
+        damping : npt.ArrayLike, optional
+            length 6 array of damping coefficients for [x, y, z, rx, ry, rz],
+            multiplied with the velocity and the angular velocity in the world
+            frame and added to the loads. As in simulate_trajectory, the
+            angular velocity is taken in deg/s. The default is None.
+        rotate_crystals : bool, optional
+            Turns the photonic crystal interpolators along with the rotation of
+            the body about z before evaluating the loads. The default is False.
+        """
+        self.ParticleSystem = ParticleSystem
+        self.PS = self.ParticleSystem
+        self.ForceCalculator = ForceCalculator
+        self.gravity = gravity
+        self.g = g
+        self.damping = None if damping is None else np.asarray(damping, dtype=np.float64)
+
+        cache = GeometryCache(ParticleSystem)
+        self.masses = np.array(cache.masses, dtype=np.float64)
+        self.mass = np.sum(self.masses)
+        self.body_locations = cache.locations - cache.center_of_mass
+        self.body_area_vectors = np.array(cache.area_vectors)
+
+        r = self.body_locations
+        self.inertia = (np.sum(self.masses*np.sum(r*r, axis=1))*np.identity(3)
+                        - np.einsum('i,ij,ik->jk', self.masses, r, r))
+        self.inverse_inertia = np.linalg.inv(self.inertia)
+
+        self.state = np.zeros(13)
+        self.state[:3] = cache.center_of_mass
+        self.state[6] = 1
+
+        self.crystal_rotations = {}
+        if rotate_crystals:
+            self.crystal_rotations = {interp: interp.rotation
+                                      for interp in ParticleSystem.optical_properties.crystals}
+        return
+
+    def __str__(self):
+        return (f"RigidBody of {len(self.masses)} nodes, mass {self.mass:.3g} kg, "
+                f"position {self.position}, attitude {self.attitude} [deg]")
+
+    @property
+    def position(self):
+        return self.state[:3]
+
+    @property
+    def quaternion(self):
+        return self.state[3:7]
+
+    @property
+    def velocity(self):
+        return self.state[7:10]
+
+    @property
+    def angular_velocity(self):
+        """angular velocity in the body frame [rad/s]"""
+        return self.state[10:13]
+
+    @property
+    def attitude(self):
+        """x, y, z rotation angles in degrees"""
+        return quaternion_to_euler(self.quaternion)
+
+    def set_state(self,
+                  position: npt.ArrayLike = None,
+                  attitude: npt.ArrayLike = None,
+                  velocity: npt.ArrayLike = None,
+                  angular_velocity: npt.ArrayLike = None):
+        """
+        Sets (part of) the state
+
+        Parameters
+        ----------
+        position : npt.ArrayLike, optional
+            position of the center of mass. [m]
+        attitude : npt.ArrayLike, optional
+            x, y, z rotation angles, see quaternion_from_euler. [deg]
+        velocity : npt.ArrayLike, optional
+            velocity of the center of mass. [m/s]
+        angular_velocity : npt.ArrayLike, optional
+            angular velocity in the world frame. [rad/s]
+        """
+        if position is not None:
+            self.state[:3] = position
+        if attitude is not None:
+            self.state[3:7] = quaternion_from_euler(attitude)
+        if velocity is not None:
+            self.state[7:10] = velocity
+        if angular_velocity is not None:
+            rotation = quaternion_to_matrix(self.quaternion)
+            self.state[10:13] = rotation.T.dot(angular_velocity)
+
+    def geometry(self, state: npt.NDArray = None) -> GeometrySnapshot:
+        """
+        World frame geometry of a state
+
+        Parameters
+        ----------
+        state : npt.NDArray, optional
+            state vector. The default is None, using self.state.
+
+        Returns
+        -------
+        snapshot : GeometrySnapshot
+            node locations, velocities and area vectors in the world frame
+        """
+        if state is None:
+            state = self.state
+        rotation = quaternion_to_matrix(state[3:7]/np.linalg.norm(state[3:7]))
+        arms = self.body_locations.dot(rotation.T)
+        angular_velocity = rotation.dot(state[10:13])
+        return GeometrySnapshot(locations = arms + state[:3],
+                                velocities = state[7:10] + np.cross(angular_velocity, arms),
+                                area_vectors = self.body_area_vectors.dot(rotation.T),
+                                center_of_mass = state[:3],
+                                masses = self.masses)
+
+    def loads(self, state: npt.NDArray = None):
+        """
+        Net force and moment around the center of mass, both in the world frame
+
+        Parameters
+        ----------
+        state : npt.NDArray, optional
+            state vector. The default is None, using self.state.
+
+        Returns
+        -------
+        net_force : npt.NDArray
+        net_moment : npt.NDArray
+        """
+        if state is None:
+            state = self.state
+        self.orient_crystals(state)
+        snapshot = self.geometry(state)
+        forces = np.reshape(self.ForceCalculator.force_value(snapshot), (-1, 3))
+
+        net_force = np.sum(forces, axis=0)
+        net_moment = np.sum(np.cross(snapshot.locations - snapshot.center_of_mass, forces), axis=0)
+
+        if self.damping is not None:
+            rotation = quaternion_to_matrix(state[3:7]/np.linalg.norm(state[3:7]))
+            net_force += self.damping[:3]*state[7:10]
+            net_moment += self.damping[3:]*np.rad2deg(rotation.dot(state[10:13]))
+        if self.gravity:
+            net_force[2] -= self.mass*self.g
+        return net_force, net_moment
+
+    def orient_crystals(self, state: npt.NDArray = None):
+        """Sets the rotation of the crystal interpolators to the z rotation of a state"""
+        if not self.crystal_rotations:
+            return
+        if state is None:
+            state = self.state
+        angle = np.deg2rad(quaternion_to_euler(state[3:7]/np.linalg.norm(state[3:7]))[2])
+        for interp, rotation in self.crystal_rotations.items():
+            interp.rotation = rotation + angle
+
+    def state_derivative(self, state: npt.NDArray, net_force: npt.NDArray,
+                         net_moment: npt.NDArray) -> npt.NDArray:
+        """
+        Time derivative of the state for given loads, broadcasting over leading axes
+
+        Parameters
+        ----------
+        state : npt.NDArray
+            array of shape (..., 13) of states
+        net_force : npt.NDArray
+            array of shape (..., 3) of net forces in the world frame
+        net_moment : npt.NDArray
+            array of shape (..., 3) of moments around the center of mass in the world frame
+
+        Returns
+        -------
+        derivative : npt.NDArray
+            array of shape (..., 13)
+        """
+        quaternion = state[...,3:7]
+        angular_velocity = state[...,10:13]
+        rotation = quaternion_to_matrix(quaternion/np.linalg.norm(quaternion, axis=-1, keepdims=True))
+        body_moment = np.einsum('...ji,...j->...i', rotation, net_moment)
+
+        # Euler's equations in the body frame
+        angular_momentum = angular_velocity.dot(self.inertia.T)
+        angular_acceleration = (body_moment - np.cross(angular_velocity, angular_momentum)).dot(self.inverse_inertia.T)
+
+        pure = np.concatenate((angular_velocity, np.zeros(angular_velocity.shape[:-1] + (1,))), axis=-1)
+        return np.concatenate((state[...,7:10],
+                               0.5*quaternion_multiply(quaternion, pure),
+                               net_force/self.mass,
+                               angular_acceleration), axis=-1)
+
+    def derivatives(self, t: float, state: npt.NDArray, spin: bool = True) -> npt.NDArray:
+        """
+        Time derivative of a state, signature of scipy.integrate.solve_ivp
+
+        If spin is False, the angular acceleration about the world z-axis is
+        removed, so a state without spin keeps none.
+        """
+        derivative = self.state_derivative(state, *self.loads(state))
+        if not spin:
+            rotation = quaternion_to_matrix(state[3:7]/np.linalg.norm(state[3:7]))
+            derivative[10:13] -= rotation[2]*rotation[2].dot(derivative[10:13])
+        return derivative
+
+    def integrate(self,
+                  t_end: float,
+                  events: list = (),
+                  t_start: float = 0,
+                  method: str = 'RK45',
+                  spin: bool = True,
+                  **kwargs):
+        """
+        Integrates self.state with an adaptive scheme of scipy.integrate.solve_ivp
+
+        Integration stops exactly at the first terminal event, see
+        perimeter_event, attitude_event and convergence_event. Afterwards
+        self.state holds the final state, with the quaternion normalised.
+
+        Parameters
+        ----------
+        t_end : float
+            end time of the integration. [s]
+        events : list, optional
+            event functions passed to solve_ivp. The default is ().
+        t_start : float, optional
+            time of self.state, to continue an earlier integration. The default is 0. [s]
+        method : str, optional
+            integration method of solve_ivp. The default is 'RK45'.
+        spin : bool, optional
+            If False, rotation about the world z-axis is suppressed. The default is True.
+        **kwargs
+            passed to solve_ivp, e.g. rtol, atol and max_step
+
+        Returns
+        -------
+        solution : OdeResult
+            result of solve_ivp, solution.nfev counts the load evaluations
+        """
+        if not spin:
+            rotation = quaternion_to_matrix(self.quaternion)
+            self.state[10:13] -= rotation[2]*rotation[2].dot(self.state[10:13])
+
+        solution = solve_ivp(partial(self.derivatives, spin = spin), (t_start, t_end), self.state.copy(),
+                             method = method,
+                             events = list(events),
+                             **kwargs)
+        if not solution.success:
+            logging.warning(f'Rigid-body integration failed: {solution.message}')
+        self.state = solution.y[:,-1].copy()
+        self.state[3:7] /= np.linalg.norm(self.state[3:7])
+        self.orient_crystals()
+        return solution
+
+    def step(self, dt: float, loads = None, spin: bool = True):
+        """
+        Advances self.state by one semi-implicit Euler step
+
+        The velocities are updated first and then used to move the body. The
+        attitude is advanced with the exponential map, which keeps the
+        quaternion of unit length.
+
+        Parameters
+        ----------
+        dt : float
+            timestep. [s]
+        loads : tuple, optional
+            net force and moment of the current state, to avoid evaluating
+            them twice. The default is None, calculating them.
+        spin : bool, optional
+            If False, the angular velocity about the world z-axis is removed
+            before moving. The default is True.
+        """
+        if loads is None:
+            loads = self.loads()
+        self.advance(self.state, self.state_derivative(self.state, *loads), dt, spin)
+
+    @staticmethod
+    def advance(state: npt.NDArray, derivative: npt.NDArray, dt: float, spin: bool = True):
+        """
+        Semi-implicit Euler update of states in place, see step
+
+        Parameters
+        ----------
+        state : npt.NDArray
+            array of shape (..., 13) of states, updated in place
+        derivative : npt.NDArray
+            array of shape (..., 13) of their time derivatives
+        dt : float
+            timestep. [s]
+        spin : bool, optional
+            If False, the angular velocity about the world z-axis is removed
+            before moving. The default is True.
+        """
+        state[...,7:13] += derivative[...,7:13]*dt
+        if not spin:
+            z_axis = quaternion_to_matrix(state[...,3:7])[...,2,:]
+            state[...,10:13] -= z_axis*np.sum(z_axis*state[...,10:13], axis=-1, keepdims=True)
+        state[...,:3] += state[...,7:10]*dt
+
+        quaternion = quaternion_multiply(state[...,3:7], rotation_vector_to_quaternion(state[...,10:13]*dt))
+        state[...,3:7] = quaternion/np.linalg.norm(quaternion, axis=-1, keepdims=True)
+
+    def kinetic_energy(self, state: npt.NDArray = None):
+        """Translational and rotational kinetic energy of a state [J]"""
+        if state is None:
+            state = self.state
+        angular_velocity = state[...,10:13]
+        return (0.5*self.mass*np.sum(state[...,7:10]**2, axis=-1),
+                0.5*np.sum(angular_velocity*angular_velocity.dot(self.inertia.T), axis=-1))
+
+    def materialize(self, state: npt.NDArray = None):
+        """
+        Moves the nodes of the ParticleSystem to the pose of a state
+
+        Parameters
+        ----------
+        state : npt.NDArray, optional
+            state vector. The default is None, using self.state.
+        """
+        snapshot = self.geometry(state)
+        self.ParticleSystem.update_pos_unsafe(snapshot.locations.ravel())
+        self.ParticleSystem.update_vel_unsafe(snapshot.velocities.ravel())
+
+
+class RigidEnsemble:
+    """
+    Lock-step ensemble of K rigid-body trajectories of the same sail
+
+    All members share the body-frame geometry of a RigidBody and differ only
+    in their state. Each step the optical forces of all active members are
+    evaluated as one (K, n, 3) batch with force_value_batch, if the force
+    calculator has it. Members are retired as soon as they converge, leave
+    the perimeter or reach the attitude limit, using the same criteria as
+    Simulate_Lightsail.simulate_rigid_trajectory.
+    """
+    def __init__(self, RigidBody, states: npt.ArrayLike, batch_size: int = None):
+        """
+        Parameters
+        ----------
+        RigidBody : RigidBody
+            model of the sail, its force calculator, damping and gravity
+        states : npt.ArrayLike
+            K x 13 array of initial states, see RigidBody
+        batch_size : int, optional
+            maximum number of members whose forces are evaluated in one batch,
+            to limit memory use. The default is None, evaluating all at once.
+        """
+        self.RigidBody = RigidBody
+        self.batch_size = batch_size
+        self.states = np.array(states, dtype=np.float64, ndmin=2)
+        self.states[:,3:7] /= np.linalg.norm(self.states[:,3:7], axis=1, keepdims=True)
+        K = len(self.states)
+        self.initial_states = self.states.copy()
+        self.displacement = np.zeros((K, 3))
+        self.active = np.ones(K, dtype=bool)
+        self.stable = np.zeros(K, dtype=bool)
+        self.steps = np.zeros(K, dtype=int)
+        return
+
+    def __str__(self):
+        return (f"RigidEnsemble of {len(self.states)} members, {np.sum(self.active)} active, "
+                f"{np.sum(self.stable)} stable")
+
+    @classmethod
+    def from_displacements(cls, RigidBody, initial_conditions: npt.ArrayLike, batch_size: int = None):
+        """
+        Creates an ensemble from initial conditions in the format of simulate_trajectory
+
+        Parameters
+        ----------
+        RigidBody : RigidBody
+            model of the sail, in its reference pose
+        initial_conditions : npt.ArrayLike
+            K x 2 x 6 array; per member the displacement [x, y, z, rx, ry, rz]
+            of the reference pose and its rate of change. Angles in degrees.
+        batch_size : int, optional
+            see RigidEnsemble. The default is None.
+        """
+        initial_conditions = np.array(initial_conditions, dtype=np.float64, ndmin=3)
+        states = np.tile(RigidBody.state, (len(initial_conditions), 1))
+        states[:,:3] += initial_conditions[:,0,:3]
+        states[:,3:7] = quaternion_multiply(quaternion_from_euler(initial_conditions[:,0,3:]),
+                                            RigidBody.quaternion)
+        states[:,7:10] = initial_conditions[:,1,:3]
+        rotations = quaternion_to_matrix(states[:,3:7])
+        states[:,10:13] = np.einsum('kji,kj->ki', rotations, np.deg2rad(initial_conditions[:,1,3:]))
+        return cls(RigidBody, states, batch_size)
+
+    def loads(self, states: npt.NDArray):
+        """
+        Net forces and moments of a batch of states, in the world frame
+
+        Parameters
+        ----------
+        states : npt.NDArray
+            K x 13 array of states
+
+        Returns
+        -------
+        net_force : npt.NDArray
+            K x 3 array
+        net_moment : npt.NDArray
+            K x 3 array
+        """
+        body = self.RigidBody
+        FC = body.ForceCalculator
+        if not hasattr(FC, 'force_value_batch'):
+            loads = [body.loads(state) for state in states]
+            return np.array([l[0] for l in loads]), np.array([l[1] for l in loads])
+
+        rotations = quaternion_to_matrix(states[:,3:7])
+        arms = np.einsum('kij,nj->kni', rotations, body.body_locations)
+        area_vectors = np.einsum('kij,nj->kni', rotations, body.body_area_vectors)
+        crystal_rotations = None
+        if body.crystal_rotations:
+            crystal_rotations = np.deg2rad(quaternion_to_euler(states[:,3:7])[:,2])
+        locations = arms + states[:,np.newaxis,:3]
+        batch_size = self.batch_size or len(states)
+        forces = np.zeros(arms.shape)
+        for i in range(0, len(states), batch_size):
+            batch = slice(i, i+batch_size)
+            forces[batch] = FC.force_value_batch(locations[batch], area_vectors[batch],
+                                                 None if crystal_rotations is None else crystal_rotations[batch])
+
+        net_force = np.sum(forces, axis=1)
+        net_moment = np.sum(np.cross(arms, forces), axis=1)
+        if body.damping is not None:
+            net_force += body.damping[:3]*states[:,7:10]
+            net_moment += body.damping[3:]*np.rad2deg(np.einsum('kij,kj->ki', rotations, states[:,10:13]))
+        if body.gravity:
+            net_force[:,2] -= body.mass*body.g
+        return net_force, net_moment
+
+    def run(self,
+            dt: float,
+            t_steps: int,
+            length_scale: float,
+            convergence_threshold: float,
+            min_steps: int = 10,
+            attitude_limit: float = 5,
+            spin: bool = True,
+            printframes: int = 0,
+            early_stopping: float = None):
+        """
+        Advances all members in lock-step until every one of them is retired
+
+        A member converges when its x, y displacement summed over the last
+        10 steps drops below convergence_threshold after min_steps. It is
+        unstable when its center of mass leaves |x|, |y| < length_scale,
+        its x or y angle reaches attitude_limit or it runs out of steps.
+        The z position is kept constant, as in simulate_trajectory, but the
+        summed displacement including z is kept in self.displacement.
+
+        Parameters
+        ----------
+        dt : float
+            timestep. [s]
+        t_steps : int
+            maximum number of steps
+        length_scale : float
+            half width of the perimeter. [m]
+        convergence_threshold : float
+            threshold of the summed x, y displacement. [m]
+        min_steps : int, optional
+            number of steps before convergence is checked. The default is 10.
+        attitude_limit : float, optional
+            limit of the x and y angles. The default is 5. [deg]
+        spin : bool, optional
+            If False, rotation about the world z-axis is suppressed. The default is True.
+        printframes : int, optional
+            Print a message every nth step. The default is 0.
+        early_stopping : float, optional
+            confidence level at which members are retired on the label of a
+            DivergencePredictor, with the equilibrium at the position of the
+            RigidBody. Borderline members run on to the criteria above. The
+            predictor is kept in self.predictor and the labels of the members
+            it retired in self.predictions. The default is None.
+
+        Returns
+        -------
+        stable : npt.NDArray
+            boolean array of length K, True for the members that converged
+            or were predicted stable
+        """
+        K = len(self.states)
+        recent = np.zeros((K, 10))
+        step = 0
+        self.predictor = None
+        self.predictions = np.full(K, '', dtype='<U10')
+        if early_stopping is not None:
+            self.predictor = DivergencePredictor(np.tile(self.RigidBody.position[:2], (K, 1)),
+                                                 length_scale, attitude_limit, early_stopping)
+        while np.any(self.active) and step < t_steps:
+            if self.predictor is not None:
+                self.predictor.update(self.states[:,:3], quaternion_to_euler(self.states[:,3:7]),
+                                      t_steps - step)
+            indices = np.flatnonzero(self.active)
+            states = self.states[indices]
+            position = states[:,:3].copy()
+            attitude = quaternion_to_euler(states[:,3:7])
+
+            derivative = self.RigidBody.state_derivative(states, *self.loads(states))
+            self.RigidBody.advance(states, derivative, dt, spin)
+            self.displacement[indices] += states[:,:3] - position
+            states[:,2] = position[:,2] # Keep z constant to keep it in frame
+            self.states[indices] = states
+            self.steps[indices] += 1
+            step += 1
+
+            # Checked on the pose before the step and the 10 steps before it,
+            # like simulate_rigid_trajectory
+            converged = (step > min_steps) & (np.sum(recent[indices], axis=1) < convergence_threshold)
+            escaped = ((np.max(np.abs(position[:,:2]), axis=1) >= length_scale)
+                       | (np.max(np.abs(attitude[:,:2]), axis=1) >= attitude_limit))
+            recent[indices, step%10] = np.sum(np.abs(states[:,:2] - position[:,:2]), axis=1)
+            self.stable[indices[converged]] = True
+            self.active[indices[converged | escaped]] = False
+            if self.predictor is not None:
+                labels = self.predictor.labels[indices]
+                predicted = ~(converged | escaped) & np.isin(labels, ['stable', 'unstable'])
+                self.stable[indices[predicted & (labels == 'stable')]] = True
+                self.predictions[indices[predicted]] = labels[predicted]
+                self.active[indices[predicted]] = False
+
+            if printframes and step%printframes==0:
+                print(f'{step=}, \tactive={np.sum(self.active)}/{K}, \tstable={np.sum(self.stable)}')
+
+        self.active[:] = False
+        logging.info(f'Ensemble of {K} finished after {step} steps, {np.sum(self.stable)} stable')
+        return self.stable
@@ -16,7 +16,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from ..particleSystem.ParticleSystem import ParticleSystem
+from ..particleSystem.ForcePipeline import GravityForce, PressureForce
 from ..Mesh import mesh_functions as MF
+from .rigid_body import (RigidBody, RigidEnsemble, quaternion_to_matrix, quaternion_to_euler,
+                         perimeter_event, attitude_event, convergence_event)
+from .stability import LinearStability, DivergencePredictor
+from .basin_mapping import BasinMap
 
 
 
@@ -182,6 +187,7 @@ class Simulate_airbag(Simulate):
         self.PS = ParticleSystem
         self.params = params
         self.pressure = params['pressure']            # [Pa]
+        self.pressure_force = PressureForce(self.pressure)
 
 
     def run_simulation(self,
@@ -219,6 +225,9 @@ class Simulate_airbag(Simulate):
 
         # Update pressure value for force calculation
         self.pressure = self.PS.params['pressure']            # [Pa]
+        self.pressure_force.pressure = self.pressure
+        if self.pressure_force not in self.PS.force_pipeline.components:
+            self.PS.force_pipeline.add(self.pressure_force)
 
         converged = False
         convergence_history = []
@@ -270,9 +279,7 @@ class Simulate_airbag(Simulate):
                 fig.savefig(f'temp\Airbag{step}.jpg', dpi = 200, format = 'jpg')
 
             # Force Calculation
-            areas = self.PS.find_surface()
-            areas = np.nan_to_num(areas)
-            f = np.hstack(areas) * self.pressure
+            f = self.PS.force_pipeline.force_value().ravel()
 
             # Advance 1 timesetp
             simulation_function(f)
@@ -370,13 +377,14 @@ class SimulateTripleChainWithMass(Simulate):
     def __init__(self, ParticleSystem, params):
         self.PS = ParticleSystem
         self.params = params
+        self.gravity = GravityForce(g = 9.81)
 
 
     def run_simulation(self):
 
         # Calculate external forces
-        forces = -1*9.81*np.array([p.m for p in self.PS.particles])
-        forces = np.outer(forces, [0,0,1]).flatten()
+        if self.gravity not in self.PS.force_pipeline.components:
+            self.PS.force_pipeline.add(self.gravity)
 
         converged = False
         self.convergence_history = {'e_kin': [],
@@ -388,6 +396,7 @@ class SimulateTripleChainWithMass(Simulate):
         max_steps = self.params['max_sim_steps']
         info_dump_divisor = int(max_steps/100)
         while not converged:
+            forces = self.PS.force_pipeline.force_value().ravel()
             x,v = self.PS.kin_damp_sim(forces)
 
             self.PS.step+=1
@@ -435,7 +444,8 @@ class Simulate_Lightsail(Simulate):
                        printframes: int = 10,
                        simulation_function: str = 'default',
                        plot_forces=False,
-                       file_id = ''):
+                       file_id = '',
+                       implicit_forces = False):
         """
         Parameters
         ----------
@@ -445,6 +455,12 @@ class Simulate_Lightsail(Simulate):
             Print a mesage every nth frame. The default is 10.
         simulation_function : str, optional
             Allows enabling kinetic damping by passing 'kinetic_damping'. The default is 'default'.
+        implicit_forces : bool, optional
+            Passes the position derivative of the external forces from
+            ForceCalculator.force_jacobian to the solver, so they are treated
+            implicitly. This allows larger stable timesteps. The Jacobian
+            ignores optical patches, so a warning is logged if the
+            ForceCalculator has a patch layer. The default is False.
 
 
         Returns
@@ -455,7 +471,11 @@ class Simulate_Lightsail(Simulate):
         if simulation_function == 'kinetic_damping':
             simulation_function = self.PS.kin_damp_sim
         else:
-            simulation_function = self.PS.simulate()
+            simulation_function = self.PS.simulate
+
+        if implicit_forces and getattr(self.FC, 'patch_layer', None) is not None:
+            logging.warning('implicit_forces uses the per-node force Jacobian, which does not '
+                            'match the forces of the optical patches')
 
         converged = False
         convergence_history = []
@@ -518,7 +538,14 @@ class Simulate_Lightsail(Simulate):
                 fig.savefig(f'temp\Lightsail{file_id}{step}.jpg', dpi = 200, format = 'jpg')
 
             # Advance 1 timestep
-            simulation_function(f.ravel())
+            if implicit_forces:
+                jx_external = self.FC.force_jacobian()
+                if simulation_function == self.PS.kin_damp_sim:
+                    simulation_function(f.ravel(), jx_ext = jx_external)
+                else:
+                    simulation_function(f.ravel(), jx_external)
+            else:
+                simulation_function(f.ravel())
 
             # Convergence checking
             d_crit_d_step = 0
@@ -574,7 +601,12 @@ class Simulate_Lightsail(Simulate):
                        spin = True,
                        gravity = False,
                        damping = None,
-                       initial_conditions = None):
+                       initial_conditions = None,
+                       rigid_body = False,
+                       ode_method = None,
+                       early_stopping = None,
+                       deform_interval = None,
+                       load_tolerance = None):
         """
         Parameters
         ----------
@@ -605,25 +637,65 @@ class Simulate_Lightsail(Simulate):
              - Row 1: Initial conditions for the variables [x, y, z, rx, ry, rz]
              - Row 2: Initial conditions for the first derivatives of the variables in Row 1
                [dx/dt, dy/dt, dz/dt, drx/dt, dry/dt, drz/dt]
+        rigid_body : bool
+            Integrates the trajectory with the quaternion based RigidBody
+            model, see simulate_rigid_trajectory. Requires deform = False and
+            does not plot frames.
+        ode_method : str
+            with rigid_body, integrates adaptively with this method of
+            scipy.integrate.solve_ivp, e.g. 'RK45' or 'DOP853'
+        early_stopping : float
+            confidence level, e.g. 0.99, at which a DivergencePredictor stops
+            the trajectory once its outcome is clear from the growth of the
+            deviation. Borderline trajectories run on to the perimeter and
+            convergence criteria. The predictor is kept in
+            self.divergence_predictor. The default is None.
+        deform_interval : int
+            with deform, updates the shape only every deform_interval steps
+            instead of advancing the structure every step. The shape update
+            is quasi-static, see ParticleSystem.relax_quasi_static, and the
+            rigid-body motion carries the frozen shape in between. A free sail
+            must be in equilibrium without load, e.g. prestressed against a
+            stiff ring; with fixed particles there is no inertia relief.
+            The default is None.
+        load_tolerance : float
+            with deform, also updates the shape as soon as the nodal optical
+            load differs from the load of the last shape update by more than
+            this fraction. Without deform_interval the shape is only updated
+            on this criterion. The default is None.
+            The error indicators are kept per step in PS.history:
+            'load_change', the relative change of the load since the last
+            shape update, and 'shape_residual', the relative residual of the
+            quasi-static shape at the steps it was updated.
+
         Returns
         -------
         None.
 
         """
 
-        keys_1d = ['abs_force', "E_kin_xy", "E_kin_rot"]
-        for key in keys_1d:
-            if not key in self.PS.history.keys() or len(self.PS.history[key]) != int(self.params['t_steps']):
-                self.PS.history[key] = np.zeros(int(self.params['t_steps']))
-
-        keys_2d = ['net_force', 'net_moment', 'lin_accel', 'rot_accel']
-        for key in keys_2d:
-            if not key in self.PS.history.keys() or len(self.PS.history[key]) != int(self.params['t_steps']):
-                self.PS.history[key] = np.zeros((int(self.params['t_steps']),3))
-        keys_6d = ['position', 'velocity']
-        for key in keys_6d:
-            if not key in self.PS.history.keys() or len(self.PS.history[key]) != int(self.params['t_steps']):
-                self.PS.history[key] = np.zeros((int(self.params['t_steps']),6))
+        if rigid_body:
+            if deform:
+                raise AttributeError("rigid_body requires deform = False, "
+                                     "the rigid-body model cannot deform the mesh")
+            return self.simulate_rigid_trajectory(printframes = printframes,
+                                                  spin = spin,
+                                                  gravity = gravity,
+                                                  damping = damping,
+                                                  initial_conditions = initial_conditions,
+                                                  ode_method = ode_method,
+                                                  early_stopping = early_stopping)
+
+        self.__init_trajectory_history()
+        multirate = deform and (deform_interval is not None or load_tolerance is not None)
+        if multirate:
+            deform_interval = np.inf if deform_interval is None else deform_interval
+            load_tolerance = np.inf if load_tolerance is None else load_tolerance
+            inertia_relief = not any(p.fixed for p in self.PS.particles)
+            shape_load = None
+            shape_updates = 0
+            self.PS.history['load_change'][:] = 0
+            self.PS.history['shape_residual'][:] = 0
 
         if plotframes:
             fig = plt.figure(figsize = [16,12])
@@ -640,6 +712,13 @@ class Simulate_Lightsail(Simulate):
 
         dt = self.params['dt']
 
+        predictor = None
+        if early_stopping is not None:
+            predictor = DivergencePredictor(self.PS.calculate_center_of_mass()[:2],
+                                            length_scale,
+                                            confidence = early_stopping)
+        self.divergence_predictor = predictor
+
         if type(initial_conditions) == type(None):
             v = np.zeros([6])
         else:
@@ -650,8 +729,7 @@ class Simulate_Lightsail(Simulate):
 
         interpolators = set()
         if spin:
-            for p in self.PS.particles:
-                interpolators.add(p.optical_interpolator)
+            interpolators.update(self.PS.optical_properties.crystals)
 
         step = 1
         min_steps = self.params['min_iterations']
@@ -663,6 +741,7 @@ class Simulate_Lightsail(Simulate):
 
         start_time = time.time()
         done = False
+        stable = False
         while not done:
             if step > self.params['t_steps']-2:
                 done = True
@@ -712,42 +791,25 @@ class Simulate_Lightsail(Simulate):
 
             # Logic save plots of the simulation while it is running
             if plotframes and step%plotframes==0:
-                fig.clear()
-                ax = fig.add_subplot(projection='3d')
-                if plot_forces:
-                    self.PS.plot_forces(f,ax, length = arrow_length)
-                else:
-                    self.PS.plot(ax)
-                ax.elev = plot_angles[0]
-                ax.azim = plot_angles[1]
-                if plot_net_force:
-                    if not spin:
-                        net_moment[2] =0
-                    ax.quiver(COM[0],COM[1],COM[2],
-                              net_force[0],net_force[1],net_force[2],
-                              length = arrow_length/2e2, label ='Net Force', color='r')
-                    ax.quiver(COM[0],COM[1],COM[2],
-                              net_moment[0],net_moment[1],net_moment[2],
-                              length = arrow_length*5e2, label ='Net Moment', color='magenta')
-                    ax.legend()
-
-                x,_ = self.PS.x_v_current_3D
-                z = x[:,2]
-
-                zlim = np.max([z.max(),zlim])
-                ax.set_zlim(0,zlim)
-                plot_scale=1
-                ax.set_xlim([-length_scale*plot_scale,length_scale*plot_scale])
-                ax.set_ylim([-length_scale*plot_scale,length_scale*plot_scale])
-                t = np.sum(self.PS.history['dt'])
-                ax.set_title(f"Simulate Lightsail, t = {t:.5f}")
-                ax.set_aspect('equal')
-
-                fig.tight_layout()
-                fig.savefig(f'temp\Lightsail{file_id}{step}.jpg', dpi = 300, format = 'jpg')
+                zlim = self.__plot_trajectory_frame(fig, f, net_force, net_moment, COM, zlim,
+                                                    plot_angles, plot_forces, plot_net_force,
+                                                    arrow_length, spin, file_id, step)
 
             # Advance 1 timestep
-            if deform:
+            if multirate:
+                if shape_load is not None:
+                    load_change = np.linalg.norm(f - shape_load)/np.linalg.norm(shape_load)
+                    self.PS.history['load_change'][step] = load_change
+                if (shape_load is None or step - shape_step >= deform_interval
+                        or load_change > load_tolerance):
+                    residual, _ = self.PS.relax_quasi_static(f.ravel(), self.FC.force_jacobian(),
+                                                             inertia_relief = inertia_relief)
+                    self.PS.history['shape_residual'][step] = residual
+                    shape_load = f.copy()
+                    shape_step = step
+                    shape_updates += 1
+                self.PS.history['dt'].append(dt)
+            elif deform:
                 self.PS.simulate(f.ravel())
             else:
                 self.PS.history['dt'].append(dt)
@@ -763,6 +825,8 @@ class Simulate_Lightsail(Simulate):
                 else:
                     print(f'{step=}, \tt={t//60:.0f}m {t%60:.2f}s, \t{abs_force=:.2g}, \t{location=} [D], \t{angles=} [deg]'.replace('array',''))
             # break if it flies off
+            if predictor is not None:
+                label = str(predictor.update(COM, attitude, self.params['t_steps'] - step))
             dx_recent = np.sum(np.abs(self.PS.history['position'][step-10:step][:,:2]))
             if step> min_steps and dx_recent<self.params['convergence_threshold']:
                 done= True
@@ -773,6 +837,10 @@ class Simulate_Lightsail(Simulate):
                 print(f'Simulation halted: Lightsail broke perimiter {COM=} [D]')
                 done = True
                 stable = False
+            elif predictor is not None and label in ('stable', 'unstable'):
+                print(f'Simulation halted: predicted {label} with confidence {predictor.label_confidence:.4f}')
+                done = True
+                stable = label == 'stable'
             elif step > self.params['t_steps']-1:
                 done = True
                 stable = False
@@ -783,11 +851,432 @@ class Simulate_Lightsail(Simulate):
         current_time = time.time()
         delta_time = current_time - start_time
         print(f'Converged in {delta_time//60:.0f}m {delta_time%60:.2f}s, {step} timesteps')
+        if multirate:
+            logging.info(f'Multi-rate trajectory: {shape_updates} shape updates in {step} steps, '
+                         f"max load change {np.max(self.PS.history['load_change']):.3g}")
         return stable
 
         if plotframes:
             self.plot_flight_hist()
 
+    def simulate_rigid_trajectory(self,
+                                  printframes: int = 10,
+                                  spin = True,
+                                  gravity = False,
+                                  damping = None,
+                                  initial_conditions = None,
+                                  ode_method = None,
+                                  early_stopping = None):
+        """
+        Trajectory simulation of the undeformed sail as a 6-DOF rigid body
+
+        The pose is kept as the position of the center of mass and a
+        quaternion, and the rotation uses the full inertia tensor. The loads
+        are evaluated on the geometry captured in the body frame, so the
+        ParticleSystem is only moved to the final pose when the simulation
+        ends. The history and stopping criteria are those of
+        simulate_trajectory, the angles in degrees.
+
+        Parameters
+        ----------
+        printframes : int, optional
+            Print a mesage every nth frame. The default is 10.
+        spin : bool
+            allows to run a trajectory simulation without rotation about z
+        gravity : bool
+            allows to enable gravitational force
+        damping : npt.ArrayLike
+            allows addition of damping forces to trajectory simulation. Should be length 6 array
+            representing damping in [x,y,z,rx,ry,rz]
+        initial_conditions : npt.Arraylike
+            A 2x6 matrix of initial conditions, see simulate_trajectory. The
+            rates of the angles are in degrees per second.
+        ode_method : str, optional
+            Integrates with this adaptive method of scipy.integrate.solve_ivp
+            instead of fixed steps of params['dt']. Integration stops exactly
+            when the sail leaves the perimeter, reaches the attitude limit or
+            converges. The history then holds the accepted steps only, without
+            the load entries. The default is None.
+        early_stopping : float
+            confidence level, e.g. 0.99, at which a DivergencePredictor stops
+            the fixed-step trajectory once its outcome is clear from the
+            growth of the deviation. Borderline trajectories run on to the perimeter and
+            convergence criteria. The predictor is kept in
+            self.divergence_predictor. The default is None.
+
+        Returns
+        -------
+        stable : bool
+            True if the sail converged or was predicted stable, False if it
+            broke the perimeter, was predicted unstable or ran out of steps
+
+        """
+        self.__init_trajectory_history()
+        length_scale = np.ptp(self.PS.x_v_current_3D[0][:,0])
+        self.length_scale = length_scale
+        dt = self.params['dt']
+
+        body = RigidBody(self.PS, self.FC, gravity = gravity, damping = damping,
+                         rotate_crystals = spin)
+        self.rigid_body = body
+        predictor = None
+        if early_stopping is not None and ode_method is None:
+            predictor = DivergencePredictor(body.position[:2], length_scale,
+                                            confidence = early_stopping)
+        self.divergence_predictor = predictor
+        if type(initial_conditions) != type(None):
+            initial_conditions = np.asarray(initial_conditions, dtype=np.float64)
+            body.set_state(position = body.position + initial_conditions[0,:3],
+                           attitude = initial_conditions[0,3:],
+                           velocity = initial_conditions[1,:3],
+                           angular_velocity = np.deg2rad(initial_conditions[1,3:]))
+
+        step = 1
+        min_steps = self.params['min_iterations']
+        if hasattr(self.PS,'history'):
+            step = len(self.PS.history['dt'])
+            min_steps += step
+        self.PS.history['position'][step,:3] = body.position
+        step +=1
+
+        start_time = time.time()
+        if ode_method is not None:
+            stable = self.__integrate_rigid_trajectory(body, step, dt, spin, ode_method)
+            body.materialize()
+            delta_time = time.time() - start_time
+            print(f'Converged in {delta_time//60:.0f}m {delta_time%60:.2f}s, {len(self.PS.history["dt"])} timesteps')
+            return stable
+
+        done = False
+        stable = False
+        while not done:
+            if step > self.params['t_steps']-2:
+                done = True
+            net_force, net_moment = body.loads()
+            derivative = body.state_derivative(body.state, net_force, net_moment)
+            rotation = quaternion_to_matrix(body.quaternion)
+
+            abs_force = np.linalg.norm(net_force)
+            E_kin_xy = sum(1/2 * body.mass * body.velocity[:2]**2)
+            E_kin_rot = body.kinetic_energy()[1]
+            self.PS.history['abs_force'][step]=abs_force
+            self.PS.history['net_force'][step]=net_force
+            self.PS.history['net_moment'][step]=net_moment
+            self.PS.history['lin_accel'][step]=derivative[7:10]
+            self.PS.history['rot_accel'][step]=np.rad2deg(rotation.dot(derivative[10:13]))
+            self.PS.history['E_kin_xy'][step]=E_kin_xy
+            self.PS.history['E_kin_rot'][step]=E_kin_rot
+
+            if 'dt' in self.PS.history:
+                if len(self.PS.history['dt'])>0:
+                    dt = self.PS.history['dt'][-1]
+            COM = body.position.copy()
+            attitude = body.attitude
+
+            body.step(dt, loads = (net_force, net_moment), spin = spin)
+            dx = np.hstack((body.position - COM,
+                            (body.attitude - attitude + 180)%360 - 180))
+            body.state[2] = COM[2] # Keep z constant to keep it in frame
+
+            self.PS.history['position'][step]=dx
+            self.PS.history['velocity'][step]=np.hstack((body.velocity,
+                                                        np.rad2deg(quaternion_to_matrix(body.quaternion).dot(body.angular_velocity))))
+            self.PS.history['dt'].append(dt)
+
+            if (printframes and step%printframes==0) or done:
+                current_time = time.time()
+                t = current_time - start_time
+                location = np.round((COM/length_scale)[:2],4)
+                angles = np.round(attitude,3)
+                print(f'{step=}, \tt={t//60:.0f}m {t%60:.2f}s, \t{abs_force=:.2g}, \t{dt=:.2g}, \t{location=} [D], \t{angles=} [deg], \t{E_kin_xy=:.2g}, \t{E_kin_rot=:.2g}'.replace('array',''))
+            # break if it flies off
+            if predictor is not None:
+                label = str(predictor.update(COM, attitude, self.params['t_steps'] - step))
+            dx_recent = np.sum(np.abs(self.PS.history['position'][step-10:step][:,:2]))
+            if step> min_steps and dx_recent<self.params['convergence_threshold']:
+                done= True
+                stable = True
+            elif (abs(COM[0])>= length_scale or abs(COM[1])>= length_scale
+                       or abs(attitude[0])>=5 or abs(attitude[1])>=5):
+                COM/=length_scale
+                print(f'Simulation halted: Lightsail broke perimiter {COM=} [D]')
+                done = True
+                stable = False
+            elif predictor is not None and label in ('stable', 'unstable'):
+                print(f'Simulation halted: predicted {label} with confidence {predictor.label_confidence:.4f}')
+                done = True
+                stable = label == 'stable'
+            elif step > self.params['t_steps']-1:
+                done = True
+                stable = False
+
+            step+= 1
+
+        body.orient_crystals()
+        body.materialize()
+        current_time = time.time()
+        delta_time = current_time - start_time
+        print(f'Converged in {delta_time//60:.0f}m {delta_time%60:.2f}s, {step} timesteps')
+        return stable
+
+    def simulate_rigid_ensemble(self,
+                                initial_conditions,
+                                printframes: int = 100,
+                                spin = True,
+                                gravity = False,
+                                damping = None,
+                                batch_size = None,
+                                early_stopping = None):
+        """
+        Runs rigid trajectories from many initial conditions at once
+
+        Equivalent to calling simulate_rigid_trajectory for every set of
+        initial conditions on the undeformed sail, but all trajectories are
+        advanced in lock-step and their optical forces evaluated as one batch.
+        The ParticleSystem is not moved.
+
+        Parameters
+        ----------
+        initial_conditions : npt.Arraylike
+            K x 2 x 6 array of initial conditions, see simulate_rigid_trajectory
+        printframes : int, optional
+            Print a mesage every nth step. The default is 100.
+        spin : bool
+            allows to run a trajectory simulation without rotation about z
+        gravity : bool
+            allows to enable gravitational force
+        damping : npt.ArrayLike
+            allows addition of damping forces to trajectory simulation. Should be length 6 array
+            representing damping in [x,y,z,rx,ry,rz]
+        batch_size : int, optional
+            maximum number of trajectories evaluated in one batch, see
+            RigidEnsemble. The default is None.
+        early_stopping : float, optional
+            confidence level at which members are retired on the prediction
+            of a DivergencePredictor, see RigidEnsemble.run. The default is None.
+
+        Returns
+        -------
+        stable : npt.NDArray
+            boolean array of length K
+        ensemble : RigidEnsemble
+            final states of the members and the number of steps they took
+
+        """
+        length_scale = np.ptp(self.PS.x_v_current_3D[0][:,0])
+        self.length_scale = length_scale
+
+        body = RigidBody(self.PS, self.FC, gravity = gravity, damping = damping,
+                         rotate_crystals = spin)
+        ensemble = RigidEnsemble.from_displacements(body, initial_conditions, batch_size)
+
+        start_time = time.time()
+        stable = ensemble.run(self.params['dt'],
+                              int(self.params['t_steps'])-1,
+                              length_scale,
+                              self.params['convergence_threshold'],
+                              min_steps = self.params['min_iterations'],
+                              spin = spin,
+                              printframes = printframes,
+                              early_stopping = early_stopping)
+        body.orient_crystals()
+        delta_time = time.time() - start_time
+        print(f'Ensemble of {len(stable)} done in {delta_time//60:.0f}m {delta_time%60:.2f}s, '
+              f'{np.sum(stable)} stable')
+        return stable, ensemble
+
+    def map_stability_basin(self,
+                            bounds,
+                            symmetry = (),
+                            max_depth = 6,
+                            initial_depth = 2,
+                            path = None,
+                            **kwargs):
+        """
+        Maps which initial x, y offsets converge with an adaptive quadtree
+
+        Cells are refined only where their corners disagree on stability, and
+        every level is run as one simulate_rigid_ensemble. See BasinMap.
+
+        Parameters
+        ----------
+        bounds : npt.ArrayLike
+            [[x_min, x_max], [y_min, y_max]] of the initial offsets. [m]
+        symmetry : list
+            symmetries of the stability around the undisplaced sail, e.g.
+            ['C4'] for a square sail in a round beam, see BasinMap
+        max_depth : int
+            number of halvings of the region. The default is 6.
+        initial_depth : int
+            depth up to which all cells are refined. The default is 2.
+        path : str
+            .npz file the map is saved to after every level. An existing map
+            at path is resumed instead. The default is None.
+        **kwargs
+            passed to simulate_rigid_ensemble, e.g. spin, gravity, damping,
+            batch_size and early_stopping
+
+        Returns
+        -------
+        basin : BasinMap
+            see BasinMap.grid and BasinMap.lattice for plotting
+
+        """
+        def classify(points):
+            initial_conditions = np.zeros((len(points), 2, 6))
+            initial_conditions[:,0,:2] = points
+            stable, _ = self.simulate_rigid_ensemble(initial_conditions, **kwargs)
+            return stable
+
+        if path is None:
+            basin = BasinMap(classify, bounds, symmetry, max_depth, initial_depth)
+        else:
+            basin = BasinMap.resume(path, classify, bounds, symmetry, max_depth, initial_depth)
+        basin.refine()
+        print(f'{basin}, a uniform grid takes {(basin.n+1)**2} points')
+        return basin
+
+    def analyse_linear_stability(self,
+                                 spin = False,
+                                 damping = None,
+                                 displacement_range = [0.1, 5],
+                                 compliance = False):
+        """
+        Classifies the local stability of the current pose without running trajectories
+
+        Linearises the rigid-body motion around the current pose, see
+        LinearStability. The ParticleSystem is not moved.
+
+        Parameters
+        ----------
+        spin : bool
+            includes the rotation about z in the analysis
+        damping : npt.ArrayLike
+            damping in [x,y,z,rx,ry,rz], as in simulate_trajectory
+        displacement_range : list
+            lateral displacement in meters and tilt angle in degrees of the
+            probes of the optical stiffness. The default is [0.1, 5].
+        compliance : bool
+            also analyses the stiffness including the quasi-static deformation
+            of the sail. The default is False.
+
+        Returns
+        -------
+        analysis : dict
+            classification, growth rates and frequencies of the modes, see
+            LinearStability.eigen_analysis
+
+        """
+        analysis = LinearStability(self.PS, self.FC, damping, spin).analyse(displacement_range,
+                                                                          compliance = compliance)
+        logging.info(f"Linear stability: {analysis['classification']}, "
+                     f"max growth rate {analysis['growth_rates'][0]:.3g} 1/s")
+        return analysis
+
+    def __integrate_rigid_trajectory(self, body, step, dt, spin, ode_method):
+        """Adaptive integration of simulate_rigid_trajectory, returns the stability verdict"""
+        length_scale = self.length_scale
+        t_steps = int(self.params['t_steps'])
+        t_min = self.params['min_iterations']*dt
+        speed_threshold = self.params['convergence_threshold']/(10*dt)
+        events = [perimeter_event(length_scale), attitude_event(5)]
+
+        # Convergence is first checked at t_min, as the solver may step over it
+        solution = body.integrate(t_min, events, method = ode_method, spin = spin)
+        times, states = solution.t, solution.y.T
+        nfev = solution.nfev
+        t_events = [len(t) > 0 for t in solution.t_events] + [False]
+        if solution.status == 0:
+            if np.sum(np.abs(body.velocity[:2])) < speed_threshold:
+                t_events[2] = True
+            else:
+                events.append(convergence_event(speed_threshold))
+                solution = body.integrate((t_steps-1-step)*dt, events, t_start = t_min,
+                                          method = ode_method, spin = spin)
+                times = np.hstack((times, solution.t[1:]))
+                states = np.vstack((states, solution.y.T[1:]))
+                nfev += solution.nfev
+                t_events = [len(t) > 0 for t in solution.t_events]
+
+        # Accepted steps are stored like the fixed steps, thinned out if there are too many
+        if len(times) > t_steps-step:
+            keep = np.unique(np.linspace(0, len(times)-1, t_steps-step).astype(int))
+            times, states = times[keep], states[keep]
+        n = len(times)-1
+        attitudes = quaternion_to_euler(states[:,3:7])
+        rotations = quaternion_to_matrix(states[1:,3:7])
+        self.PS.history['position'][step:step+n,:3] = np.diff(states[:,:3], axis=0)
+        self.PS.history['position'][step:step+n,3:] = (np.diff(attitudes, axis=0) + 180)%360 - 180
+        self.PS.history['velocity'][step:step+n,:3] = states[1:,7:10]
+        self.PS.history['velocity'][step:step+n,3:] = np.rad2deg(np.einsum('nij,nj->ni', rotations, states[1:,10:13]))
+        self.PS.history['E_kin_xy'][step:step+n] = 1/2 * body.mass * np.sum(states[1:,7:9]**2, axis=1)
+        self.PS.history['E_kin_rot'][step:step+n] = body.kinetic_energy(states[1:])[1]
+        self.PS.history['dt'].extend(np.diff(times))
+
+        logging.info(f'Rigid trajectory integrated with {nfev} load evaluations, '
+                     f'{len(times)-1} steps')
+        perimeter, attitude, converged = t_events
+        if perimeter or attitude:
+            COM = body.position/length_scale
+            print(f'Simulation halted: Lightsail broke perimiter {COM=} [D]')
+        return converged
+
+    def __init_trajectory_history(self):
+        """Allocates the history arrays of simulate_trajectory"""
+        keys_1d = ['abs_force', "E_kin_xy", "E_kin_rot", 'load_change', 'shape_residual']
+        for key in keys_1d:
+            if not key in self.PS.history.keys() or len(self.PS.history[key]) != int(self.params['t_steps']):
+                self.PS.history[key] = np.zeros(int(self.params['t_steps']))
+
+        keys_2d = ['net_force', 'net_moment', 'lin_accel', 'rot_accel']
+        for key in keys_2d:
+            if not key in self.PS.history.keys() or len(self.PS.history[key]) != int(self.params['t_steps']):
+                self.PS.history[key] = np.zeros((int(self.params['t_steps']),3))
+        keys_6d = ['position', 'velocity']
+        for key in keys_6d:
+            if not key in self.PS.history.keys() or len(self.PS.history[key]) != int(self.params['t_steps']):
+                self.PS.history[key] = np.zeros((int(self.params['t_steps']),6))
+
+    def __plot_trajectory_frame(self, fig, f, net_force, net_moment, COM, zlim,
+                                plot_angles, plot_forces, plot_net_force,
+                                arrow_length, spin, file_id, step):
+        """Saves a frame of simulate_trajectory, returns the updated z limit"""
+        length_scale = self.length_scale
+        fig.clear()
+        ax = fig.add_subplot(projection='3d')
+        if plot_forces:
+            self.PS.plot_forces(f,ax, length = arrow_length)
+        else:
+            self.PS.plot(ax)
+        ax.elev = plot_angles[0]
+        ax.azim = plot_angles[1]
+        if plot_net_force:
+            if not spin:
+                net_moment[2] =0
+            ax.quiver(COM[0],COM[1],COM[2],
+                      net_force[0],net_force[1],net_force[2],
+                      length = arrow_length/2e2, label ='Net Force', color='r')
+            ax.quiver(COM[0],COM[1],COM[2],
+                      net_moment[0],net_moment[1],net_moment[2],
+                      length = arrow_length*5e2, label ='Net Moment', color='magenta')
+            ax.legend()
+
+        x,_ = self.PS.x_v_current_3D
+        z = x[:,2]
+
+        zlim = np.max([z.max(),zlim])
+        ax.set_zlim(0,zlim)
+        plot_scale=1
+        ax.set_xlim([-length_scale*plot_scale,length_scale*plot_scale])
+        ax.set_ylim([-length_scale*plot_scale,length_scale*plot_scale])
+        t = np.sum(self.PS.history['dt'])
+        ax.set_title(f"Simulate Lightsail, t = {t:.5f}")
+        ax.set_aspect('equal')
+
+        fig.tight_layout()
+        fig.savefig(f'temp\Lightsail{file_id}{step}.jpg', dpi = 300, format = 'jpg')
+        return zlim
+
     def plot_flight_hist(self, energy = False, pos_offset = [0,0]):
         length_scale = self.length_scale
         time_history = np.cumsum(self.PS.history['dt'], axis=0)
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Linearised stability analysis of a lightsail around its current pose
+
+The optical stiffness from calculate_stability_coefficients, the damping, the
+mass and the inertia tensor are combined into the state matrix of the rigid
+body. Its eigenvalues classify the equilibrium, with the real parts as growth
+rates and the imaginary parts as angular frequencies of the modes.
+
+DivergencePredictor classifies running trajectories from the growth of their
+deviation, so doomed trajectories can be stopped early.
+"""
+import logging
+
+import numpy as np
+import numpy.typing as npt
+from scipy import stats
+import scipy.sparse as sps
+from scipy.sparse.linalg import splu
+
+from ..particleSystem.ForcePipeline import GeometryCache
+
+
+def state_matrix(stiffness: npt.ArrayLike,
+                 mass_matrix: npt.ArrayLike,
+                 damping: npt.ArrayLike = None) -> npt.NDArray:
+    """
+    First order state matrix of M q'' = K q + D q'
+
+    Parameters
+    ----------
+    stiffness : npt.ArrayLike
+        d x d derivative of the loads w.r.t. the displacements, K
+    mass_matrix : npt.ArrayLike
+        d x d mass matrix, M
+    damping : npt.ArrayLike, optional
+        length d array of damping coefficients, or d x d matrix, D. Negative
+        values dissipate energy, as they are added to the loads. The default
+        is None, which is undamped.
+
+    Returns
+    -------
+    A : npt.NDArray
+        2d x 2d matrix such that [q, q']' = A [q, q']
+    """
+    stiffness = np.asarray(stiffness, dtype=np.float64)
+    d = len(stiffness)
+    if damping is None:
+        damping = np.zeros((d, d))
+    damping = np.asarray(damping, dtype=np.float64)
+    if damping.ndim == 1:
+        damping = np.diag(damping)
+
+    inverse_mass = np.linalg.inv(mass_matrix)
+    A = np.zeros((2*d, 2*d))
+    A[:d, d:] = np.identity(d)
+    A[d:, :d] = inverse_mass.dot(stiffness)
+    A[d:, d:] = inverse_mass.dot(damping)
+    return A
+
+
+def classify_eigenvalues(eigenvalues: npt.ArrayLike, tolerance: float = 1e-6) -> str:
+    """
+    Classifies an equilibrium by the eigenvalues of its state matrix
+
+    Parameters
+    ----------
+    eigenvalues : npt.ArrayLike
+        eigenvalues of the state matrix
+    tolerance : float, optional
+        growth rates within tolerance times the largest eigenvalue magnitude
+        are considered zero. The default is 1e-6.
+
+    Returns
+    -------
+    classification : str
+        'stable' if all modes decay, 'unstable' if any mode grows and
+        'marginal' otherwise, e.g. for undamped oscillations.
+    """
+    eigenvalues = np.asarray(eigenvalues)
+    threshold = tolerance*np.max(np.abs(eigenvalues), initial=0)
+    growth = np.max(eigenvalues.real)
+    if growth > threshold:
+        return 'unstable'
+    if growth < -threshold:
+        return 'stable'
+    return 'marginal'
+
+
+class LinearStability:
+    """
+    Eigen-analysis of the rigid-body motion of a lightsail around its current pose
+
+    The displacements are [x, y, z, rx, ry, rz] in meters and radians, with
+    the rotations around the centre of mass. As in simulate_trajectory the
+    z displacement, along which the sail is propelled, is not part of the
+    analysis, and neither is the spin rz unless requested.
+    """
+    def __init__(self,
+                 ParticleSystem,
+                 ForceCalculator,
+                 damping: npt.ArrayLike = None,
+                 spin: bool = False):
+        """
+        Parameters
+        ----------
+        ParticleSystem : ParticleSystem
+            sail in the pose to analyse
+        ForceCalculator : OpticalForceCalculator
+            calculator providing calculate_stability_coefficients
+        damping : npt.ArrayLike, optional
+            length 6 array of damping coefficients for [x, y, z, rx, ry, rz],
+            added to the loads as damping*velocity with the angular velocity
+            in deg/s, as in simulate_trajectory. The rotational terms are
+            converted to rad/s for the state matrix. The default is None.
+        spin : bool, optional
+            Includes the rotation around z in the analysis. The default is False.
+        """
+        self.ParticleSystem = ParticleSystem
+        self.ForceCalculator = ForceCalculator
+        self.damping = np.zeros(6) if damping is None else np.array(damping, dtype=np.float64)
+        self.damping[3:] = np.rad2deg(self.damping[3:])
+        self.dofs = [0, 1, 3, 4, 5] if spin else [0, 1, 3, 4]
+
+        cache = GeometryCache(ParticleSystem)
+        self.masses = np.array(cache.masses, dtype=np.float64)
+        self.arms = cache.locations - cache.center_of_mass
+
+        r = self.arms
+        inertia = (np.sum(self.masses*np.sum(r*r, axis=1))*np.identity(3)
+                   - np.einsum('i,ij,ik->jk', self.masses, r, r))
+        self.mass_matrix = np.zeros((6, 6))
+        self.mass_matrix[:3, :3] = np.sum(self.masses)*np.identity(3)
+        self.mass_matrix[3:, 3:] = inertia
+
+    def rigid_stiffness(self,
+                        displacement_range: list = [0.1, 5],
+                        central_differences: bool = True) -> npt.NDArray:
+        """
+        Optical stiffness of the undeformed sail
+
+        Parameters
+        ----------
+        displacement_range : list, optional
+            lateral displacement in meters and tilt angle in degrees of the
+            probes, see calculate_stability_coefficients. The default is [0.1, 5].
+        central_differences : bool, optional
+            Probes in both directions of every displacement. The default is
+            True, as the forward differences are biased by the curvature of
+            the reaction over the large default probes.
+
+        Returns
+        -------
+        stiffness : npt.NDArray
+            6x6 derivative of [F_x, F_y, F_z, M_x, M_y, M_z] w.r.t. the
+            displacements in meters and radians
+        """
+        stiffness = np.array(self.ForceCalculator.calculate_stability_coefficients(displacement_range,
+                                                                                   central_differences),
+                             dtype=np.float64)
+        stiffness[:, 3:] = np.rad2deg(stiffness[:, 3:])
+        return stiffness
+
+    def compliance_stiffness(self) -> npt.NDArray:
+        """
+        Change of the optical stiffness due to the quasi-static deformation of the sail
+
+        A rigid displacement changes the nodal optical forces by J G q, with
+        J the optical force_jacobian and G the nodal motion of the rigid
+        displacements. The part of this change that does not accelerate the
+        sail as a rigid body deforms it by u, found from (K_s + J) u = -f,
+        with K_s the structural stiffness of the ParticleSystem. The
+        deformation is taken orthogonal to the rigid motions, which are
+        handled by the rigid-body modes. The net loads of J u are returned.
+
+        Both are found at once from the sparse saddle point system
+
+            [ K_s + J  M G ] [ u      ]   [ -J G ]
+            [ G^T M     0  ] [ lambda ] = [   0  ]
+
+        whose multipliers lambda are the rigid-body accelerations, i.e. the
+        inertia relief. It is factorised once for the 6 right hand sides.
+
+        The structural stiffness only has out of plane terms for a prestressed
+        sail, see ParticleSystem.stress_self.
+
+        Returns
+        -------
+        stiffness : npt.NDArray
+            6x6 correction to rigid_stiffness, in the same units
+        """
+        n = len(self.masses)
+        G = np.zeros((n, 3, 6))
+        G[:, :, :3] = np.identity(3)
+        for k in range(3):
+            G[:, :, 3+k] = np.cross(np.identity(3)[k], self.arms)
+        G = G.reshape(3*n, 6)
+        MG = sps.csr_matrix(np.repeat(self.masses, 3)[:, np.newaxis]*G)
+
+        optical_jacobian = sps.csr_matrix(self.ForceCalculator.force_jacobian())
+        force_change = optical_jacobian.dot(G)
+
+        system = sps.bmat([[self.ParticleSystem.stiffness_m + optical_jacobian, MG],
+                           [MG.T, None]], format='csc')
+        rhs = np.vstack((-force_change, np.zeros((6, 6))))
+        deformation = splu(system).solve(rhs)[:3*n]
+        return G.T.dot(optical_jacobian.dot(deformation))
+
+    def eigen_analysis(self, stiffness: npt.ArrayLike, tolerance: float = 1e-6) -> dict:
+        """
+        Eigenvalues of the state matrix built from a 6x6 stiffness
+
+        Parameters
+        ----------
+        stiffness : npt.ArrayLike
+            6x6 stiffness in meters and radians, see rigid_stiffness
+        tolerance : float, optional
+            relative tolerance on the growth rates, see classify_eigenvalues.
+            The default is 1e-6.
+
+        Returns
+        -------
+        analysis : dict
+            'classification' : 'stable', 'marginal' or 'unstable'
+            'eigenvalues' : eigenvalues of the state matrix, sorted by
+            descending growth rate [1/s]
+            'growth_rates' : real parts of the eigenvalues [1/s]
+            'frequencies' : oscillation frequencies of the modes [Hz]
+            'modes' : displacement part of the eigenvectors, one column per
+            eigenvalue, rows ordered as dofs
+            'dofs' : indices of the analysed displacements in [x, y, z, rx, ry, rz]
+            'stiffness', 'state_matrix' : the matrices used
+        """
+        stiffness = np.asarray(stiffness, dtype=np.float64)
+        dofs = np.ix_(self.dofs, self.dofs)
+        A = state_matrix(stiffness[dofs], self.mass_matrix[dofs], np.diag(self.damping)[dofs])
+
+        eigenvalues, eigenvectors = np.linalg.eig(A)
+        order = np.lexsort((eigenvalues.imag, -eigenvalues.real))
+        eigenvalues = eigenvalues[order]
+        eigenvectors = eigenvectors[:, order]
+
+        return {'classification': classify_eigenvalues(eigenvalues, tolerance),
+                'eigenvalues': eigenvalues,
+                'growth_rates': eigenvalues.real,
+                'frequencies': np.abs(eigenvalues.imag)/(2*np.pi),
+                'modes': eigenvectors[:len(self.dofs)],
+                'dofs': list(self.dofs),
+                'stiffness': stiffness,
+                'state_matrix': A}
+
+    def analyse(self,
+                displacement_range: list = [0.1, 5],
+                central_differences: bool = True,
+                compliance: bool = False,
+                tolerance: float = 1e-6) -> dict:
+        """
+        Classifies the stability of the current pose from one eigen-solve
+
+        Parameters
+        ----------
+        displacement_range : list, optional
+            probe sizes of the optical stiffness, see rigid_stiffness.
+            The default is [0.1, 5].
+        central_differences : bool, optional
+            see rigid_stiffness. The default is True.
+        compliance : bool, optional
+            Also analyses the stiffness including the quasi-static deformation
+            of the sail, see compliance_stiffness. The result is stored under
+            'compliant'. The default is False.
+        tolerance : float, optional
+            see classify_eigenvalues. The default is 1e-6.
+
+        Returns
+        -------
+        analysis : dict
+            see eigen_analysis
+        """
+        stiffness = self.rigid_stiffness(displacement_range, central_differences)
+        analysis = self.eigen_analysis(stiffness, tolerance)
+
+        if compliance:
+            analysis['compliant'] = self.eigen_analysis(stiffness + self.compliance_stiffness(),
+                                                        tolerance)
+            if analysis['compliant']['classification'] != analysis['classification']:
+                logging.warning(f"Structural compliance changes the classification from "
+                                f"{analysis['classification']} to "
+                                f"{analysis['compliant']['classification']}")
+        return analysis
+
+
+class DivergencePredictor:
+    """
+    Online classifier of trajectories from the growth of their deviation
+
+    The deviation of a member is the largest of its x, y offsets from the
+    equilibrium as a fraction of the distance to the perimeter and its x, y
+    angles as a fraction of the attitude limit, so the trajectory criteria
+    are broken at a deviation of one. The maximum deviation in blocks of
+    steps removes oscillations, and a line is fitted through the logarithm
+    of the last n_blocks maxima. Its slope is the growth rate per step.
+
+    A member is labelled 'unstable' when the growth rate is positive with the
+    requested confidence and the slowest growth within that confidence
+    reaches the perimeter in the remaining steps. It is labelled 'stable'
+    when the slowest decay within that confidence brings the deviation down
+    to settled in the remaining steps. Other members, e.g. undamped
+    oscillations, are 'borderline' and are left to the time-domain criteria,
+    '' before the first fit. All members are updated in lock-step.
+    """
+    def __init__(self,
+                 reference: npt.ArrayLike,
+                 length_scale: float,
+                 attitude_limit: float = 5,
+                 confidence: float = 0.99,
+                 block_size: int = 20,
+                 n_blocks: int = 10,
+                 settled: float = 1e-6):
+        """
+        Parameters
+        ----------
+        reference : npt.ArrayLike
+            x, y position of the equilibrium, shape (2,) for a single
+            trajectory or (K, 2) for an ensemble. [m]
+        length_scale : float
+            half width of the perimeter. [m]
+        attitude_limit : float, optional
+            limit of the x and y angles. The default is 5. [deg]
+        confidence : float, optional
+            one-sided confidence level of the labels. The default is 0.99.
+        block_size : int, optional
+            number of steps per block. The default is 20.
+        n_blocks : int, optional
+            number of blocks in the fit, at least 3. The default is 10.
+        settled : float, optional
+            deviation below which a decaying member counts as converged.
+            The default is 1e-6.
+        """
+        if n_blocks < 3:
+            raise AttributeError(f"DivergencePredictor requires n_blocks >= 3, got {n_blocks}")
+        self.reference = np.asarray(reference, dtype=np.float64)
+        self.margin = np.maximum(length_scale - np.abs(self.reference), np.finfo(np.float64).tiny)
+        self.attitude_limit = attitude_limit
+        self.confidence = confidence
+        self.block_size = block_size
+        self.n_blocks = n_blocks
+        self.settled = settled
+        self.critical_value = stats.t.ppf(confidence, n_blocks - 2)
+
+        shape = self.reference.shape[:-1]
+        self.block_maxima = np.zeros(shape + (0,))
+        self.current_maximum = np.zeros(shape)
+        self.count = 0
+        self.labels = np.full(shape, '', dtype='<U10')
+        self.probability = np.zeros(shape)
+        self.growth_rate = np.full(shape, np.nan)
+        self.breach_steps = np.full(shape, np.inf)
+        self.settle_steps = np.full(shape, np.inf)
+
+    def deviation(self, position: npt.ArrayLike, attitude: npt.ArrayLike) -> npt.NDArray:
+        """Fraction of the way to the perimeter or attitude limit, per member"""
+        position = np.asarray(position)[..., :2]
+        attitude = np.asarray(attitude)[..., :2]
+        return np.maximum(np.max(np.abs(position - self.reference)/self.margin, axis=-1),
+                          np.max(np.abs(attitude), axis=-1)/self.attitude_limit)
+
+    def update(self,
+               position: npt.ArrayLike,
+               attitude: npt.ArrayLike,
+               steps_left: float = np.inf) -> npt.NDArray:
+        """
+        Adds one step of all members and refits at the end of every block
+
+        Parameters
+        ----------
+        position : npt.ArrayLike
+            position of the center of mass, shape (..., 2) or (..., 3). [m]
+        attitude : npt.ArrayLike
+            x, y and z angles, shape (..., 2) or (..., 3). [deg]
+        steps_left : float, optional
+            number of remaining steps of the trajectory. The default is inf.
+
+        Returns
+        -------
+        labels : npt.NDArray
+            current labels of the members, see DivergencePredictor
+        """
+        self.current_maximum = np.maximum(self.current_maximum, self.deviation(position, attitude))
+        self.count += 1
+        if self.count%self.block_size == 0:
+            self.block_maxima = np.concatenate((self.block_maxima[..., 1-self.n_blocks:],
+                                                self.current_maximum[..., np.newaxis]), axis=-1)
+            self.current_maximum = np.zeros_like(self.current_maximum)
+            if self.block_maxima.shape[-1] == self.n_blocks:
+                self.classify(steps_left)
+        return self.labels
+
+    def classify(self, steps_left: float = np.inf):
+        """Fits the growth rates of the last n_blocks and updates the labels"""
+        tiny = np.finfo(np.float64).tiny
+        y = np.log(np.maximum(self.block_maxima, tiny))
+        x = np.arange(self.n_blocks)*self.block_size
+        x = x - np.mean(x)
+
+        slope = np.sum(x*y, axis=-1)/np.sum(x*x)
+        residuals = y - np.mean(y, axis=-1, keepdims=True) - slope[..., np.newaxis]*x
+        standard_error = np.sqrt(np.sum(residuals**2, axis=-1)/(self.n_blocks - 2)/np.sum(x*x))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistic = np.where(standard_error > 0, slope/standard_error, np.sign(slope)*np.inf)
+        self.probability = stats.t.cdf(statistic, self.n_blocks - 2)
+        self.growth_rate = slope
+
+        lower = slope - self.critical_value*standard_error
+        upper = slope + self.critical_value*standard_error
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.breach_steps = np.where(lower > 0, np.maximum(-y[..., -1], 0)/lower, np.inf)
+            self.settle_steps = np.where(upper < 0,
+                                         np.maximum(y[..., -1] - np.log(self.settled), 0)/-upper,
+                                         np.inf)
+
+        decided = self.block_maxima[..., -1] > tiny
+        self.labels = np.where(decided, 'borderline', '').astype('<U10')
+        self.labels[decided & (lower > 0) & (self.breach_steps <= steps_left)] = 'unstable'
+        self.labels[decided & (upper < 0) & (self.settle_steps <= steps_left)] = 'stable'
+
+    @property
+    def label_confidence(self) -> npt.NDArray:
+        """Probability of growth for unstable members, of decay otherwise"""
+        return np.where(self.labels == 'unstable', self.probability, 1 - self.probability)
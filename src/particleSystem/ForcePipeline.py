@@ -0,0 +1,330 @@
+"""
+Child Class 'ForcePipeline', for combining external force components of a ParticleSystem
+"""
+import numpy as np
+import numpy.typing as npt
+from scipy.spatial.transform import Rotation
+
+from .Force import Force
+
+
+class GeometryCache:
+    """
+    Per-step cache of the geometry of a ParticleSystem
+
+    Every quantity is computed on first access and shared by all force
+    components evaluated in the same step. The arrays are read-only, so a
+    component can not accidentally modify the input of the next one.
+
+    Attributes
+    ----------
+    locations : npt.NDArray
+        n_particles x 3 array of node locations
+    velocities : npt.NDArray
+        n_particles x 3 array of node velocities
+    area_vectors : npt.NDArray
+        n_particles x 3 array of area vectors from ParticleSystem.find_surface
+    center_of_mass : npt.NDArray
+        location of the center of mass, including ParticleSystem.COM_offset
+    masses : npt.NDArray
+        mass of every node
+    """
+    def __init__(self, ParticleSystem):
+        self.ParticleSystem = ParticleSystem
+        self.__values = {}
+
+    def __get(self, key, function):
+        if key not in self.__values:
+            value = np.asarray(function())
+            value.setflags(write = False)
+            self.__values[key] = value
+        return self.__values[key]
+
+    def __x_v(self):
+        x, v = self.ParticleSystem.x_v_current_3D
+        x.setflags(write = False)
+        v.setflags(write = False)
+        self.__values['locations'] = x
+        self.__values['velocities'] = v
+
+    @property
+    def locations(self):
+        if 'locations' not in self.__values:
+            self.__x_v()
+        return self.__values['locations']
+
+    @property
+    def velocities(self):
+        if 'velocities' not in self.__values:
+            self.__x_v()
+        return self.__values['velocities']
+
+    @property
+    def area_vectors(self):
+        return self.__get('area_vectors', lambda: np.nan_to_num(self.ParticleSystem.find_surface()))
+
+    @property
+    def center_of_mass(self):
+        return self.__get('center_of_mass', self.ParticleSystem.calculate_center_of_mass)
+
+    @property
+    def masses(self):
+        return self.__get('masses', lambda: [p.m for p in self.ParticleSystem.particles])
+
+    def pose(self, displacement: npt.ArrayLike) -> 'GeometrySnapshot':
+        """
+        Returns a rigidly displaced copy of the geometry, without moving the ParticleSystem
+
+        Parameters
+        ----------
+        displacement : npt.ArrayLike
+            x, y, z translation in meters and rotations around the x, y and z
+            axes through the center of mass in degrees, with the same
+            convention as ParticleSystem.displace
+
+        Returns
+        -------
+        snapshot : GeometrySnapshot
+            displaced geometry, usable in place of a GeometryCache
+        """
+        displacement = np.asarray(displacement, dtype=np.float64)
+        if displacement.shape != (6,):
+            raise AttributeError("Expected list of 6 arguments representing "
+                                 f"x,y,z,rx,ry,rz, got shape {displacement.shape} instead")
+
+        rotation = Rotation.from_euler('xyz', displacement[3:], degrees=True).as_matrix()
+        center_of_mass = self.center_of_mass + displacement[:3]
+        return GeometrySnapshot(locations = (self.locations-self.center_of_mass).dot(rotation.T) + center_of_mass,
+                                velocities = self.velocities.dot(rotation.T),
+                                area_vectors = self.area_vectors.dot(rotation.T),
+                                center_of_mass = center_of_mass,
+                                masses = self.masses)
+
+    def pose_batch(self, displacements: npt.ArrayLike) -> 'GeometrySnapshot':
+        """
+        Returns K rigidly displaced copies of the geometry at once
+
+        Same transform as pose, broadcast over all displacements, so the
+        locations, velocities and area vectors of the snapshot get a leading
+        axis of length K and its center_of_mass becomes a K x 3 array.
+
+        Parameters
+        ----------
+        displacements : npt.ArrayLike
+            K x 6 array of displacements [x, y, z, rx, ry, rz], see pose
+
+        Returns
+        -------
+        snapshot : GeometrySnapshot
+            displaced geometries stacked along the first axis
+        """
+        displacements = np.array(displacements, dtype=np.float64, ndmin=2)
+        if displacements.ndim != 2 or displacements.shape[1] != 6:
+            raise AttributeError("Expected K x 6 array of displacements representing "
+                                 f"x,y,z,rx,ry,rz, got shape {displacements.shape} instead")
+
+        rotations = Rotation.from_euler('xyz', displacements[:,3:], degrees=True).as_matrix()
+        center_of_mass = self.center_of_mass + displacements[:,:3]
+        rotate = lambda vectors: np.einsum('kij,nj->kni', rotations, vectors)
+        return GeometrySnapshot(locations = rotate(self.locations-self.center_of_mass) + center_of_mass[:,np.newaxis],
+                                velocities = rotate(self.velocities),
+                                area_vectors = rotate(self.area_vectors),
+                                center_of_mass = center_of_mass,
+                                masses = self.masses)
+
+
+class GeometrySnapshot:
+    """
+    Fixed geometry with the same attributes as a GeometryCache
+
+    Used to evaluate force components on a state other than the current
+    state of the ParticleSystem, e.g. the rigidly posed copies made by
+    GeometryCache.pose, or a stack of them made by GeometryCache.pose_batch.
+    """
+    def __init__(self, locations, velocities, area_vectors, center_of_mass, masses):
+        self.locations = np.array(locations, dtype=np.float64)
+        self.velocities = np.array(velocities, dtype=np.float64)
+        self.area_vectors = np.array(area_vectors, dtype=np.float64)
+        self.center_of_mass = np.array(center_of_mass, dtype=np.float64)
+        self.masses = np.array(masses, dtype=np.float64)
+        for value in vars(self).values():
+            value.setflags(write = False)
+
+    def unstack(self) -> list:
+        """Splits a stack of poses from GeometryCache.pose_batch into one snapshot per pose"""
+        return [GeometrySnapshot(*values, self.masses)
+                for values in zip(self.locations, self.velocities, self.area_vectors, self.center_of_mass)]
+
+
+class ForcePipeline(Force):
+    """
+    Chains external force components and sums their contributions
+
+    A component is any object with a force_value(cache) method returning an
+    n_particles x 3 array, e.g. GravityForce, PressureForce, DragForce,
+    CallableForce or an OpticalForceCalculator. All components of one call
+    to force_value share a single GeometryCache.
+    """
+    def __init__(self, ParticleSystem, components: list = ()):
+        """
+        Parameters
+        ----------
+        ParticleSystem : ParticleSystem
+            system the forces act on
+        components : list, optional
+            initial force components. The default is ().
+        """
+        self.ParticleSystem = ParticleSystem
+        self.components = list(components)
+        self.cache = None
+        super().__init__()
+
+    def __str__(self):
+        print("ForcePipeline object instantiated with components:")
+        for component in self.components:
+            print(f"{type(component).__name__}")
+        return ""
+
+    def add(self, component):
+        """Appends a force component and returns it"""
+        self.components.append(component)
+        return component
+
+    def remove(self, component):
+        """Removes a force component"""
+        self.components.remove(component)
+
+    def new_step(self) -> GeometryCache:
+        """Discards the cached geometry of the previous step"""
+        self.cache = GeometryCache(self.ParticleSystem)
+        return self.cache
+
+    def force_value(self) -> npt.NDArray:
+        """
+        Calculates the sum of the forces of all components for the current state
+
+        Returns
+        -------
+        forces : npt.NDArray
+            n_particles x 3 array of external forces. Use .ravel() to pass
+            them to ParticleSystem.simulate.
+        """
+        cache = self.new_step()
+        forces = np.zeros((self.ParticleSystem.n, 3))
+        for component in self.components:
+            forces += np.reshape(component.force_value(cache), (-1, 3))
+        return forces
+
+    def calculate_restoring_forces(self, forces: npt.ArrayLike = None):
+        """
+        calculates net forces and moments around the center of mass
+
+        Parameters
+        ----------
+        forces : npt.Arraylike
+            Allows inputting the forces directly, but is calculated automatically when ommitted.
+
+        Returns
+        -------
+        net_force : npt.ArrayLike
+            Net force on center of mass.
+        net_moments : npt.ArrayLike
+            Net moments around center of mass.
+        """
+        if forces is None:
+            forces = self.force_value()
+        forces = np.reshape(forces, (-1, 3))
+
+        cache = GeometryCache(self.ParticleSystem)
+        moment_arms = cache.locations - cache.center_of_mass
+        return np.sum(forces, axis=0), np.sum(np.cross(moment_arms, forces), axis=0)
+
+
+class GravityForce(Force):
+    """Weight of every node"""
+    def __init__(self, g: float = 9.80665, direction: npt.ArrayLike = (0, 0, -1)):
+        """
+        Parameters
+        ----------
+        g : float, optional
+            gravitational acceleration. The default is 9.80665. [m/s^2]
+        direction : npt.ArrayLike, optional
+            direction of gravity. The default is (0, 0, -1).
+        """
+        self.g = g
+        self.direction = np.asarray(direction, dtype=np.float64)
+        super().__init__()
+
+    def force_value(self, cache: GeometryCache) -> npt.NDArray:
+        return np.outer(cache.masses*self.g, self.direction)
+
+
+class PressureForce(Force):
+    """Uniform pressure acting on the area vectors of the nodes"""
+    def __init__(self, pressure: float):
+        """
+        Parameters
+        ----------
+        pressure : float
+            pressure on the side the area vectors point away from. [Pa]
+        """
+        self.pressure = pressure
+        super().__init__()
+
+    def force_value(self, cache: GeometryCache) -> npt.NDArray:
+        return cache.area_vectors*self.pressure
+
+
+class DragForce(Force):
+    """Quadratic drag of a flow, F = 1/2 rho c_d A |v_app| v_app on every node"""
+    def __init__(self,
+                 flow_velocity: npt.ArrayLike,
+                 density: float = 1.225,
+                 drag_coefficient: float = 1,
+                 reference_area: npt.ArrayLike = None):
+        """
+        Parameters
+        ----------
+        flow_velocity : npt.ArrayLike
+            velocity of the undisturbed flow, length 3 or n_particles x 3. [m/s]
+        density : float, optional
+            density of the flow. The default is 1.225. [kg/m^3]
+        drag_coefficient : float, optional
+            The default is 1. [-]
+        reference_area : npt.ArrayLike, optional
+            area of every node, scalar or length n_particles. The default is
+            None, which uses the area vectors projected on the apparent flow. [m^2]
+        """
+        self.flow_velocity = np.asarray(flow_velocity, dtype=np.float64)
+        self.density = density
+        self.drag_coefficient = drag_coefficient
+        self.reference_area = reference_area
+        super().__init__()
+
+    def force_value(self, cache: GeometryCache) -> npt.NDArray:
+        apparent_velocity = self.flow_velocity - cache.velocities
+        speed = np.linalg.norm(apparent_velocity, axis=1)
+
+        if self.reference_area is None:
+            area = np.abs(np.einsum('ij,ij->i', cache.area_vectors, apparent_velocity))
+            area /= np.where(speed>0, speed, 1)
+        else:
+            area = self.reference_area
+
+        return (0.5*self.density*self.drag_coefficient*area*speed)[:,np.newaxis]*apparent_velocity
+
+
+class CallableForce(Force):
+    """User defined force component"""
+    def __init__(self, function):
+        """
+        Parameters
+        ----------
+        function : Callable[[GeometryCache], npt.NDArray]
+            maps the geometry of the current step to an n_particles x 3 array of forces
+        """
+        self.function = function
+        super().__init__()
+
+    def force_value(self, cache: GeometryCache) -> npt.NDArray:
+        return self.function(cache)
@@ -0,0 +1,221 @@
+"""
+Child Class 'OpticalPropertyTable', columnar storage of the optical properties of a ParticleSystem
+"""
+import numpy as np
+import numpy.typing as npt
+
+
+class OpticalPropertyTable:
+    """
+    Holds the optical properties of all nodes of a ParticleSystem as arrays
+
+    Every node has a row in the table. The columns are:
+
+    type_code : npt.NDArray
+        integer code of the optical type, indexes into self.types. -1 means unset.
+    crystal_id : npt.NDArray
+        integer id of the photonic crystal interpolator, indexes into self.crystals.
+        -1 means no crystal is assigned.
+    rotation : npt.NDArray
+        rotation of the crystal around the z+ axis [rad]. Added on top of the
+        rotation that is set on the interpolator itself.
+    axicon_matrix : npt.NDArray
+        n x 3 x 3 array of rotation matrices used by axicon gratings.
+
+    The columns should only be modified through the setters, as these bump
+    self.version. Consumers like the OpticalForceCalculator compare the version
+    to decide if their cached masks are still valid.
+    """
+    def __init__(self, n: int):
+        """
+        Initializes an empty table for n nodes
+
+        Parameters
+        ----------
+        n : int
+            number of nodes in the ParticleSystem
+        """
+        self.__n = n
+        self.__type_code = np.full(n, -1, dtype=np.int16)
+        self.__crystal_id = np.full(n, -1, dtype=np.int32)
+        self.__rotation = np.zeros(n)
+        self.__axicon_matrix = np.tile(np.identity(3), (n, 1, 1))
+
+        self.types = []
+        self.crystals = []
+        self.version = 0
+        return
+
+    def __str__(self):
+        description = f"OpticalPropertyTable for {self.__n} nodes, version {self.version}\n"
+        for code, optical_type in enumerate(self.types):
+            description += f"{optical_type}: {np.sum(self.__type_code == code)} nodes\n"
+        description += f"{len(self.crystals)} crystal(s) registered"
+        return description
+
+    def __len__(self):
+        return self.__n
+
+    def __selection(self, selection):
+        """Converts None, masks, slices or index lists into something usable for indexing"""
+        if selection is None:
+            return slice(None)
+        if isinstance(selection, slice):
+            return selection
+
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            if selection.shape != (self.__n,):
+                raise AttributeError(f"Boolean selection should have length {self.__n}, "
+                                     f"got shape {selection.shape}")
+            return selection
+        return selection.astype(int)
+
+    def __register(self, registry: list, item) -> int:
+        # Crystals are compared by identity, types by equality
+        for i, registered in enumerate(registry):
+            if registered is item or (registry is self.types and registered == item):
+                return i
+        registry.append(item)
+        return len(registry)-1
+
+    def set_optical_type(self, optical_type, selection=None):
+        """
+        Sets the optical type of the selected nodes
+
+        Parameters
+        ----------
+        optical_type : ParticleOpticalPropertyType
+            optical type to assign
+        selection : npt.ArrayLike, optional
+            boolean mask, index array or slice of nodes. The default is None, selecting all nodes.
+        """
+        code = self.__register(self.types, optical_type)
+        self.__type_code[self.__selection(selection)] = code
+        self.version += 1
+
+    def set_crystal(self, interpolator, selection=None, rotation: float = None):
+        """
+        Assigns a photonic crystal interpolator to the selected nodes
+
+        Parameters
+        ----------
+        interpolator : Callable
+            interpolator mapping [theta, phi, pol] to [theta, phi, mag]
+        selection : npt.ArrayLike, optional
+            boolean mask, index array or slice of nodes. The default is None, selecting all nodes.
+        rotation : float, optional
+            if passed also sets the rotation of the selected nodes [rad]
+        """
+        crystal_id = self.__register(self.crystals, interpolator)
+        selection = self.__selection(selection)
+        self.__crystal_id[selection] = crystal_id
+        if rotation is not None:
+            self.__rotation[selection] = rotation
+        self.version += 1
+
+    def set_rotation(self, rotation: npt.ArrayLike, selection=None):
+        """Sets the crystal rotation around z+ of the selected nodes [rad]"""
+        self.__rotation[self.__selection(selection)] = rotation
+        self.version += 1
+
+    def set_axicon_matrix(self, matrix: npt.ArrayLike, selection=None):
+        """
+        Sets the axicon rotation matrices of the selected nodes
+
+        Parameters
+        ----------
+        matrix : npt.ArrayLike
+            either a single 3 x 3 matrix that is applied to all selected nodes
+            or an array of shape (n_selected, 3, 3)
+        selection : npt.ArrayLike, optional
+            boolean mask, index array or slice of nodes. The default is None, selecting all nodes.
+        """
+        self.__axicon_matrix[self.__selection(selection)] = matrix
+        self.version += 1
+
+    def from_particles(self, particles: list):
+        """
+        Fills the table from the legacy per-particle attributes
+
+        Reads optical_type, optical_interpolator and axicon_angle from each
+        particle where present. Particles without an optical_type are left unset.
+        """
+        self.types = []
+        self.crystals = []
+        self.__type_code[:] = -1
+        self.__crystal_id[:] = -1
+        self.__rotation[:] = 0
+        self.__axicon_matrix[:] = np.identity(3)
+
+        for i, particle in enumerate(particles):
+            if hasattr(particle, 'optical_type'):
+                self.__type_code[i] = self.__register(self.types, particle.optical_type)
+            if hasattr(particle, 'optical_interpolator'):
+                self.__crystal_id[i] = self.__register(self.crystals,
+                                                       particle.optical_interpolator)
+            if hasattr(particle, 'axicon_angle'):
+                self.__axicon_matrix[i] = particle.axicon_angle
+        self.version += 1
+
+    def type_mask(self, optical_type) -> npt.NDArray:
+        """Returns boolean mask of the nodes with the given optical type"""
+        for code, registered in enumerate(self.types):
+            if registered == optical_type:
+                return self.__type_code == code
+        return np.zeros(self.__n, dtype=bool)
+
+    def crystal_masks(self, selection=None) -> dict:
+        """
+        Returns dict formatted as {interpolator: mask} for the crystals in use
+
+        Parameters
+        ----------
+        selection : npt.ArrayLike, optional
+            boolean mask limiting which nodes are considered.
+        """
+        crystal_id = self.__crystal_id
+        if selection is not None:
+            crystal_id = np.where(selection, crystal_id, -1)
+
+        masks = {}
+        for i in np.unique(crystal_id):
+            if i >= 0:
+                masks[self.crystals[i]] = crystal_id == i
+        return masks
+
+    @property
+    def unset(self) -> npt.NDArray:
+        """indices of nodes without optical type"""
+        return np.flatnonzero(self.__type_code < 0)
+
+    @property
+    def populated(self) -> bool:
+        return bool(np.any(self.__type_code >= 0))
+
+    @property
+    def type_code(self):
+        return self.__type_code
+
+    @property
+    def crystal_id(self):
+        return self.__crystal_id
+
+    @property
+    def rotation(self):
+        return self.__rotation
+
+    @property
+    def axicon_matrix(self):
+        return self.__axicon_matrix
+
+    @property
+    def n(self):
+        return self.__n
+
+
+if __name__ == "__main__":
+    table = OpticalPropertyTable(10)
+    table.set_optical_type('specular')
+    table.set_optical_type('axicongrating', np.arange(10) > 4)
+    print(table)
@@ -6,7 +6,7 @@ import logging
 
 import numpy as np
 import numpy.typing as npt
-from scipy.sparse.linalg import bicgstab
+from scipy.sparse.linalg import bicgstab, gmres, spsolve, LinearOperator, aslinearoperator
 import scipy.sparse as sps
 from scipy.spatial import Delaunay
 from scipy.spatial.transform import Rotation
@@ -15,6 +15,8 @@ from mpl_toolkits.mplot3d.art3d import Line3DCollection
 
 from .Particle import Particle
 from .SpringDamper import SpringDamper
+from .OpticalPropertyTable import OpticalPropertyTable
+from .ForcePipeline import ForcePipeline
 
 class ParticleSystem:
     def __init__(self,
@@ -22,7 +24,8 @@ class ParticleSystem:
                  initial_conditions: npt.ArrayLike,
                  sim_param: dict,
                  clean_particles: bool = True,
-                 init_surface = True):
+                 init_surface = True,
+                 triangles: npt.ArrayLike = None):
         """
         Constructor for ParticleSystem object, model made up of n particles
 
@@ -44,9 +47,19 @@ class ParticleSystem:
             Sets wether or not to initialise the surface finding. If disabled will perform it auto
             matically on surface calculation. But it gives the opertunity to initialise it manually
             with some extra parameters.
+        triangles : npt.ArrayLike
+            m-by-3 array of node indices of the surface triangles, e.g. from a
+            meshing function called with return_triangles = True. Replaces the
+            Delaunay triangulation of the projected nodes, which fills in
+            concave boundaries and holes. Default: None
         """
+        if triangles is not None:
+            triangles = np.array(triangles, dtype=int)
+
         if clean_particles:
-            self.clean_up(connectivity_matrix, initial_conditions)
+            triangles = self.clean_up(connectivity_matrix, initial_conditions, triangles)
+
+        self.__triangles = triangles
 
         self.__connectivity_matrix = connectivity_matrix
         self.__initial_conditions = initial_conditions
@@ -80,6 +93,16 @@ class ParticleSystem:
         # Variables that aid simulations
         self.COM_offset = np.zeros(3)
 
+        # Columnar storage of the optical properties of each node
+        self.__optical_properties = OpticalPropertyTable(self.__n)
+
+        # External force components sharing a per-step geometry cache
+        self.__force_pipeline = ForcePipeline(self)
+
+        # Nodal area vectors with the locations they belong to, kept up to
+        # date through rigid displacements, see find_surface
+        self.__area_cache = None
+
         # setup some recording
         self.__history = {'dt':[],
                           'E_kin':[]}
@@ -124,7 +147,13 @@ class ParticleSystem:
             link[1].connections.append(SD)
         return
 
-    def clean_up(self, connectivity_matrix, initial_conditions):
+    def clean_up(self, connectivity_matrix, initial_conditions, triangles = None):
+        """
+        Deletes particles without connections and renumbers the links
+
+        Triangles with a deleted node are dropped, the remaining ones are
+        renumbered and returned.
+        """
         remove_list = set(range(len(initial_conditions)))
         for link in connectivity_matrix:
             try:
@@ -145,6 +174,11 @@ class ParticleSystem:
                 if link[1]>i:
                     link[1]-=1
 
+        if triangles is not None and len(remove_list):
+            triangles = triangles[~np.any(np.isin(triangles, remove_list), axis=1)]
+            triangles = triangles - np.searchsorted(remove_list, triangles)
+        return triangles
+
     def stress_self(self, factor: float = 0):
         """Set all node lengths to zero to homogenously stress mesh"""
         if factor == 0:
@@ -170,7 +204,7 @@ class ParticleSystem:
         w_kin = np.matmul(np.matmul(v, self.__m_matrix), v.T)      # Kinetic energy, 0.5 constant can be neglected
         return w_kin
 
-    def simulate(self, f_external: npt.ArrayLike = ()):
+    def simulate(self, f_external: npt.ArrayLike = (), jx_external = None):
         """
         Core simulate function to advance sim a timestep
 
@@ -187,6 +221,11 @@ class ParticleSystem:
         ----------
         f_external : npt.ArrayLike, optional
             DESCRIPTION. The default is ().
+        jx_external : npt.ArrayLike | sps.spmatrix | LinearOperator, optional
+            3n x 3n derivative of f_external w.r.t. the nodal positions, e.g.
+            from OpticalForceCalculator.force_jacobian. When passed, the
+            external forces are treated implicitly by including it in A.
+            The default is None.
 
         Returns
         -------
@@ -212,6 +251,8 @@ class ParticleSystem:
         # constructing A matrix and b vector for solver
         A = self.__m_matrix - self.__dt * jv - self.__dt ** 2 * jx
         b = self.__dt * f + self.__dt ** 2 * jx.dot(v_current)
+        if jx_external is not None:
+            b += self.__dt ** 2 * jx_external.dot(v_current)
 
         # checking conditioning of A
         # print("conditioning A:", np.linalg.cond(A))
@@ -269,6 +310,8 @@ class ParticleSystem:
         dv = np.zeros_like(b, dtype='float64')
         A = A[mask, :][:, mask]
         b = np.array(b)[mask]
+        if jx_external is not None:
+            A = self.__add_external_jacobian(A, jx_external, mask)
 
         # BiCGSTAB from scipy library
         dv_filtered, _ = bicgstab(A, b, tol=self.__rtol, atol=self.__atol, maxiter=self.__maxiter)
@@ -297,9 +340,28 @@ class ParticleSystem:
 
         return x_next, v_next
 
+    def __add_external_jacobian(self, A, jx_external, mask):
+        # Subtracts the masked external jacobian from A, keeping matrix-free
+        # operators matrix-free
+        if isinstance(jx_external, LinearOperator):
+            n = len(mask)
+            def matvec(v):
+                v_full = np.zeros(n)
+                v_full[mask] = v
+                return jx_external.dot(v_full)[mask]
+            jx_masked = LinearOperator(A.shape, matvec = matvec, dtype = np.float64)
+            return aslinearoperator(A) - self.__dt ** 2 * jx_masked
+
+        if sps.issparse(jx_external):
+            jx_external = sps.csr_matrix(jx_external)[mask, :][:, mask].toarray()
+        else:
+            jx_external = np.asarray(jx_external)[mask, :][:, mask]
+        return A - self.__dt ** 2 * jx_external
+
     def kin_damp_sim(self,
                      f_ext: npt.ArrayLike = (),
-                     q_correction: bool = False):       # kinetic damping algorithm
+                     q_correction: bool = False,
+                     jx_ext = None):       # kinetic damping algorithm
         # kwargs passed to self.simulate
         if self.__vis_damp:         # Condition resetting viscous damping to 0
             for link in self.__springdampers:
@@ -309,7 +371,7 @@ class ParticleSystem:
 
         if len(f_ext):              # condition checking if an f_ext is passed as argument
             self.__save_state()
-            x_next, v_next = self.simulate(f_ext)
+            x_next, v_next = self.simulate(f_ext, jx_ext)
         else:
             self.__save_state()
             x_next, v_next = self.simulate()
@@ -340,6 +402,142 @@ class ParticleSystem:
 
         return x_next, v_next
 
+    def relax_quasi_static(self,
+                           f_external: npt.ArrayLike,
+                           jx_external = None,
+                           inertia_relief: bool = True,
+                           tolerance: float = 1e-6,
+                           max_iter: int = 10):
+        """
+        Moves the nodes to the quasi-static equilibrium shape under an external load
+
+        Newton iterations on f_int(x) + f_external + jx_external (x - x0) = 0,
+        without advancing time or changing the nodal velocities. With inertia
+        relief, the part of the load that accelerates the whole system is
+        balanced by the rigid-body inertia instead of by deformation, as for
+        a free flying sail. The shape change is then constrained to be free
+        of rigid-body motion, so the center of mass and mean orientation stay
+        in place. Fixed particles are kept in place.
+
+        The tangent stays sparse. With inertia relief every Newton step
+        solves the saddle point system
+
+            [ K    M G ] [ du     ]   [ -f ]
+            [ G^T M  0 ] [ lambda ] = [  0 ]
+
+        with K = stiffness_m + jx_external and G the 3n x 6 rigid_body_modes.
+        The multipliers lambda are the rigid-body accelerations.
+
+        Parameters
+        ----------
+        f_external : npt.ArrayLike
+            3n external force vector, kept constant during the iterations
+        jx_external : npt.ArrayLike | sps.spmatrix | LinearOperator, optional
+            3n x 3n derivative of f_external w.r.t. the nodal positions, e.g.
+            from OpticalForceCalculator.force_jacobian. Linearises the change
+            of the load with the shape. Matrices are solved with a sparse
+            direct solver, a LinearOperator with GMRES, as the saddle point
+            system is indefinite.
+            The default is None.
+        inertia_relief : bool, optional
+            balances the net force and moment with the rigid-body inertia.
+            The default is True.
+        tolerance : float, optional
+            norm of the residual force relative to the external load at which
+            the shape is accepted. The default is 1e-6.
+        max_iter : int, optional
+            maximum number of Newton iterations. The default is 10.
+
+        Returns
+        -------
+        residual : float
+            relative residual force of the accepted shape
+        iterations : int
+            number of Newton iterations taken
+        """
+        f_external = np.asarray(f_external, dtype=np.float64).ravel()
+        n_dofs = self.__n * 3
+        matrix_free = isinstance(jx_external, LinearOperator)
+        if jx_external is None:
+            jx_external = sps.csr_matrix((n_dofs, n_dofs))
+        elif not matrix_free:
+            jx_external = sps.csr_matrix(jx_external)
+
+        free = np.repeat([not p.fixed for p in self.__particles], 3)
+        n_free = np.sum(free)
+        x_start = self.__pack_x_current()
+        load_scale = max(np.linalg.norm(f_external[free]), np.finfo(float).tiny)
+
+        n_constraints = 0
+        if inertia_relief:
+            masses = np.repeat([p.m for p in self.__particles], 3)
+            G = self.rigid_body_modes()
+            MG = masses[:, np.newaxis]*G
+            rigid_inverse = np.linalg.inv(G.T.dot(MG))
+            constraints = MG[free]
+            n_constraints = constraints.shape[1]
+
+        displacement = np.zeros(n_dofs)
+        for iterations in range(max_iter + 1):
+            f = self.__one_d_force_vector() + f_external + jx_external.dot(displacement)
+            residual_vector = f
+            if inertia_relief:
+                # Removes the loads that accelerate the rigid body
+                residual_vector = f - MG.dot(rigid_inverse.dot(G.T.dot(f)))
+            residual = np.linalg.norm(residual_vector[free])/load_scale
+            if residual < tolerance or iterations == max_iter:
+                break
+
+            rhs = np.concatenate((-residual_vector[free], np.zeros(n_constraints)))
+            if matrix_free:
+                step = self.__solve_quasi_static_operator(jx_external, free, rhs,
+                                                          constraints if n_constraints else None)
+                if n_constraints:
+                    # The iterative solution meets the constraints only to rel_tol
+                    modes = G[free]
+                    step[:n_free] -= modes.dot(np.linalg.solve(constraints.T.dot(modes),
+                                                               constraints.T.dot(step[:n_free])))
+            else:
+                tangent = (self.stiffness_m + jx_external).tocsr()[free][:, free]
+                if n_constraints:
+                    tangent = sps.bmat([[tangent, sps.csr_matrix(constraints)],
+                                        [sps.csr_matrix(constraints.T), None]])
+                step = spsolve(tangent.tocsc(), rhs)
+            if not np.all(np.isfinite(step)):
+                logging.warning('Quasi-static tangent is singular, the shape is not updated further')
+                break
+            displacement[free] += step[:n_free]
+
+            for i, particle in enumerate(self.__particles):
+                particle.update_pos(x_start[3*i: 3*i+3] + displacement[3*i: 3*i+3])
+
+        if residual >= tolerance:
+            logging.warning(f'Quasi-static shape not converged after {iterations} iterations, '
+                            f'{residual=:.3g}')
+        return residual, iterations
+
+    def __solve_quasi_static_operator(self, jx_external, free, rhs, constraints):
+        # Newton step of relax_quasi_static with a matrix-free external jacobian
+        stiffness = self.stiffness_m
+        n_free = np.sum(free)
+        n_dofs = self.__n * 3
+        if constraints is not None:
+            # Scales the constraints to the stiffness, only rescales lambda
+            constraints = constraints*max(abs(stiffness).max(), 1)/np.abs(constraints).max()
+
+        def matvec(v):
+            u = np.zeros(n_dofs)
+            u[free] = v[:n_free]
+            result = (stiffness.dot(u) + jx_external.dot(u))[free]
+            if constraints is None:
+                return result
+            return np.concatenate((result + constraints.dot(v[n_free:]),
+                                   constraints.T.dot(v[:n_free])))
+
+        A = LinearOperator((len(rhs), len(rhs)), matvec=matvec)
+        step, _ = gmres(A, rhs, tol=self.__rtol, atol=self.__atol, maxiter=self.__maxiter)
+        return step
+
     def __pack_v_current(self):
         return np.array([particle.v for particle in self.__particles]).flatten()
 
@@ -462,10 +660,41 @@ class ParticleSystem:
     def springdampers(self):
         return self.__springdampers
 
-    # @property
-    # def stiffness_m(self):
-    #     self.__system_jacobians()
-    #     return self.__jx
+    @property
+    def stiffness_m(self):
+        """3n x 3n sparse derivative of the internal forces w.r.t. the nodal positions"""
+        n_links = len(self.__springdampers)
+        blocks = np.zeros((n_links, 3, 3))
+        for n, link in enumerate(self.__springdampers):
+            blocks[n] = link.calculate_jacobian()[0]
+        i, j = np.array([link[:2] for link in self.__connectivity_matrix], dtype=int).T
+
+        # Every link adds jx to both diagonal blocks and -jx to the coupling blocks
+        rows = np.concatenate((i, j, i, j))[:, np.newaxis, np.newaxis]*3 + np.arange(3)[:, np.newaxis]
+        cols = np.concatenate((i, j, j, i))[:, np.newaxis, np.newaxis]*3 + np.arange(3)
+        data = np.concatenate((blocks, blocks, -blocks, -blocks))
+        n_dofs = self.__n * 3
+        return sps.csr_matrix((data.ravel(), (np.broadcast_to(rows, data.shape).ravel(),
+                                              np.broadcast_to(cols, data.shape).ravel())),
+                              shape=(n_dofs, n_dofs))
+
+    def rigid_body_modes(self) -> np.ndarray:
+        """
+        Nodal motions of the rigid-body translations and rotations
+
+        Returns
+        -------
+        modes : np.ndarray
+            3n x 6 array, the columns are the nodal displacements of unit
+            translations along x, y, z and unit rotations around the x, y and
+            z axes through the center of mass
+        """
+        arms = self.__pack_x_current().reshape((-1, 3)) - self.calculate_center_of_mass()
+        modes = np.zeros((self.__n, 3, 6))
+        modes[:, :, :3] = np.identity(3)
+        for k in range(3):
+            modes[:, :, 3+k] = np.cross(np.identity(3)[k], arms)
+        return modes.reshape((self.__n * 3, 6))
 
     @property
     def kinetic_energy(self):
@@ -504,6 +733,20 @@ class ParticleSystem:
     def n(self):
         return self.__n
 
+    @property
+    def optical_properties(self):
+        return self.__optical_properties
+
+    @property
+    def force_pipeline(self):
+        return self.__force_pipeline
+
+    @property
+    def simplices(self):
+        if not hasattr(self, '_ParticleSystem__simplices'):
+            self.initialize_find_surface()
+        return self.__simplices
+
 
     def plot(self, ax=None, colors = None):
         """"Plots current system configuration"""
@@ -587,9 +830,10 @@ class ParticleSystem:
         performs triangulation and sets up conversion matrix for surface calc
 
         Projects the point cloud onto specified plane and performs
-        triangulation. Then uses shape of current triangles to create a
-        conversion matrix for assigning the areas of each triangle onto the
-        nodes.
+        triangulation, unless the triangles of the mesh were passed to the
+        constructor, in which case those are used. Then uses shape of current
+        triangles to create a conversion matrix for assigning the areas of
+        each triangle onto the nodes.
 
         Parameters
         ----------
@@ -621,16 +865,19 @@ class ParticleSystem:
             raise AttributeError("projection_plane improperly defined; Must be x, y or z.")
 
         # Performing triangulation
-        points_projected = points[:,:projection_plane] # Projecting onto x-y plane
-        tri = Delaunay(points_projected)
+        if self.__triangles is not None:
+            simplices = self.__triangles
+        else:
+            points_projected = np.delete(points, projection_plane, axis=1) # Projecting onto plane
+            simplices = Delaunay(points_projected).simplices
 
         # Finding areas of each triangle
-        v1 = points[tri.simplices[:,0]]-points[tri.simplices[:,1]]
-        v2 = points[tri.simplices[:,0]]-points[tri.simplices[:,2]]
+        v1 = points[simplices[:,0]]-points[simplices[:,1]]
+        v2 = points[simplices[:,0]]-points[simplices[:,2]]
 
         # Next we set up the matrix multiplication that will divide the areas
         # of the triangles over the actual nodes
-        #conversion_matrix = np.zeros((self.__n*3,len(tri.simplices)*3))
+        #conversion_matrix = np.zeros((self.__n*3,len(simplices)*3))
 
         v1_length = np.linalg.norm(v1, axis=1)
         v2_length = np.linalg.norm(v2, axis=1)
@@ -646,34 +893,40 @@ class ParticleSystem:
 
         angle_iterator = np.column_stack((angle_1, angle_2, angle_3)).flatten()/np.pi
 
-        # Sparse matrix construction
-        rows = []
-        cols = []
-        data = []
-        for j, indices in enumerate(tri.simplices):
-            for k, i in enumerate(indices):
-                for l in range(3):
-                    rows.append(3*i+l)
-                    cols.append(3*j+l)
-                    data.append(angle_iterator[3*j+k])
-        conversion_matrix = sps.csr_matrix((data, (rows, cols)), shape=(self.__n*3, len(tri.simplices)*3))
-
-        #for j, indices in enumerate(tri.simplices):
+        # Sparse matrix construction, entry [3i+l, 3j+l] holds the weight of
+        # vertex k = i of triangle j, indexed here as [j, k, l]
+        n_simplices = len(simplices)
+        components = np.arange(3)
+        rows = 3*simplices[:,:,np.newaxis] + components
+        cols = np.broadcast_to(3*np.arange(n_simplices)[:,np.newaxis,np.newaxis] + components,
+                               rows.shape)
+        data = np.broadcast_to(angle_iterator.reshape((n_simplices,3))[:,:,np.newaxis], rows.shape)
+        conversion_matrix = sps.csr_matrix((data.ravel(), (rows.ravel(), cols.ravel())),
+                                           shape=(self.__n*3, n_simplices*3))
+
+        #for j, indices in enumerate(simplices):
         #    for k, i in enumerate(indices):
         #        conversion_matrix[3*i,3*j]+= angle_iterator[3*j+k]
         #        conversion_matrix[3*i+1,3*j+1]+= angle_iterator[3*j+k]
         #        conversion_matrix[3*i+2,3*j+2]+= angle_iterator[3*j+k]
 
 
-        self.__simplices = tri.simplices
+        self.__simplices = simplices
         self.__surface_conversion_matrix = conversion_matrix
+        self.__surface_weights = angle_iterator.reshape((len(simplices),3))
+        self.__area_cache = None
 
-        return tri.simplices, conversion_matrix
+        return simplices, conversion_matrix
 
     def find_surface(self, projection_plane: str = 'z') -> np.ndarray:
         """
         finds the surface area vector for each node in the mesh
 
+        The result is cached together with the node locations. While the
+        locations are unchanged, or only moved rigidly by displace and
+        un_displace, the cached area vectors are returned, rotated by the
+        accumulated rotation, instead of recalculating them.
+
         Parameters
         ----------
             projection_plane: passed to self.initialize_find_surface().
@@ -700,6 +953,9 @@ class ParticleSystem:
         n = len(points)
         points = points.reshape((int(n/3),3))
 
+        if self.__area_cache is not None and np.array_equal(points, self.__area_cache[0]):
+            return self.__area_cache[1].copy()
+
         # Finding areas of each triangle
         v1 = points[simplices[:,0]]-points[simplices[:,1]]
         v2 = points[simplices[:,0]]-points[simplices[:,2]]
@@ -728,16 +984,112 @@ class ParticleSystem:
         direction_magnitudes = np.linalg.norm(area_vectors_redistributed, axis = 1)
         logging.debug(f'{np.sum(direction_magnitudes)=}')
 
-        scaling_factor = particle_area_magnitudes_1d[::3] /direction_magnitudes
+        # Nodes outside of all triangles have no area
+        scaling_factor = np.divide(particle_area_magnitudes_1d[::3], direction_magnitudes,
+                                   out = np.zeros(len(direction_magnitudes)),
+                                   where = direction_magnitudes>0)
         logging.debug(f'{scaling_factor=}')
 
         area_vectors_redistributed *= np.outer(scaling_factor,np.ones(3))
 
         logging.debug(f'After scaling {np.sum(np.linalg.norm(area_vectors_redistributed, axis=1))=}')
 
+        self.__area_cache = (points, area_vectors_redistributed.copy())
 
         return area_vectors_redistributed
 
+    def __rigid_area_update(self, locations, new_locations, rotation_matrix):
+        """
+        Rotates the cached area vectors along with a rigid displacement
+
+        The cache is only carried over if it belongs to the locations before
+        the displacement, so any other change of the node locations since the
+        last find_surface call invalidates it.
+        """
+        if self.__area_cache is None:
+            return
+        if not np.array_equal(locations, self.__area_cache[0]):
+            self.__area_cache = None
+            return
+        area_vectors = self.__area_cache[1].dot(rotation_matrix.T)
+        self.__area_cache = (np.array(new_locations, dtype=np.float64), area_vectors)
+
+    def find_surface_jacobian(self) -> sps.csr_matrix:
+        """
+        finds the derivative of the nodal area vectors w.r.t. the nodal positions
+
+        Differentiates find_surface analytically, including the rescaling of
+        the redistributed direction vectors to the redistributed magnitudes.
+        The triangulation itself is assumed to stay constant.
+
+        Returns
+        -------
+        jacobian : sps.csr_matrix
+            sparse matrix of shape 3n x 3n, where entry [3i+k, 3j+l] holds the
+            derivative of component k of the area vector of node i w.r.t.
+            component l of the position of node j
+
+        """
+        if not hasattr(self, '_ParticleSystem__surface_weights'):
+            logging.warning('find_surface_jacobian called without prior initialization.')
+            self.initialize_find_surface()
+        simplices = self.__simplices
+        weights = self.__surface_weights
+
+        points = self.__pack_x_current().reshape((self.__n,3))
+        p0 = points[simplices[:,0]]
+        p1 = points[simplices[:,1]]
+        p2 = points[simplices[:,2]]
+
+        # Area vectors of the simplices and their derivatives
+        # dA/dp_k = 1/2 [e_k]x, with e_k the edge opposite to corner k
+        area_vectors = np.cross(p0-p1, p0-p2)/2
+        area_magnitudes = np.linalg.norm(area_vectors, axis=1)
+        area_normals = np.divide(area_vectors, area_magnitudes[:,np.newaxis],
+                                 out = np.zeros(area_vectors.shape),
+                                 where = area_magnitudes[:,np.newaxis]>0)
+
+        edges = np.stack((p2-p1, p0-p2, p1-p0), axis = 1)
+        d_area_vectors = np.zeros(edges.shape + (3,))
+        d_area_vectors[...,0,1] = -edges[...,2]
+        d_area_vectors[...,0,2] = edges[...,1]
+        d_area_vectors[...,1,0] = edges[...,2]
+        d_area_vectors[...,1,2] = -edges[...,0]
+        d_area_vectors[...,2,0] = -edges[...,1]
+        d_area_vectors[...,2,1] = edges[...,0]
+        d_area_vectors /= 2
+        d_area_magnitudes = np.einsum('tr,tkrc->tkc', area_normals, d_area_vectors)
+
+        # Redistributed directions and magnitudes, identical to find_surface
+        directions = np.zeros((self.__n,3))
+        magnitudes = np.zeros(self.__n)
+        np.add.at(directions, simplices, weights[:,:,np.newaxis]*area_vectors[:,np.newaxis,:])
+        np.add.at(magnitudes, simplices, weights*area_magnitudes[:,np.newaxis])
+
+        # a = m * d/|d|, so da = d/|d| dm + m/|d| (I - d d^T/|d|^2) dd
+        direction_norms = np.linalg.norm(directions, axis=1)
+        valid = direction_norms>0
+        units = np.zeros(directions.shape)
+        units[valid] = directions[valid]/direction_norms[valid,np.newaxis]
+        projectors = np.identity(3) - np.einsum('ni,nj->nij', units, units)
+        projectors[~valid] = 0
+        projectors[valid] *= (magnitudes[valid]/direction_norms[valid])[:,np.newaxis,np.newaxis]
+
+        # blocks[t, m, k] is the contribution of simplex t to da_i/dp_j, with
+        # i the node at corner m and j the node at corner k
+        blocks = np.einsum('tmr,tkc->tmkrc', units[simplices], d_area_magnitudes)
+        blocks += np.einsum('tmrs,tksc->tmkrc', projectors[simplices], d_area_vectors)
+        blocks *= weights[:,:,np.newaxis,np.newaxis,np.newaxis]
+
+        local = np.arange(3)
+        rows = 3*simplices[:,:,np.newaxis,np.newaxis,np.newaxis] + local[:,np.newaxis]
+        cols = 3*simplices[:,np.newaxis,:,np.newaxis,np.newaxis] + local
+        rows, cols = np.broadcast_arrays(rows, cols)
+
+        jacobian = sps.coo_matrix((blocks.ravel(), (rows.ravel(), cols.ravel())),
+                                  shape=(self.__n*3, self.__n*3))
+        return jacobian.tocsr()
+
     def plot_triangulated_surface(self, ax = None, arrow_length = 1, plot_points = True):
         """
         plots triangulated surface for user inspection
@@ -833,6 +1185,7 @@ class ParticleSystem:
 
         qx, qy, qz, *_ = displacement
         locations, _ = self.x_v_current_3D
+        original_locations = locations.copy()
 
         # To apply rotations around COM we need to place it at the origin first
         COM =self.calculate_center_of_mass()
@@ -848,6 +1201,9 @@ class ParticleSystem:
             # 'Unsafe' update needed to move fixed particles as well
             self.particles[i].update_pos_unsafe(location)
 
+        rotation_matrix = Rotation.from_euler('xyz', displacement[3:], degrees=True).as_matrix()
+        self.__rigid_area_update(original_locations, new_locations, rotation_matrix)
+
 
     def un_displace(self):
         """
@@ -866,13 +1222,14 @@ class ParticleSystem:
 
         qx, qy, qz, *_ = reverse_displacement
         locations, _ = self.x_v_current_3D
+        original_locations = locations.copy()
 
         # To apply rotations around COM we need to place it at the origin first
         COM =self.calculate_center_of_mass()
         self.translate_mesh(locations, -COM)
 
         # Extra syntax is to apply rotations in reverse order
-        new_locations = self.rotate_mesh(locations, reverse_displacement[3:][::-1], order = 'xyz')
+        new_locations = self.rotate_mesh(locations, reverse_displacement[3:][::-1], order = 'zyx')
         new_locations = self.translate_mesh(new_locations, reverse_displacement[:3])
 
         # Put back system in original location
@@ -882,6 +1239,10 @@ class ParticleSystem:
             # 'Unsafe' update needed to move fixed particles as well
             self.particles[i].update_pos_unsafe(location)
 
+        rotation_matrix = Rotation.from_euler('zyx', reverse_displacement[3:][::-1],
+                                              degrees=True).as_matrix()
+        self.__rigid_area_update(original_locations, new_locations, rotation_matrix)
+
         self.current_displacement = None
 
     def translate_mesh(self, mesh, translation):
@@ -3,4 +3,6 @@ from .ParticleSystem import ParticleSystem
 from .SpringDamper import SpringDamper
 from .SystemObject import SystemObject
 from .Force import Force
-from .ImplicitForce import ImplicitForce
\ No newline at end of file
+from .ImplicitForce import ImplicitForce
+from .OpticalPropertyTable import OpticalPropertyTable
+from .ForcePipeline import ForcePipeline, GeometryCache, GeometrySnapshot, GravityForce, PressureForce, DragForce, CallableForce
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Validation of the fused photonic crystal kernel against calculate_arbitrary_phc_force
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestFusedPhCKernel(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.5)/0.25)**2
+                                                      -1/2 *((y-0.5)/0.25)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+        self.phc = interp.create_interpolator(interp.PhC_library['Mark_4'], 0)
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(self.phc)
+
+        self.OFC = OpticalForceCalculator(self.PS, self.LB)
+        self.OFC_fused = OpticalForceCalculator(self.PS, self.LB, fused_kernel = True)
+
+    def table_samples(self):
+        # Area and polarisation vectors that hit the samples of the crystal table exactly
+        coordinates = self.phc.coordinates
+        coordinates = coordinates[coordinates[:,1] < 2*np.pi - 1e-6]
+        theta, phi, pol = coordinates.T
+        area_vectors = np.column_stack((np.sin(theta)*np.cos(phi),
+                                        np.sin(theta)*np.sin(phi),
+                                        np.cos(theta)))
+        polarisation_vectors = np.column_stack((np.cos(pol), np.sin(pol)))
+        intensity_vectors = np.zeros(area_vectors.shape)
+        intensity_vectors[:,2] = 1
+        return area_vectors, intensity_vectors, polarisation_vectors
+
+    def test_table_samples(self):
+        area_vectors, intensity_vectors, polarisation_vectors = self.table_samples()
+        phc_dict = {self.phc: np.ones(len(area_vectors), dtype=bool)}
+
+        forces = self.OFC.calculate_arbitrary_phc_force(area_vectors, intensity_vectors,
+                                                        polarisation_vectors, None,
+                                                        phc_dict = phc_dict)
+        forces_fused = self.OFC_fused.calculate_arbitrary_phc_force_fused(area_vectors,
+                                                                          intensity_vectors,
+                                                                          polarisation_vectors,
+                                                                          phc_dict = phc_dict)
+        self.assertTrue(np.allclose(forces, forces_fused, atol = 1e-7))
+
+    def test_flat_sail(self):
+        forces = self.OFC.force_value()
+        forces_fused = self.OFC_fused.force_value()
+        self.assertTrue(np.allclose(forces, forces_fused, atol = 1e-7*np.abs(forces).max()))
+
+    def test_rotation(self):
+        # Rotating the nodes must be equivalent to rotating the interpolator
+        rotation = 0.4
+        self.PS.displace([0, 0, 0, 4, 3, 0])
+        self.PS.optical_properties.set_rotation(rotation)
+        forces_fused = self.OFC_fused.force_value()
+
+        self.PS.optical_properties.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'],
+                                                                          rotation),
+                                               rotation = 0)
+        forces_rotated_crystal = self.OFC_fused.force_value()
+        self.PS.un_displace()
+
+        self.assertTrue(np.allclose(forces_fused, forces_rotated_crystal))
+
+    def test_fallback_without_cartesian_table(self):
+        area_vectors, intensity_vectors, polarisation_vectors = self.table_samples()
+        spherical_only = lambda coordinates: self.phc(coordinates)
+        phc_dict = {spherical_only: np.ones(len(area_vectors), dtype=bool)}
+
+        forces = self.OFC.calculate_arbitrary_phc_force(area_vectors, intensity_vectors,
+                                                        polarisation_vectors, None,
+                                                        phc_dict = phc_dict)
+        forces_fused = self.OFC_fused.calculate_arbitrary_phc_force_fused(area_vectors,
+                                                                          intensity_vectors,
+                                                                          polarisation_vectors,
+                                                                          phc_dict = phc_dict)
+        self.assertTrue(np.allclose(forces, forces_fused))
+
+    def test_incremental(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB, fused_kernel = True,
+                                     incremental_tolerance = 1e-4)
+        self.PS.displace([0, 0, 0, 4, 3, 0])
+        forces = OFC.force_value()
+        forces_cached = OFC.force_value()
+        self.PS.un_displace()
+
+        self.assertTrue(np.allclose(forces, forces_cached))
+        self.assertEqual(OFC.interpolation_stats['hits'], self.PS.n)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the incremental re-interpolation of photonic crystals in the OpticalForceCalculator
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestIncrementalInterpolation(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.5)/0.25)**2
+                                                      -1/2 *((y-0.5)/0.25)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+
+        self.OFC = OpticalForceCalculator(self.PS, self.LB)
+        self.OFC_incremental = OpticalForceCalculator(self.PS, self.LB,
+                                                      incremental_tolerance = 1e-4)
+
+    def test_first_call_recomputes(self):
+        forces = self.OFC_incremental.force_value()
+        self.assertTrue(np.all(forces == self.OFC.force_value()))
+        self.assertEqual(self.OFC_incremental.interpolation_stats['recomputed'], self.PS.n)
+        self.assertEqual(self.OFC_incremental.interpolation_stats['hits'], 0)
+
+    def test_small_motion_hits(self):
+        self.OFC_incremental.force_value()
+        x, _ = self.PS.x_v_current
+        self.PS.update_pos_unsafe(x + 1e-7*np.random.random(x.shape))
+
+        forces = self.OFC_incremental.force_value()
+        self.assertEqual(self.OFC_incremental.interpolation_stats['hits'], self.PS.n)
+        self.assertTrue(np.allclose(forces, self.OFC.force_value(), atol = 1e-5))
+
+    def test_large_motion_recomputes(self):
+        self.OFC_incremental.force_value()
+        self.PS.displace([0, 0, 0, 3, 0, 0])
+        forces = self.OFC_incremental.force_value()
+        reference = self.OFC.force_value()
+        self.PS.un_displace()
+
+        self.assertEqual(self.OFC_incremental.interpolation_stats['recomputed'], 2*self.PS.n)
+        self.assertTrue(np.all(forces == reference))
+
+    def test_table_change_resets_cache(self):
+        self.OFC_incremental.force_value()
+        self.PS.optical_properties.set_rotation(np.pi/4)
+        self.OFC_incremental.force_value()
+        self.assertEqual(self.OFC_incremental.interpolation_stats['recomputed'], 2*self.PS.n)
+
+
+if __name__ == '__main__':
+    unittest.main()
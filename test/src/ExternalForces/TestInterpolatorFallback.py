@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the handling of queries outside of the range of the photonic crystal tables
+"""
+import unittest
+
+import numpy as np
+
+import src.ExternalForces.optical_interpolators.interpolators as interp
+
+
+class TestInterpolatorFallback(unittest.TestCase):
+    def setUp(self):
+        self.phc = interp.create_interpolator(interp.PhC_library['Mark_4'], 0)
+
+        # theta beyond the 15 degrees covered by the table
+        rng = np.random.default_rng(0)
+        self.coordinates = np.column_stack((rng.uniform(0.3, 0.5, 50),
+                                            rng.uniform(0, 2*np.pi, 50),
+                                            rng.uniform(0, np.pi, 50)))
+
+    def test_no_nan(self):
+        self.assertFalse(np.any(np.isnan(self.phc(self.coordinates))))
+        self.assertFalse(np.any(np.isnan(self.phc.outgoing_vectors(self.coordinates))))
+        self.assertFalse(np.any(np.isnan(self.phc(self.coordinates[0]))))
+
+    def test_nearest_sample(self):
+        # Directly beyond a sample at the edge of the table, the nearest sample is that sample
+        edge = self.phc.coordinates[self.phc.coordinates[:,0] == self.phc.coordinates[:,0].max()]
+        edge = edge[edge[:,1] < 2*np.pi - 1e-6][:10]
+        beyond = edge + np.array([0.01, 0, 0])
+
+        self.assertTrue(np.allclose(self.phc(beyond), self.phc(edge)))
+        self.assertTrue(np.allclose(self.phc.outgoing_vectors(beyond),
+                                    self.phc.outgoing_vectors(edge)))
+
+    def test_counter(self):
+        self.assertEqual(self.phc.out_of_range_count, 0)
+        self.phc(self.coordinates)
+        self.assertEqual(self.phc.out_of_range_count, len(self.coordinates))
+
+        with self.assertLogs(level = 'DEBUG') as logs:
+            self.phc.outgoing_vectors(self.coordinates)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].levelname, 'DEBUG')
+        self.assertEqual(self.phc.out_of_range_count, 2*len(self.coordinates))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the MultiBeamForceCalculator and beams with an arbitrary direction
+"""
+import unittest
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.MultiBeamForceCalculator import MultiBeamForceCalculator
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestMultiBeamForceCalculator(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+
+        # Curve the mesh, so the beams see different incidence angles
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+
+        gaussian = lambda mu_x: (lambda x, y: 1e9 * np.exp(-1/2 *((x-mu_x)/0.3)**2
+                                                           -1/2 *((y-0.5)/0.3)**2))
+        polarisation_y = lambda x, y: np.outer(np.ones(np.shape(x)), [0,1])
+        polarisation_x = lambda x, y: np.outer(np.ones(np.shape(x)), [1,0])
+        self.beams = [LaserBeam(gaussian(0.3), polarisation_y),
+                      LaserBeam(gaussian(0.7), polarisation_y),
+                      LaserBeam(gaussian(0.5), polarisation_x),
+                      LaserBeam(gaussian(0.5), polarisation_y, direction = [0.1, 0, 1])]
+
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+
+    def test_sum_of_beams(self):
+        MBFC = MultiBeamForceCalculator(self.PS, self.beams)
+        forces = MBFC.force_value()
+
+        single = [OpticalForceCalculator(self.PS, LB).force_value() for LB in self.beams]
+        self.assertTrue(np.allclose(forces, np.sum(single, axis=0)))
+        self.assertTrue(np.allclose(MBFC.beam_forces(), single))
+
+        # The first two beams share direction and polarisation
+        MBFC.force_value()
+        self.assertEqual(MBFC.beam_batches, [[0, 1], [2], [3]])
+
+    def test_stability_per_beam(self):
+        MBFC = MultiBeamForceCalculator(self.PS, self.beams[:2])
+        coefficients = MBFC.calculate_stability_coefficients(per_beam = True)
+
+        self.assertEqual(coefficients.shape, (2, 6, 6))
+        self.assertTrue(np.allclose(coefficients.sum(axis=0),
+                                    MBFC.calculate_stability_coefficients()))
+        self.assertTrue(np.allclose(coefficients[0],
+                                    OpticalForceCalculator(self.PS, self.beams[0]).calculate_stability_coefficients()))
+
+    def test_jacobian(self):
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        MBFC = MultiBeamForceCalculator(self.PS, self.beams)
+        jacobian = MBFC.force_jacobian().toarray()
+
+        single = [OpticalForceCalculator(self.PS, LB).force_jacobian().toarray() for LB in self.beams]
+        self.assertTrue(np.allclose(jacobian, np.sum(single, axis=0)))
+
+    def test_no_beams(self):
+        with self.assertRaises(AttributeError):
+            MultiBeamForceCalculator(self.PS, [])
+
+
+class TestBeamDirection(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.2, self.params)
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        self.uniform = lambda x, y: 1e9*np.ones(np.shape(x))
+        self.polarisation = lambda x, y: np.outer(np.ones(np.shape(x)), [0,1])
+
+    def test_rotated_beam_and_sail(self):
+        OFC = OpticalForceCalculator(self.PS, LaserBeam(self.uniform, self.polarisation))
+        forces = OFC.force_value()
+
+        # Rotating the sail and the beam together rotates the forces
+        rotation = Rotation.from_euler('xyz', [0, 30, 0], degrees=True).as_matrix()
+        OFC.LaserBeam = LaserBeam(self.uniform, self.polarisation, direction = rotation[:,2])
+        self.PS.displace([0, 0, 0, 0, 30, 0])
+        forces_rotated = OFC.force_value()
+        self.PS.un_displace()
+
+        self.assertTrue(np.allclose(forces_rotated, forces.dot(rotation.T)))
+
+    def test_jacobian(self):
+        LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.4)/0.3)**2 -1/2 *((y-0.5)/0.3)**2),
+                       self.polarisation, direction = [0.3, -0.2, 1])
+        OFC = OpticalForceCalculator(self.PS, LB)
+        jacobian = OFC.force_jacobian().toarray()
+
+        x0, _ = self.PS.x_v_current
+        x0 = x0.copy()
+        h = 1e-5
+        numerical = np.zeros(jacobian.shape)
+        for j in range(len(x0)):
+            x = x0.copy()
+            x[j] += h
+            self.PS.update_pos_unsafe(x)
+            f_plus = OFC.force_value().ravel()
+            x[j] -= 2*h
+            self.PS.update_pos_unsafe(x)
+            f_min = OFC.force_value().ravel()
+            numerical[:,j] = (f_plus - f_min)/(2*h)
+        self.PS.update_pos_unsafe(x0)
+
+        self.assertTrue(np.allclose(jacobian, numerical, atol = 1e-6*np.abs(jacobian).max()))
+
+    def test_invalid_direction(self):
+        with self.assertRaises(AttributeError):
+            LaserBeam(self.uniform, self.polarisation, direction = [0, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the batched optical force calculation of several poses
+"""
+import unittest
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.particleSystem.ForcePipeline import GeometryCache
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.MultiBeamForceCalculator import MultiBeamForceCalculator
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestOpticalForceBatch(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        locations, _ = self.PS.x_v_current_3D
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+        table.set_optical_type(ParticleOpticalPropertyType.SPECULAR, locations[:,0] < 0.2)
+        table.set_optical_type(ParticleOpticalPropertyType.AXICONGRATING, locations[:,0] > 0.85)
+        table.set_axicon_matrix(Rotation.from_euler("x", 5, degrees=True).as_matrix(), locations[:,0] > 0.85)
+
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.45)/0.25)**2
+                                                      -1/2 *((y-0.5)/0.25)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+        cache = GeometryCache(self.PS)
+        rng = np.random.default_rng(0)
+        self.poses = [cache.pose(np.hstack((rng.normal(0, 0.05, 3), rng.normal(0, 3, 3))))
+                      for i in range(5)]
+        self.locations = np.array([pose.locations for pose in self.poses])
+        self.area_vectors = np.array([pose.area_vectors for pose in self.poses])
+
+    def test_matches_single_poses(self):
+        for kwargs in [{}, {'fused_kernel': True}, {'intensity_threshold': 5e8}]:
+            OFC = OpticalForceCalculator(self.PS, self.LB, **kwargs)
+            reference = np.array([OFC.force_value(pose).reshape((-1,3)) for pose in self.poses])
+            forces = OFC.force_value_batch(self.locations, self.area_vectors)
+            self.assertTrue(np.allclose(forces, reference, rtol = 0, atol = 1e-12*np.abs(reference).max()))
+
+    def test_multiple_beams(self):
+        beams = [self.LB, LaserBeam(lambda x, y: 5e8 * np.ones(np.shape(x)),
+                                    lambda x, y: np.outer(np.ones(np.shape(x)), [1,0]),
+                                    direction = [0.1, 0, 1])]
+        MBFC = MultiBeamForceCalculator(self.PS, beams)
+        reference = np.array([MBFC.force_value(pose) for pose in self.poses])
+        forces = MBFC.force_value_batch(self.locations, self.area_vectors)
+        self.assertTrue(np.allclose(forces, reference, rtol = 0, atol = 1e-12*np.abs(reference).max()))
+
+    def test_crystal_rotations(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        rotations = np.linspace(0, 1, len(self.poses))
+        forces = OFC.force_value_batch(self.locations, self.area_vectors, rotations)
+
+        table = self.PS.optical_properties
+        base = table.rotation.copy()
+        for i, pose in enumerate(self.poses):
+            table.set_rotation(base + rotations[i])
+            reference = OFC.force_value(pose).reshape((-1,3))
+            self.assertTrue(np.allclose(forces[i], reference))
+
+    def test_restoring_forces(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        rng = np.random.default_rng(1)
+        displacements = np.hstack((rng.normal(0, 0.05, (7,3)), rng.normal(0, 3, (7,3))))
+        locations = self.PS.x_v_current_3D[0].copy()
+
+        cache = GeometryCache(self.PS)
+        posed = cache.pose_batch(displacements)
+        self.assertTrue(np.allclose(posed.locations, [cache.pose(d).locations for d in displacements]))
+
+        net_force, net_moments = OFC.calculate_restoring_forces_batch(displacements, batch_size = 3)
+        self.assertTrue(np.all(self.PS.x_v_current_3D[0] == locations))
+
+        for i, displacement in enumerate(displacements):
+            self.PS.displace(displacement, suppress_warnings = True)
+            reference = OFC.calculate_restoring_forces()
+            self.PS.un_displace()
+            self.assertTrue(np.allclose(net_force[i], reference[0], rtol = 1e-8, atol = 0))
+            self.assertTrue(np.allclose(net_moments[i], reference[1], rtol = 1e-8,
+                                        atol = 1e-10*np.abs(reference[1]).max()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for skipping nodes outside of the beam footprint in the OpticalForceCalculator
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestOpticalForceCulling(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.05, self.params)
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+
+        self.I_0 = 1e9
+        sigma = 0.1
+        self.LB = LaserBeam(lambda x, y: self.I_0 * np.exp(-1/2 *((x-0.5)/sigma)**2
+                                                           -1/2 *((y-0.5)/sigma)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+
+    def test_culled_forces(self):
+        threshold = 1e-3*self.I_0
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        OFC_culled = OpticalForceCalculator(self.PS, self.LB, intensity_threshold = threshold)
+
+        forces = OFC.force_value()
+        forces_culled = OFC_culled.force_value()
+
+        locations, _ = self.PS.x_v_current_3D
+        illuminated = self.LB.intensity_profile(locations[:,0], locations[:,1]) >= threshold
+
+        self.assertTrue(np.any(~illuminated))
+        self.assertTrue(np.all(forces_culled[~illuminated] == 0))
+        self.assertTrue(np.allclose(forces_culled[illuminated], forces[illuminated]))
+
+    def test_footprint_follows_sail(self):
+        threshold = 1e-3*self.I_0
+        OFC = OpticalForceCalculator(self.PS, self.LB, intensity_threshold = threshold)
+        OFC.force_value()
+        footprint = OFC.footprint_mask.copy()
+
+        # Move the sail so the beam hits a different part of it
+        self.PS.displace([0.3, 0, 0, 0, 0, 0], suppress_warnings = True)
+        forces = OFC.force_value()
+        self.PS.un_displace()
+
+        locations, _ = self.PS.x_v_current_3D
+        illuminated = self.LB.intensity_profile(locations[:,0]+0.3, locations[:,1]) >= threshold
+        self.assertFalse(np.all(OFC.footprint_mask == footprint))
+        self.assertTrue(np.all(OFC.footprint_mask[illuminated]))
+        self.assertTrue(np.all(forces[~illuminated] == 0))
+        self.assertTrue(np.all(forces[illuminated,2] != 0))
+
+    def test_footprint_rebuild(self):
+        # A rebuild only evaluates the intensity around the previous footprint, as arrays
+        threshold = 1e-3*self.I_0
+        profile = self.LB.intensity_profile
+        evaluated = []
+        def counting_profile(x, y):
+            evaluated.append(np.size(x))
+            return profile(x, y)
+        self.LB.intensity_profile = counting_profile
+
+        OFC = OpticalForceCalculator(self.PS, self.LB, intensity_threshold = threshold)
+        OFC.force_value()
+        self.assertEqual(evaluated[0], self.PS.n)
+
+        evaluated.clear()
+        self.PS.displace([0.1, 0, 0, 0, 0, 0], suppress_warnings = True)
+        OFC.force_value()
+        footprint = OFC.footprint_mask.copy()
+        # The last call evaluates the footprint for the forces
+        self.assertLess(sum(evaluated[:-1]), self.PS.n)
+        self.assertEqual(evaluated[-1], np.sum(footprint))
+        self.assertTrue(np.all(np.array(evaluated) > 1))
+
+        locations, _ = self.PS.x_v_current_3D
+        self.assertTrue(np.all(OFC.update_footprint(locations, rebuild = True) == footprint))
+        self.PS.un_displace()
+
+    def test_jacobian_culled_rows(self):
+        threshold = 1e-3*self.I_0
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB, intensity_threshold = threshold)
+
+        jacobian = OFC.force_jacobian().toarray()
+        locations, _ = self.PS.x_v_current_3D
+        illuminated = self.LB.intensity_profile(locations[:,0], locations[:,1]) >= threshold
+        rows = np.repeat(~illuminated, 3)
+        self.assertTrue(np.all(jacobian[rows] == 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the position derivative of the optical forces and its use in the implicit solver
+"""
+import unittest
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.Sim.simulations import Simulate_Lightsail
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestOpticalForceJacobian(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.2, self.params)
+
+        # Curve the mesh, so all terms of the derivative contribute
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+
+        I_0 = 1e9
+        self.LB = LaserBeam(lambda x, y: I_0 * np.exp(-1/2 *((x-0.4)/0.3)**2
+                                                      -1/2 *((y-0.5)/0.3)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+    def numerical_jacobian(self, function, h = 1e-5):
+        x0, _ = self.PS.x_v_current_3D
+        x0 = x0.ravel().copy()
+        jacobian = []
+        for j in range(len(x0)):
+            x_plus = x0.copy()
+            x_plus[j] += h
+            self.PS.update_pos_unsafe(x_plus)
+            f_plus = function().ravel()
+
+            x_min = x0.copy()
+            x_min[j] -= h
+            self.PS.update_pos_unsafe(x_min)
+            f_min = function().ravel()
+            jacobian.append((f_plus-f_min)/(2*h))
+        self.PS.update_pos_unsafe(x0)
+        return np.array(jacobian).T
+
+    def test_surface_jacobian(self):
+        jacobian = self.PS.find_surface_jacobian().toarray()
+        numerical = self.numerical_jacobian(self.PS.find_surface)
+        self.assertTrue(np.allclose(jacobian, numerical, atol = 1e-8))
+
+    def test_specular(self):
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+
+        jacobian = OFC.force_jacobian().toarray()
+        numerical = self.numerical_jacobian(OFC.force_value)
+        self.assertTrue(np.allclose(jacobian, numerical, atol = 1e-6*np.abs(jacobian).max()))
+
+    def test_axicon(self):
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.AXICONGRATING)
+        table.set_axicon_matrix(Rotation.from_euler('yz', [20, 30], degrees=True).as_matrix())
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+
+        jacobian = OFC.force_jacobian().toarray()
+        numerical = self.numerical_jacobian(OFC.force_value)
+        self.assertTrue(np.allclose(jacobian, numerical, atol = 1e-6*np.abs(jacobian).max()))
+
+    def test_phc(self):
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+
+        jacobian = OFC.force_jacobian().toarray()
+        numerical = self.numerical_jacobian(OFC.force_value)
+
+        # The crystal response is piecewise linear, so nodes right at the edge
+        # of a cell of the table are allowed to differ
+        error = np.abs(jacobian-numerical) > 1e-2*np.abs(jacobian).max()
+        nodes_with_error = np.unique(np.argwhere(error)[:,0]//3)
+        self.assertLess(len(nodes_with_error), 0.05*self.PS.n)
+
+    def test_culled(self):
+        # The Jacobian linearises the force over the same culled nodes
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB, intensity_threshold = 5e8, culling_margin = 0.3)
+        forces = OFC.force_value()
+        self.assertTrue(np.any(np.all(forces == 0, axis=1)))
+
+        jacobian = OFC.force_jacobian().toarray()
+        numerical = self.numerical_jacobian(OFC.force_value)
+        self.assertTrue(np.allclose(jacobian, numerical, atol = 1e-6*np.abs(jacobian).max()))
+
+    def test_implicit_patches(self):
+        # The per-node Jacobian does not linearise the patch forces
+        self.params['t_steps'] = 1
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB, patch_size = 0.5)
+        SIM = Simulate_Lightsail(self.PS, OFC, self.params)
+        with self.assertLogs(level = 'WARNING') as logs:
+            SIM.run_simulation(printframes = 0, implicit_forces = True)
+        self.assertTrue(any('patches' in message for message in logs.output))
+
+    def test_linear_operator(self):
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+
+        jacobian = OFC.force_jacobian()
+        operator = OFC.force_jacobian(as_linear_operator = True)
+        v = np.random.random(3*self.PS.n)
+        self.assertTrue(np.allclose(jacobian.dot(v), operator.matvec(v)))
+
+    def test_simulate_with_jacobian(self):
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        x0, v0 = self.PS.x_v_current
+        x0, v0 = x0.copy(), v0.copy()
+
+        f = OFC.force_value().ravel()
+        jacobian = OFC.force_jacobian()
+        results = []
+        for jx_external in [jacobian,
+                            jacobian.toarray(),
+                            OFC.force_jacobian(as_linear_operator = True)]:
+            self.PS.update_pos_unsafe(x0)
+            self.PS.update_vel_unsafe(v0)
+            results.append(self.PS.simulate(f, jx_external)[1])
+        self.PS.update_pos_unsafe(x0)
+        self.PS.update_vel_unsafe(v0)
+        explicit = self.PS.simulate(f)[1]
+
+        self.assertTrue(np.allclose(results[0], results[1], rtol = 1e-4))
+        self.assertTrue(np.allclose(results[0], results[2], rtol = 1e-4))
+        self.assertFalse(np.allclose(results[0], explicit, rtol = 1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()
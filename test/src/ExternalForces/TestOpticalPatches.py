@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the optical patch layer of the OpticalForceCalculator
+"""
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestOpticalPatches(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.025, self.params)
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.4)/0.3)**2
+                                                      -1/2 *((y-0.5)/0.3)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+    def curve(self):
+        locations, _ = self.PS.x_v_current_3D
+        x, y = locations[:,0], locations[:,1]
+        locations[:,2] = 0.1*(x-0.5)**2 + 0.05*x*y
+        self.PS.update_pos_unsafe(locations.ravel())
+
+    def test_flat_sail(self):
+        # On a flat sail the patches are exact, for any patch size
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        OFC_patches = OpticalForceCalculator(self.PS, self.LB, patch_size = 0.2)
+
+        forces = OFC.force_value()
+        patch_forces = OFC_patches.force_value()
+        self.assertEqual(OFC_patches.patch_layer.n_patches, 25)
+        self.assertTrue(np.allclose(patch_forces, forces))
+
+    def test_node_patches(self):
+        # Patches smaller than the mesh hold a single node each
+        self.curve()
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        OFC_patches = OpticalForceCalculator(self.PS, self.LB, patch_size = 0.01)
+        self.assertTrue(np.allclose(OFC_patches.force_value(), OFC.force_value()))
+        self.assertEqual(OFC_patches.patch_layer.n_patches, self.PS.n)
+
+    def test_error_estimate(self):
+        self.curve()
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+
+        errors = []
+        for patch_size in [0.25, 0.1]:
+            OFC = OpticalForceCalculator(self.PS, self.LB, patch_size = patch_size)
+            errors.append(OFC.estimate_patch_error())
+
+        self.assertLess(errors[0]['force'], 1e-2)
+        self.assertLess(errors[1]['force'], errors[0]['force'])
+        self.assertLess(errors[1]['moment'], errors[0]['moment'])
+        self.assertLess(errors[1]['nodal'], errors[0]['nodal'])
+
+    def test_crystal_boundaries(self):
+        # Nodes with different crystals never share a patch
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+        locations, _ = self.PS.x_v_current_3D
+        table.set_rotation(np.pi/2, locations[:,0] > 0.3)
+
+        OFC = OpticalForceCalculator(self.PS, self.LB, patch_size = 0.5)
+        OFC.force_value()
+        labels = OFC.patch_layer.labels
+        self.assertEqual(OFC.patch_layer.n_patches, 6)
+        for label in range(OFC.patch_layer.n_patches):
+            self.assertEqual(len(np.unique(table.rotation[labels == label])), 1)
+
+    def test_varying_polarisation(self):
+        # The mean polarisation of a patch is shortened where it rotates over the patch
+        self.curve()
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+        self.LB.polarization_map = lambda x, y: np.column_stack((np.cos(3*x), np.sin(3*x)))
+
+        OFC = OpticalForceCalculator(self.PS, self.LB, patch_size = 0.5, incremental_tolerance = 1e-4)
+        with mock.patch.object(OFC, 'calculate_forces', wraps = OFC.calculate_forces) as calculate_forces:
+            OFC.force_value()
+        polarisation = calculate_forces.call_args[0][2][OFC.patch_layer.representatives]
+        self.assertTrue(np.allclose(np.linalg.norm(polarisation, axis=1), 1))
+
+        # Reassigning the patches resets the cache keyed on their representative nodes
+        self.assertIsNotNone(OFC.incidence_cache)
+        OFC.patch_layer.labels = None
+        forces = OFC.force_value()
+        self.assertEqual(OFC.interpolation_stats['hits'], 0)
+        OFC.force_value()
+        self.assertEqual(OFC.interpolation_stats['hits'], OFC.patch_layer.n_patches)
+        self.assertTrue(np.allclose(OFC.force_value(), forces))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the pose response surface of the net optical force and moment
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.particleSystem.ForcePipeline import GeometryCache
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.PoseSurrogate import PoseSurrogate
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.Sim.simulations import Simulate_Lightsail
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestPoseSurrogate(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 1e-3,  # [s]       simulation timestep
+            "t_steps": 100,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-12, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.PS.calculate_correct_masses(1e-3, 1000)
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.45)/0.25)**2
+                                                      -1/2 *((y-0.5)/0.25)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+        self.OFC = OpticalForceCalculator(self.PS, self.LB)
+
+    def test_grid_points(self):
+        # The table reproduces the full model at its grid points
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+        surrogate = PoseSurrogate(self.OFC, translation_range = 0.1, rotation_range = 2,
+                                  spin_range = 10, n_points = (3, 3, 3, 3, 3))
+        cache = GeometryCache(self.PS)
+        for pose in [[0.1, 0, -2, 2, 10], [-0.1, 0.1, 0, 2, -10]]:
+            reference = self.OFC.calculate_restoring_forces(cache = cache.pose(np.insert(pose, 2, 0)))
+            net_force, net_moment = surrogate.pose_loads(pose)
+            self.assertTrue(np.allclose(net_force[0], reference[0]))
+            self.assertTrue(np.allclose(net_moment[0], reference[1]))
+
+    def test_drop_in(self):
+        surrogate = PoseSurrogate(self.OFC, translation_range = 0.1, rotation_range = 2,
+                                  n_points = (5, 5, 5, 5, 1))
+        cache = GeometryCache(self.PS)
+        displacement = np.array([0.03, -0.02, 0, 1, -0.5, 0])
+        posed = cache.pose(displacement)
+
+        self.assertTrue(np.allclose(surrogate.find_poses(posed.locations[np.newaxis]),
+                                    np.delete(displacement, 2)))
+
+        # The nodal forces add up to the interpolated loads
+        forces = surrogate.force_value(posed)
+        net_force, net_moment = surrogate.calculate_restoring_forces(cache = posed)
+        self.assertTrue(np.allclose(np.sum(forces, axis=0), net_force))
+        self.assertTrue(np.allclose(np.sum(np.cross(posed.locations - posed.center_of_mass, forces), axis=0),
+                                    net_moment))
+
+        self.PS.displace(displacement)
+        self.assertTrue(np.allclose(surrogate.calculate_restoring_forces(), (net_force, net_moment)))
+        reference = self.OFC.calculate_restoring_forces()
+        self.assertTrue(np.allclose(net_force, reference[0], rtol = 0, atol = 1e-3*np.abs(reference[0]).max()))
+
+    def test_trajectory(self):
+        surrogate = PoseSurrogate(self.OFC, translation_range = 0.1, rotation_range = 2,
+                                  n_points = (5, 5, 5, 5, 1))
+        errors = surrogate.estimate_error(20)
+        self.assertLess(errors['force'], 1e-2)
+        finer = PoseSurrogate(self.OFC, translation_range = 0.1, rotation_range = 2,
+                              n_points = (9, 9, 9, 9, 1)).estimate_error(20)
+        self.assertLess(finer['moment'], errors['moment'])
+
+        histories = []
+        initial_positions, _ = self.PS.x_v_current
+        for FC in [self.OFC, surrogate]:
+            self.PS.reset_history()
+            self.PS.update_pos_unsafe(initial_positions)
+            sim = Simulate_Lightsail(self.PS, FC, self.params)
+            sim.simulate_trajectory(printframes = 0, deform = False, spin = False)
+            histories.append(np.cumsum(self.PS.history['position'], axis=0))
+        self.assertTrue(np.allclose(histories[1], histories[0], atol = 2e-2*np.abs(histories[0][:,3:]).max()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the self-shadowing stage of the OpticalForceCalculator
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.ExternalForces.SelfShadowing import TriangleBVH
+import src.Mesh.mesh_functions as MF
+
+
+class TestTriangleBVH(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.points = rng.uniform(0, 1, (300, 3))
+        self.simplices = rng.integers(0, 300, (100, 3))
+        self.origins = rng.uniform(0, 1, (200, 3))
+        self.direction = [0.2, -0.3, 1]
+
+    def test_brute_force(self):
+        bvh = TriangleBVH(self.simplices, self.points)
+        brute_force = TriangleBVH(self.simplices, self.points, leaf_size = len(self.simplices))
+
+        hit = bvh.intersect(self.origins, self.direction)
+        self.assertTrue(np.any(hit))
+        self.assertFalse(np.all(hit))
+        self.assertTrue(np.all(hit == brute_force.intersect(self.origins, self.direction)))
+
+    def test_refit(self):
+        bvh = TriangleBVH(self.simplices, self.points)
+        moved = self.points + np.random.default_rng(1).normal(0, 0.1, self.points.shape)
+        bvh.refit(moved)
+
+        self.assertTrue(np.all(bvh.intersect(self.origins, self.direction)
+                               == TriangleBVH(self.simplices, moved).intersect(self.origins,
+                                                                              self.direction)))
+
+
+class TestSelfShadowing(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+
+        # Strongly billowed sail
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 1.5*((x-0.5)**2 + (y-0.5)**2)
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.LB = LaserBeam(lambda x, y: 1e9*np.ones(np.shape(x)),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+
+    def test_untilted_sail(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        OFC_shadowing = OpticalForceCalculator(self.PS, self.LB, self_shadowing = True)
+
+        self.assertTrue(np.all(OFC.force_value() == OFC_shadowing.force_value()))
+        self.assertFalse(np.any(OFC_shadowing.shadow_mask))
+
+    def test_tilted_sail(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        OFC_shadowing = OpticalForceCalculator(self.PS, self.LB, self_shadowing = True)
+        OFC_shadowing.force_value()
+
+        self.PS.displace([0, 0, 0, 0, 75, 0], suppress_warnings = True)
+        forces = OFC.force_value()
+        forces_shadowing = OFC_shadowing.force_value()
+        locations, _ = self.PS.x_v_current_3D
+        self.PS.un_displace()
+
+        shadowed = OFC_shadowing.shadow_mask
+        self.assertTrue(np.any(shadowed))
+        self.assertTrue(np.all(forces_shadowing[shadowed] == 0))
+        self.assertTrue(np.all(forces_shadowing[~shadowed] == forces[~shadowed]))
+
+        # The refitted hierarchy matches a brute force test against all triangles
+        brute_force = TriangleBVH(self.PS.simplices, locations, leaf_size = len(self.PS.simplices))
+        self.assertTrue(np.all(shadowed == brute_force.intersect(locations, [0, 0, -1],
+                                                                 exclude = np.arange(self.PS.n),
+                                                                 epsilon = 1e-9*np.ptp(locations))))
+
+    def test_jacobian_shadowed_rows(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB, self_shadowing = True)
+        self.PS.displace([0, 0, 0, 0, 75, 0], suppress_warnings = True)
+        jacobian = OFC.force_jacobian().toarray()
+        self.PS.un_displace()
+
+        rows = np.repeat(OFC.shadow_mask, 3)
+        self.assertTrue(np.all(jacobian[rows] == 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the smooth spline fit of the photonic crystal response
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestSplineInterpolator(unittest.TestCase):
+    def setUp(self):
+        self.linear = interp.create_interpolator(interp.PhC_library['Mark_4'], 0.3)
+        self.spline = interp.create_spline_interpolator(interp.PhC_library['Mark_4'], 0.3)
+
+        rng = np.random.default_rng(0)
+        self.coordinates = np.column_stack((rng.uniform(0, 0.25, 100),
+                                            rng.uniform(0, 2*np.pi, 100),
+                                            rng.uniform(0, np.pi, 100)))
+
+    def test_interpolates_samples(self):
+        coordinates = np.round(self.linear.coordinates, 8)
+        coordinates = coordinates[coordinates[:,1] < 2*np.pi]
+        coordinates += np.array([0, 0.3, 0.3])
+
+        self.assertTrue(np.allclose(self.spline.outgoing_vectors(coordinates),
+                                    self.linear.outgoing_vectors(coordinates), atol = 1e-7))
+        self.assertTrue(np.allclose(self.spline(coordinates[:5]),
+                                    self.linear(coordinates[:5]), atol = 1e-7))
+
+    def test_periodic_in_phi(self):
+        shifted = self.coordinates + np.array([0, 2*np.pi, 0])
+        self.assertTrue(np.allclose(self.spline.outgoing_vectors(self.coordinates),
+                                    self.spline.outgoing_vectors(shifted)))
+
+    def test_gradient(self):
+        gradient = self.spline.outgoing_vectors_gradient(self.coordinates)
+
+        h = 1e-6
+        for l in range(3):
+            step = np.zeros(3)
+            step[l] = h
+            numerical = (self.spline.outgoing_vectors(self.coordinates + step)
+                         - self.spline.outgoing_vectors(self.coordinates - step))/(2*h)
+            self.assertTrue(np.allclose(gradient[:,:,l], numerical, atol = 1e-5*np.abs(gradient).max()))
+
+    def test_irregular_samples(self):
+        with self.assertRaises(AttributeError):
+            interp.create_spline_interpolator(interp.PhC_library['Gao'])
+
+
+class TestSplineForceJacobian(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.2, self.params)
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.4)/0.3)**2
+                                                      -1/2 *((y-0.5)/0.3)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_spline_interpolator(interp.PhC_library['Mark_4'], 0.2),
+                          rotation = 0.3)
+
+    def test_analytic_jacobian(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB, fused_kernel = True)
+        jacobian = OFC.force_jacobian().toarray()
+
+        x0, _ = self.PS.x_v_current
+        x0 = x0.copy()
+        h = 1e-6
+        numerical = np.zeros(jacobian.shape)
+        for j in range(len(x0)):
+            x = x0.copy()
+            x[j] += h
+            self.PS.update_pos_unsafe(x)
+            f_plus = OFC.force_value().ravel()
+            x[j] -= 2*h
+            self.PS.update_pos_unsafe(x)
+            f_min = OFC.force_value().ravel()
+            numerical[:,j] = (f_plus - f_min)/(2*h)
+        self.PS.update_pos_unsafe(x0)
+
+        self.assertTrue(np.allclose(jacobian, numerical, atol = 1e-5*np.abs(jacobian).max()))
+
+
+if __name__ == '__main__':
+    unittest.main()
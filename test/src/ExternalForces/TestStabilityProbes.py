@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the stability coefficients evaluated on posed copies of the geometry
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.particleSystem.ForcePipeline import GeometryCache
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.MultiBeamForceCalculator import MultiBeamForceCalculator
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.ExternalForces.optical_interpolators.interpolators as interp
+import src.Mesh.mesh_functions as MF
+
+
+class TestStabilityProbes(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.ARBITRARY_PHC)
+        table.set_crystal(interp.create_interpolator(interp.PhC_library['Mark_4'], 0))
+
+        polarisation = lambda x, y: np.outer(np.ones(np.shape(x)), [0,1])
+        self.beams = [LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.4)/0.3)**2
+                                                          -1/2 *((y-0.5)/0.3)**2), polarisation),
+                      LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.6)/0.3)**2
+                                                          -1/2 *((y-0.5)/0.3)**2), polarisation)]
+        self.OFC = OpticalForceCalculator(self.PS, self.beams[0])
+
+    def test_displaced_reference(self):
+        displacement_range = [0.1, 5]
+        coefficients = self.OFC.calculate_stability_coefficients(displacement_range)
+
+        q, alpha = displacement_range
+        original = np.hstack(self.OFC.calculate_restoring_forces())
+        reference = np.zeros((6,6))
+        for i, vector in enumerate(np.diag([q, q, q, alpha, alpha, alpha])):
+            self.PS.displace(vector)
+            reference[:,i] = (np.hstack(self.OFC.calculate_restoring_forces()) - original)/vector[i]
+            self.PS.un_displace()
+
+        self.assertTrue(np.allclose(coefficients, reference, atol = 1e-9*np.abs(reference).max()))
+
+    def test_no_mutation(self):
+        x, v = self.PS.x_v_current
+        self.OFC.calculate_stability_coefficients(central_differences = True)
+        x_after, v_after = self.PS.x_v_current
+
+        self.assertTrue(np.all(x == x_after))
+        self.assertTrue(np.all(v == v_after))
+        self.assertFalse(hasattr(self.PS, 'current_displacement'))
+
+    def test_central_differences(self):
+        coefficients = self.OFC.calculate_stability_coefficients([0.01, 0.5],
+                                                                 central_differences = True)
+
+        cache = GeometryCache(self.PS)
+        vector = np.array([0, 0, 0, 0, 0.5, 0])
+        plus = np.hstack(self.OFC.calculate_restoring_forces(cache = cache.pose(vector)))
+        minus = np.hstack(self.OFC.calculate_restoring_forces(cache = cache.pose(-vector)))
+        self.assertTrue(np.allclose(coefficients[:,4], (plus - minus)/1))
+
+        # Central differences are closer to a fine forward difference
+        fine = self.OFC.calculate_stability_coefficients([1e-4, 1e-3])
+        forward = self.OFC.calculate_stability_coefficients([0.01, 0.5])
+        self.assertLess(np.linalg.norm(coefficients - fine), np.linalg.norm(forward - fine))
+
+    def test_single_batch(self):
+        # All probes go through force_value_batch in one call
+        calls = []
+        force_value_batch = self.OFC.force_value_batch
+        def counting_batch(locations, *args, **kwargs):
+            calls.append(len(locations))
+            return force_value_batch(locations, *args, **kwargs)
+        self.OFC.force_value_batch = counting_batch
+
+        self.OFC.calculate_stability_coefficients(central_differences = True)
+        self.OFC.calculate_stability_coefficients()
+        self.assertEqual(calls, [12, 7])
+
+    def test_per_beam(self):
+        MBFC = MultiBeamForceCalculator(self.PS, self.beams)
+        coefficients = MBFC.calculate_stability_coefficients(central_differences = True,
+                                                             per_beam = True)
+
+        self.assertEqual(coefficients.shape, (2, 6, 6))
+        self.assertTrue(np.allclose(coefficients.sum(axis=0),
+                                    MBFC.calculate_stability_coefficients(central_differences = True)))
+        self.assertTrue(np.allclose(coefficients[1],
+                                    OpticalForceCalculator(self.PS, self.beams[1]).calculate_stability_coefficients(
+                                        central_differences = True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
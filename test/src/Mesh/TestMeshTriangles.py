@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the triangles emitted by the meshing functions
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+import src.Mesh.mesh_functions as MF
+
+
+class TestMeshTriangles(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+
+            # photonic crystal parameters
+            "E_x": 100e9, # [Pa]
+            "E_y": 100e9, # [Pa]
+            "G": 0, # [Pa]
+            "thickness": 100e-9, # [m]
+            }
+
+    def test_square(self):
+        connections, initial_conditions, triangles = MF.mesh_square(1, 1, 0.1, self.params,
+                                                                    return_triangles = True)
+        self.assertEqual(triangles.shape, (2*10*10, 3))
+
+        PS = ParticleSystem(connections, initial_conditions, self.params, triangles = triangles)
+        self.assertTrue(np.all(PS.simplices == triangles))
+
+        area_vectors = PS.find_surface()
+        self.assertTrue(np.allclose(area_vectors.sum(axis=0), [0, 0, 1]))
+        self.assertTrue(np.all(area_vectors[:,2] > 0))
+
+    def test_trimmed_circle(self):
+        h = 0.1
+        connections, initial_conditions, triangles = MF.mesh_circle_square_cross(1, h, self.params,
+                                                                                 return_triangles = True)
+        # Every triangle is half a grid cell, the tips are covered by single triangles
+        mesh_spacing = 2/(int(1/h + 1) - 1)
+        triangle_area = mesh_spacing**2/2
+
+        # Cleaning up removes the nodes outside the circle and renumbers the triangles
+        PS = ParticleSystem(connections, initial_conditions, self.params, triangles = triangles)
+        self.assertEqual(len(PS.simplices), len(triangles))
+        self.assertLess(PS.simplices.max(), PS.n)
+        self.assertTrue(np.all(np.isin(np.arange(PS.n), PS.simplices)))
+
+        area_vectors = PS.find_surface()
+        self.assertTrue(np.all(np.isfinite(area_vectors)))
+        self.assertTrue(np.all(area_vectors[:,2] > 0))
+        self.assertTrue(np.allclose(area_vectors.sum(axis=0), [0, 0, len(triangles)*triangle_area]))
+        PS.calculate_correct_masses(1e-3, 1000)
+        masses = np.array([p.m for p in PS.particles])
+        self.assertTrue(np.all(np.isfinite(masses) & (masses > 0)))
+        area = area_vectors.sum(axis=0)
+
+        # Without cleaning up, the nodes outside the circle are in no triangle and get no area
+        connections, initial_conditions, triangles = MF.mesh_circle_square_cross(1, h, self.params,
+                                                                                 return_triangles = True)
+        PS_full = ParticleSystem(connections, initial_conditions, self.params, triangles = triangles,
+                                 clean_particles = False)
+        PS_full.calculate_correct_masses(1e-3, 1000)
+        masses = np.array([p.m for p in PS_full.particles])
+        self.assertTrue(np.all(np.isfinite(PS_full.find_surface())))
+        self.assertTrue(np.all(np.isfinite(masses)))
+        self.assertTrue(np.allclose(PS_full.find_surface().sum(axis=0), area))
+
+        # Delaunay fills in the notches of the stepped boundary
+        connections, initial_conditions = MF.mesh_circle_square_cross(1, h, self.params)
+        PS_delaunay = ParticleSystem(connections, initial_conditions, self.params)
+        self.assertGreater(np.abs(PS_delaunay.find_surface().sum(axis=0)[2]), area[2])
+
+    def test_round_phc(self):
+        h = 0.2
+        connections, initial_conditions, triangles = MF.mesh_round_phc_square_cross(1, h, self.params,
+                                                                                    return_triangles = True)
+        PS = ParticleSystem(connections, initial_conditions, self.params, triangles = triangles)
+        self.assertLess(triangles.max(), PS.n)
+
+        # Every triangle is made up of neighbouring nodes
+        locations, _ = PS.x_v_current_3D
+        edges = locations[triangles] - locations[np.roll(triangles, 1, axis=1)]
+        self.assertTrue(np.all(np.linalg.norm(edges, axis=2) <= np.sqrt(2)*h + 1e-9))
+        area_vectors = PS.find_surface()
+        self.assertTrue(np.all(np.isfinite(area_vectors)))
+        self.assertTrue(np.allclose(area_vectors.sum(axis=0), [0, 0, len(triangles)/2*h**2]))
+
+    def test_rotate_and_trim(self):
+        connections, initial_conditions, triangles = MF.mesh_square_cross(1, 1, 0.1, self.params,
+                                                                          return_triangles = True)
+        connections, initial_conditions, triangles = MF.mesh_rotate_and_trim(initial_conditions,
+                                                                             connections,
+                                                                             30,
+                                                                             triangles)
+        PS = ParticleSystem(connections, initial_conditions, self.params, triangles = triangles)
+        self.assertLess(len(PS.simplices), 200)
+        self.assertTrue(np.all(PS.find_surface()[:,2] > 0))
+
+    def test_projection_plane(self):
+        connections, initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        for initial_condition in initial_conditions:
+            x, y, z = initial_condition[0]
+            initial_condition[0] = np.array([x, z, y])
+
+        PS = ParticleSystem(connections, initial_conditions, self.params, init_surface = False)
+        PS.initialize_find_surface('y')
+        area = PS.find_surface()
+        self.assertTrue(np.isclose(np.abs(area.sum(axis=0)[1]), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the adaptive quadtree mapping of stability basins
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.Sim.simulations import Simulate_Lightsail
+from src.Sim.basin_mapping import BasinMap, polar_ksection
+import src.Mesh.mesh_functions as MF
+
+
+class TestBasinMapping(unittest.TestCase):
+    def setUp(self):
+        self.points = []
+        self.bounds = [[-1, 1], [-1, 1]]
+
+    def classify(self, points):
+        # Four-lobed basin, symmetric under quarter turns and mirrors
+        self.points.append(points)
+        radius = np.hypot(points[:,0], points[:,1])
+        angle = np.arctan2(points[:,1], points[:,0])
+        return radius < 0.5 + 0.1*np.cos(4*angle)
+
+    def truth(self, basin):
+        x, y = basin.lattice()
+        return self.classify(np.column_stack((x.ravel(), y.ravel()))).reshape(x.shape)
+
+    def test_refinement(self):
+        basin = BasinMap(self.classify, self.bounds, max_depth = 7, initial_depth = 3)
+        basin.refine()
+        # One batch per level
+        self.assertEqual(len(self.points), basin.max_depth + 1)
+        self.assertTrue(np.all(basin.grid() == self.truth(basin)))
+        self.assertLess(basin.evaluations, 0.1*(basin.n + 1)**2)
+
+    def test_symmetry(self):
+        reference = BasinMap(self.classify, self.bounds, max_depth = 7, initial_depth = 3)
+        reference.refine()
+        self.points = []
+
+        basin = BasinMap(self.classify, self.bounds, ['C4'], max_depth = 7, initial_depth = 3)
+        basin.refine()
+        self.assertTrue(np.all(basin.grid() == reference.grid()))
+        self.assertLess(basin.evaluations, 0.3*reference.evaluations)
+        # Only one vertex of every orbit is classified
+        self.assertEqual(len(np.concatenate(self.points)), basin.evaluations)
+
+        with self.assertRaises(AttributeError):
+            BasinMap(self.classify, [[0, 1], [-1, 1]], ['C4'])
+
+    def test_resume(self):
+        reference = BasinMap(self.classify, self.bounds, ['mirror_x'], max_depth = 5)
+        reference.refine()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'basin.npz')
+            basin = BasinMap.resume(path, self.classify, self.bounds, ['mirror_x'], max_depth = 5)
+            basin.refine(levels = 2)
+            self.assertEqual(basin.depth, 2)
+
+            self.points = []
+            resumed = BasinMap.resume(path, self.classify)
+            resumed.refine()
+            self.assertEqual(resumed.evaluations, reference.evaluations)
+            self.assertEqual(len(np.concatenate(self.points)), reference.evaluations - basin.evaluations)
+            self.assertTrue(np.all(resumed.grid() == reference.grid()))
+
+    def test_polar_ksection(self):
+        # Smooth radius with a narrow notch that the seeds of its neighbours miss
+        def radius(angles):
+            return np.where(np.abs(angles - 92) < 3, 0.05, 0.3 + 0.1*np.cos(4*np.radians(angles)))
+
+        def classify(points):
+            self.points.append(points)
+            angles = np.degrees(np.arctan2(points[:,1], points[:,0]))%360
+            return np.hypot(points[:,0], points[:,1]) < radius(angles)
+
+        angles = np.arange(0, 361, 1)
+        evaluations = []
+        for stride in [1, 4]:
+            self.points = []
+            stable, unstable, rounds = polar_ksection(classify, angles, 0.5, 0.005, k = 4, stride = stride)
+            self.assertTrue(np.all((stable <= radius(angles)) & (radius(angles) <= unstable)))
+            self.assertTrue(np.all(unstable - stable <= 0.005))
+            self.assertEqual(len(self.points), rounds)
+            evaluations.append(len(np.concatenate(self.points)))
+        # Bisection of every angle takes 7 sequential trajectories
+        self.assertLessEqual(rounds, 7)
+        self.assertLess(evaluations[1], 0.8*evaluations[0])
+
+    def test_polar_ksection_ends(self):
+        # Stable beyond r_max on one side, unstable everywhere on another and beyond r_limit on a third
+        def radius(angles):
+            return np.select([angles < 60, angles < 120, angles < 180], [0.7, 0, 2], 0.3)
+
+        def classify(points):
+            self.points.append(points)
+            angles = np.degrees(np.arctan2(points[:,1], points[:,0]))%360
+            return np.hypot(points[:,0], points[:,1]) < radius(angles)
+
+        self.points = []
+        angles = np.arange(2.5, 240, 5)
+        stable, unstable, rounds = polar_ksection(classify, angles, 0.5, 0.005, verify_ends = True, r_limit = 1)
+        self.assertEqual(len(self.points[0]), 1 + len(angles))
+        self.assertEqual(len(self.points), rounds)
+
+        inside = radius(angles) < 1
+        self.assertTrue(np.all((stable <= radius(angles)) & (radius(angles) <= unstable) | ~inside))
+        self.assertTrue(np.all(unstable - stable <= 0.005))
+        self.assertTrue(np.all(stable[radius(angles) == 0] == 0))
+        self.assertTrue(np.all(stable[~inside] == 1))
+
+    def test_lightsail(self):
+        params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 1e-2,  # [s]       simulation timestep
+            "t_steps": 40,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-3, # [-]
+            "min_iterations": 10, # [-]
+            }
+        connectivity_matrix, initial_conditions = MF.mesh_square(1, 1, 0.1, params)
+        PS = ParticleSystem(connectivity_matrix, initial_conditions, params, clean_particles = False)
+        PS.calculate_correct_masses(1e-3, 1000)
+        PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.5)/0.25)**2
+                                                 -1/2 *((y-0.5)/0.25)**2),
+                       lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+        SIM = Simulate_Lightsail(PS, OpticalForceCalculator(PS, LB), params)
+
+        bounds = [[-0.2, 0.2], [-0.2, 0.2]]
+        basin = SIM.map_stability_basin(bounds, ['C4'], max_depth = 2, printframes = 0, spin = False)
+        self.assertEqual(basin.grid().shape, (5, 5))
+        self.assertLessEqual(basin.evaluations, 7)
+
+        initial_conditions = np.zeros((1, 2, 6))
+        initial_conditions[0,0,:2] = [0.2, -0.1]
+        stable, _ = SIM.simulate_rigid_ensemble(initial_conditions, printframes = 0, spin = False)
+        self.assertEqual(basin.value((4, 1)), stable[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the linearised stability analysis of the rigid-body motion
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.Sim.rigid_body import RigidBody
+from src.Sim.simulations import Simulate_Lightsail
+from src.Sim.stability import LinearStability, DivergencePredictor, state_matrix, classify_eigenvalues
+import src.Mesh.mesh_functions as MF
+
+
+class TestLinearStability(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 1e-3,  # [s]       simulation timestep
+            "t_steps": 40,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-12, # [-]
+            "min_iterations": 10, # [-]
+            }
+
+    def build_sail(self, k = 1):
+        self.params['k'] = self.params['k_d'] = k
+        connectivity_matrix, initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        PS = ParticleSystem(connectivity_matrix,
+                            initial_conditions,
+                            self.params,
+                            clean_particles = False)
+        PS.calculate_correct_masses(1e-3, 1000)
+        PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.5)/0.25)**2
+                                                 -1/2 *((y-0.5)/0.25)**2),
+                       lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+        return PS, OpticalForceCalculator(PS, LB)
+
+    def test_oscillator(self):
+        # Damped mass-spring: eigenvalues -c/2m +- i sqrt(k/m - (c/2m)^2)
+        m, k, c = 2, 8, 0.4
+        eigenvalues = np.linalg.eigvals(state_matrix([[-k]], [[m]], [-c]))
+        decay = c/(2*m)
+        frequency = np.sqrt(k/m - decay**2)
+        self.assertTrue(np.allclose(np.sort_complex(eigenvalues),
+                                    [-decay - 1j*frequency, -decay + 1j*frequency]))
+
+        self.assertEqual(classify_eigenvalues(eigenvalues), 'stable')
+        self.assertEqual(classify_eigenvalues(np.linalg.eigvals(state_matrix([[-k]], [[m]]))), 'marginal')
+        self.assertEqual(classify_eigenvalues(np.linalg.eigvals(state_matrix([[k]], [[m]], [-c]))), 'unstable')
+
+    def test_growth_rate(self):
+        # The fastest mode grows at the predicted rate in a rigid-body trajectory
+        PS, OFC = self.build_sail()
+        analysis = LinearStability(PS, OFC).analyse(displacement_range = [1e-3, 0.05])
+        self.assertEqual(analysis['classification'], 'unstable')
+        rate = analysis['growth_rates'][0]
+
+        mode = analysis['modes'][:, 0].real
+        displacement = np.zeros(6)
+        displacement[analysis['dofs']] = 1e-4*mode/np.max(np.abs(mode))
+
+        body = RigidBody(PS, OFC)
+        start = body.position.copy()
+        body.set_state(position = start + displacement[:3], attitude = np.rad2deg(displacement[3:]))
+        solution = body.integrate(2, t_eval = [1.5, 2], rtol = 1e-9, atol = 1e-12)
+        deviation = np.linalg.norm(solution.y[:2].T - start[:2], axis=1)
+        self.assertAlmostEqual(deviation[1]/deviation[0], np.exp(rate*0.5), delta = 0.02*np.exp(rate*0.5))
+
+    def test_damping(self):
+        # Damping on all axes only shifts the growth rates of the undamped sail
+        PS, OFC = self.build_sail()
+        undamped = LinearStability(PS, OFC).analyse()
+        mass = np.sum([p.m for p in PS.particles])
+        damped = LinearStability(PS, OFC, damping = [-0.1*mass, -0.1*mass, 0, 0, 0, 0]).analyse()
+        self.assertEqual(len(damped['eigenvalues']), 8)
+        self.assertTrue(np.all(damped['growth_rates'] < undamped['growth_rates'][0]))
+
+        # Rotational damping acts on the angular velocity in deg/s
+        analysis = LinearStability(PS, OFC, damping = [0, 0, 0, -1, -1, 0])
+        A = analysis.eigen_analysis(undamped['stiffness'])['state_matrix']
+        inertia = analysis.mass_matrix[3:5, 3:5]
+        self.assertTrue(np.allclose(A[6:, 6:], np.linalg.inv(inertia).dot(-np.rad2deg(1)*np.identity(2))))
+
+    def test_compliance(self):
+        # The correction for the deformation of the sail vanishes for a stiff structure
+        corrections = []
+        for k in [100, 1e4]:
+            PS, OFC = self.build_sail(k)
+            PS.stress_self(0.9)
+            analysis = LinearStability(PS, OFC).analyse(compliance = True)
+            stiffness = analysis['stiffness']
+            change = analysis['compliant']['stiffness'] - stiffness
+            corrections.append(np.linalg.norm(change)/np.linalg.norm(stiffness))
+        self.assertGreater(corrections[0], 0)
+        self.assertAlmostEqual(corrections[0]/corrections[1], 100, delta = 10)
+
+    def test_divergence_predictor(self):
+        # Growing, decaying and undamped oscillations
+        predictor = DivergencePredictor(np.zeros((3, 2)), 1)
+        for n in range(400):
+            x = np.array([1e-4*np.exp(0.02*n), 0.1*np.exp(-0.05*n), 0.1])*np.cos(0.3*n)
+            position = np.column_stack((x, np.zeros(3)))
+            labels = predictor.update(position, np.zeros((3, 3)), 2000 - n)
+            if n < 199:
+                self.assertTrue(np.all(labels == ''))
+        self.assertEqual(list(labels), ['unstable', 'stable', 'borderline'])
+        self.assertAlmostEqual(predictor.growth_rate[0], 0.02, delta = 2e-3)
+        self.assertGreater(predictor.label_confidence[0], 0.99)
+
+    def test_early_stopping(self):
+        # An unstable trajectory is stopped before it breaks the perimeter
+        self.params['dt'] = 1e-2
+        self.params['t_steps'] = 2000
+        initial_conditions = np.array([[1e-5, 0, 0, 0, 0, 0], np.zeros(6)])
+        verdicts, steps = [], []
+        for early_stopping in [None, 0.99]:
+            PS, OFC = self.build_sail()
+            SIM = Simulate_Lightsail(PS, OFC, self.params)
+            verdicts.append(SIM.simulate_trajectory(printframes = 0, deform = False, spin = False,
+                                                    rigid_body = True,
+                                                    initial_conditions = initial_conditions.copy(),
+                                                    early_stopping = early_stopping))
+            steps.append(len(PS.history['dt']))
+        self.assertEqual(verdicts, [False, False])
+        self.assertEqual(str(SIM.divergence_predictor.labels), 'unstable')
+        self.assertLess(steps[1], steps[0])
+
+        PS, OFC = self.build_sail()
+        SIM = Simulate_Lightsail(PS, OFC, self.params)
+        stable, ensemble = SIM.simulate_rigid_ensemble(np.stack((initial_conditions,
+                                                                 initial_conditions[:, [1, 0, 2, 3, 4, 5]])),
+                                                       printframes = 0, spin = False,
+                                                       early_stopping = 0.99)
+        self.assertFalse(np.any(stable))
+        self.assertTrue(np.all(ensemble.predictions == 'unstable'))
+        self.assertTrue(np.all(ensemble.steps < steps[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the multi-rate coupling of the sail deformation and the rigid-body motion
+"""
+import time
+import unittest
+
+import numpy as np
+from scipy.sparse.linalg import aslinearoperator
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.Sim.simulations import Simulate_Lightsail
+import src.Mesh.mesh_functions as MF
+
+
+class TestMultiRateTrajectory(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 100,  # [N/m]   spring stiffness
+            "k_d": 100,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 1e-2,  # [s]       simulation timestep
+            "t_steps": 60,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-12, # [-]
+            "min_iterations": 10, # [-]
+            }
+
+    def build_sail(self, frame = True, mesh_edge_length = 0.1):
+        connectivity_matrix, initial_conditions = MF.mesh_square(1, 1, mesh_edge_length, self.params)
+        if frame:
+            # Prestressed membrane in a rigid frame
+            for node in initial_conditions:
+                x, y, _ = node[0]
+                node[3] = bool(np.isclose(x, 0) or np.isclose(x, 1) or np.isclose(y, 0) or np.isclose(y, 1))
+        PS = ParticleSystem(connectivity_matrix,
+                            initial_conditions,
+                            self.params,
+                            clean_particles = False)
+        PS.calculate_correct_masses(1e-3, 1000)
+        if frame:
+            PS.stress_self(0.9)
+        PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.5)/0.25)**2
+                                                 -1/2 *((y-0.5)/0.25)**2),
+                       lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+        return PS, OpticalForceCalculator(PS, LB)
+
+    def test_quasi_static(self):
+        PS, OFC = self.build_sail()
+        f = OFC.force_value().ravel()
+        residual, iterations = PS.relax_quasi_static(f, inertia_relief = False)
+        self.assertLess(residual, 1e-6)
+        self.assertGreater(iterations, 0)
+
+        free = np.repeat([not p.fixed for p in PS.particles], 3)
+        self.assertLess(np.linalg.norm((PS.f_int + f)[free]), 1e-6*np.linalg.norm(f[free]))
+        self.assertGreater(np.ptp(PS.x_v_current_3D[0][:,2]), 0)
+        self.assertTrue(np.all(PS.x_v_current_3D[1] == 0))
+
+    def test_inertia_relief(self):
+        # A load that only accelerates the free sail does not deform it
+        PS, _ = self.build_sail(frame = False)
+        locations = PS.x_v_current_3D[0]
+        masses = np.array([p.m for p in PS.particles])
+        arms = locations - PS.calculate_center_of_mass()
+        f = masses[:,np.newaxis]*([0.1, -0.2, 1] + np.cross([0.3, 0.1, -0.2], arms))
+        residual, iterations = PS.relax_quasi_static(f.ravel())
+        self.assertLess(residual, 1e-12)
+        self.assertEqual(iterations, 0)
+        self.assertTrue(np.all(PS.x_v_current_3D[0] == locations))
+
+    def test_free_relaxation(self):
+        # Free sail on a soft elastic foundation, the shape change has no rigid-body part
+        results = []
+        for matrix_free in [False, True]:
+            PS, _ = self.build_sail(frame = False)
+            rng = np.random.default_rng(0)
+            f = rng.normal(0, 1e-2, 3*PS.n)
+            foundation = -10*np.identity(3*PS.n)
+            if matrix_free:
+                foundation = aslinearoperator(foundation)
+            start = PS.x_v_current[0]
+            residual, iterations = PS.relax_quasi_static(f, foundation)
+            self.assertLess(residual, 1e-6)
+            self.assertGreater(iterations, 0)
+
+            displacement = PS.x_v_current[0] - start
+            masses = np.repeat([p.m for p in PS.particles], 3)
+            PS.update_pos_unsafe(start)
+            modes = PS.rigid_body_modes()
+            scale = np.abs(modes).T.dot(masses*np.abs(displacement)).max()
+            self.assertLess(np.abs(modes.T.dot(masses*displacement)).max(), 1e-4*scale)
+            results.append(displacement)
+        # The iterative solve of the matrix-free jacobian is accurate to rel_tol
+        self.assertTrue(np.allclose(results[0], results[1], atol = 1e-4*np.abs(results[0]).max()))
+
+    def test_trajectory(self):
+        # Shape updates every few steps follow the fully coupled trajectory
+        initial_conditions = np.array([[1e-3, 0, 0, 0, 0, 0], np.zeros(6)])
+        positions, updates = [], []
+        for kwargs in [{}, {'deform_interval': 20}, {'deform_interval': 20, 'load_tolerance': 1e-2}]:
+            PS, OFC = self.build_sail()
+            SIM = Simulate_Lightsail(PS, OFC, self.params)
+            SIM.simulate_trajectory(printframes = 0, spin = False,
+                                    initial_conditions = initial_conditions.copy(), **kwargs)
+            positions.append(np.sum(PS.history['position'][:,:2], axis=0))
+            updates.append(np.count_nonzero(PS.history['shape_residual']))
+            self.assertLess(np.max(PS.history['shape_residual']), 1e-6)
+
+        self.assertEqual(updates[0], 0)
+        self.assertEqual(updates[1], 3)
+        self.assertGreater(updates[2], updates[1])
+        self.assertLess(np.max(PS.history['load_change']), 0.1)
+        for position in positions[1:]:
+            self.assertTrue(np.allclose(position, positions[0], rtol = 0, atol = 1e-3*np.abs(positions[0]).max()))
+
+    def test_fine_mesh_speedup(self):
+        # On a 21x21 mesh the multi-rate trajectory beats advancing the structure every step
+        self.params['t_steps'] = 20
+        initial_conditions = np.array([[1e-3, 0, 0, 0, 0, 0], np.zeros(6)])
+        durations = []
+        for kwargs in [{}, {'deform_interval': 10}]:
+            PS, OFC = self.build_sail(mesh_edge_length = 0.05)
+            SIM = Simulate_Lightsail(PS, OFC, self.params)
+            start = time.perf_counter()
+            SIM.simulate_trajectory(printframes = 0, spin = False,
+                                    initial_conditions = initial_conditions.copy(), **kwargs)
+            durations.append(time.perf_counter() - start)
+        self.assertLess(durations[1], 0.5*durations[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the quaternion rigid-body model and its trajectory mode
+"""
+import unittest
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.Sim.simulations import Simulate_Lightsail
+from src.Sim.rigid_body import RigidBody, RigidEnsemble, quaternion_multiply, rotation_vector_to_quaternion
+import src.Mesh.mesh_functions as MF
+
+
+class TestRigidBody(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 1e-3,  # [s]       simulation timestep
+            "t_steps": 40,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-12, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.PS.calculate_correct_masses(1e-3, 1000)
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.45)/0.25)**2
+                                                      -1/2 *((y-0.5)/0.25)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+        self.OFC = OpticalForceCalculator(self.PS, self.LB)
+
+    def test_quaternions(self):
+        rotation_vectors = np.array([[0.1, -0.2, 0.3], [0, 0, 0], [1, 2, -0.5]])
+        quaternions = rotation_vector_to_quaternion(rotation_vectors)
+        self.assertTrue(np.allclose(quaternions, Rotation.from_rotvec(rotation_vectors).as_quat()))
+
+        product = quaternion_multiply(quaternions[0], quaternions[2])
+        reference = (Rotation.from_quat(quaternions[0])*Rotation.from_quat(quaternions[2])).as_quat()
+        self.assertTrue(np.allclose(product, reference))
+
+    def test_displaced_geometry(self):
+        # Loads of a pose match those of the displaced ParticleSystem
+        body = RigidBody(self.PS, self.OFC)
+        displacement = np.array([0.05, -0.02, 0, 2, -3, 10])
+        body.set_state(position = body.position + displacement[:3], attitude = displacement[3:])
+
+        x, v = self.PS.x_v_current
+        net_force, net_moment = body.loads()
+        x_after, _ = self.PS.x_v_current
+        self.assertTrue(np.all(x == x_after))
+
+        self.PS.displace(displacement)
+        reference = self.OFC.calculate_restoring_forces()
+        self.assertTrue(np.allclose(body.geometry().locations, self.PS.x_v_current_3D[0]))
+        self.assertTrue(np.allclose(net_force, reference[0]))
+        self.assertTrue(np.allclose(net_moment, reference[1]))
+
+    def test_damping(self):
+        # Same units as simulate_trajectory, the angular velocity in deg/s
+        damping = np.array([-1, -2, 0, -3, -4, -5])
+        body = RigidBody(self.PS, self.OFC)
+        damped = RigidBody(self.PS, self.OFC, damping = damping)
+        for model in [body, damped]:
+            model.set_state(attitude = [1, -2, 3], velocity = [0.1, -0.2, 0],
+                            angular_velocity = [0.3, 0.1, -0.2])
+        expected = damping*np.array([0.1, -0.2, 0, *np.rad2deg([0.3, 0.1, -0.2])])
+
+        difference = np.hstack(damped.loads()) - np.hstack(body.loads())
+        self.assertTrue(np.allclose(difference, expected))
+        states = np.stack((damped.state, damped.state))
+        ensemble = np.hstack(RigidEnsemble(damped, states).loads(states))
+        self.assertTrue(np.allclose(ensemble - np.hstack(body.loads()), expected))
+
+    def test_torque_free_rotation(self):
+        # Without loads the kinetic energy and angular momentum are conserved
+        body = RigidBody(self.PS, self.OFC)
+        body.set_state(angular_velocity = [0.3, 0.2, 2])
+        energy = body.kinetic_energy()[1]
+        rotation = Rotation.from_quat(body.quaternion).as_matrix()
+        momentum = rotation.dot(body.inertia.dot(body.angular_velocity))
+
+        for i in range(200):
+            body.step(1e-3, loads = (np.zeros(3), np.zeros(3)))
+        rotation = Rotation.from_quat(body.quaternion).as_matrix()
+        self.assertAlmostEqual(np.linalg.norm(body.quaternion), 1)
+        self.assertLess(abs(body.kinetic_energy()[1]/energy - 1), 1e-2)
+        self.assertTrue(np.allclose(rotation.dot(body.inertia.dot(body.angular_velocity)),
+                                    momentum, rtol = 1e-2))
+
+    def test_trajectory(self):
+        # Matches the trajectory of the displaced ParticleSystem
+        sim = Simulate_Lightsail(self.PS, self.OFC, self.params)
+        sim.simulate_rigid_trajectory(printframes = 0, spin = False)
+        rigid_history = np.cumsum(self.PS.history['position'], axis=0)[:-1]
+        rigid_location = self.PS.calculate_center_of_mass()
+
+        self.setUp()
+        sim = Simulate_Lightsail(self.PS, self.OFC, self.params)
+        sim.simulate_trajectory(printframes = 0, deform = False, spin = False)
+        history = np.cumsum(self.PS.history['position'], axis=0)[:-1]
+
+        self.assertTrue(np.allclose(rigid_history, history, atol = 1e-3*np.abs(history).max()))
+        self.assertTrue(np.allclose(rigid_location, self.PS.calculate_center_of_mass()))
+
+    def test_adaptive_events(self):
+        # Same verdict as the fixed steps, stopping exactly at the attitude limit
+        class CountingCalculator:
+            def __init__(self, OFC):
+                self.OFC = OFC
+                self.evaluations = 0
+            def force_value(self, *args):
+                self.evaluations += 1
+                return self.OFC.force_value(*args)
+
+        self.params['t_steps'] = 1500
+        initial_conditions = [[0, 0, 0, 0, 0, 0], [0.5, 0.2, 0, 0, 0, 5]]
+        verdicts, evaluations = [], []
+        for ode_method in [None, 'RK45']:
+            FC = CountingCalculator(OpticalForceCalculator(self.PS, self.LB))
+            sim = Simulate_Lightsail(self.PS, FC, self.params)
+            verdicts.append(sim.simulate_rigid_trajectory(printframes = 0,
+                                                          initial_conditions = initial_conditions,
+                                                          ode_method = ode_method))
+            evaluations.append(FC.evaluations)
+            self.setUp()
+            self.params['t_steps'] = 1500
+
+        self.assertEqual(verdicts, [False, False])
+        self.assertLess(evaluations[1], evaluations[0]/5)
+        self.assertAlmostEqual(abs(sim.rigid_body.attitude[1]), 5)
+
+    def test_adaptive_convergence(self):
+        self.params['convergence_threshold'] = 1e-6
+        sim = Simulate_Lightsail(self.PS, self.OFC, self.params)
+        self.assertTrue(sim.simulate_rigid_trajectory(printframes = 0, ode_method = 'RK45'))
+        self.assertAlmostEqual(np.sum(self.PS.history['dt']), self.params['min_iterations']*self.params['dt'])
+
+    def test_ensemble(self):
+        # Same verdicts and number of steps as one trajectory at a time
+        self.params['t_steps'] = 200
+        self.params['convergence_threshold'] = 1e-5
+        initial_conditions = np.zeros((4, 2, 6))
+        initial_conditions[:,0,:2] = [[0, 0], [0.02, -0.01], [0.05, 0.05], [-0.03, 0.01]]
+        initial_conditions[2:,1,:2] = [[0.5, -0.3], [-0.2, 0.4]]
+        initial_conditions[3,1,3:] = [2, -1, 5]
+
+        sim = Simulate_Lightsail(self.PS, self.OFC, self.params)
+        stable, ensemble = sim.simulate_rigid_ensemble(initial_conditions, printframes = 0, batch_size = 3)
+        x, _ = self.PS.x_v_current_3D
+        self.assertTrue(np.all(x == self.PS.x_v_current_3D[0]))
+
+        for i, initial_condition in enumerate(initial_conditions):
+            self.setUp()
+            self.params['t_steps'] = 200
+            self.params['convergence_threshold'] = 1e-5
+            sim = Simulate_Lightsail(self.PS, self.OFC, self.params)
+            self.assertEqual(sim.simulate_rigid_trajectory(printframes = 0,
+                                                           initial_conditions = initial_condition.copy()),
+                             stable[i])
+            self.assertEqual(len(self.PS.history['dt']), ensemble.steps[i])
+            self.assertTrue(np.allclose(sim.rigid_body.state[:2], ensemble.states[i,:2]))
+        self.assertEqual(list(stable), [True, True, False, False])
+
+    def test_requires_rigid_sail(self):
+        sim = Simulate_Lightsail(self.PS, self.OFC, self.params)
+        with self.assertRaises(AttributeError):
+            sim.simulate_trajectory(printframes = 0, rigid_body = True)
+
+
+if __name__ == '__main__':
+    unittest.main()
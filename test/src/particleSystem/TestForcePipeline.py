@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the ForcePipeline and its force components
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.particleSystem.ForcePipeline import (ForcePipeline, GeometryCache, GravityForce,
+                                              PressureForce, DragForce, CallableForce)
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator, ParticleOpticalPropertyType
+from src.ExternalForces.LaserBeam import LaserBeam
+import src.Mesh.mesh_functions as MF
+
+
+class TestForcePipeline(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.2, self.params)
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.PS.optical_properties.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        self.LB = LaserBeam(lambda x, y: 1e9 * np.exp(-1/2 *((x-0.4)/0.3)**2
+                                                      -1/2 *((y-0.5)/0.3)**2),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0,1]))
+
+    def test_components(self):
+        locations, _ = self.PS.x_v_current_3D
+        cache = GeometryCache(self.PS)
+        masses = np.array([p.m for p in self.PS.particles])
+        area_vectors = self.PS.find_surface()
+
+        gravity = GravityForce().force_value(cache)
+        self.assertTrue(np.allclose(gravity[:,2], -9.80665*masses))
+        self.assertTrue(np.all(gravity[:,:2] == 0))
+
+        self.assertTrue(np.allclose(PressureForce(100).force_value(cache), 100*area_vectors))
+
+        # Drag on a node at rest with a fixed area
+        drag = DragForce([0, 0, 10], density = 1, drag_coefficient = 2, reference_area = 0.5)
+        self.assertTrue(np.allclose(drag.force_value(cache), [0, 0, 0.5*1*2*0.5*10*10]))
+
+        # Without a reference area the area vectors projected on the flow are used
+        drag = DragForce([0, 0, 10], density = 1, drag_coefficient = 2)
+        self.assertTrue(np.allclose(drag.force_value(cache)[:,2], 0.5*2*np.abs(area_vectors[:,2])*100))
+
+        user = CallableForce(lambda cache: cache.locations*2)
+        self.assertTrue(np.all(user.force_value(cache) == 2*locations))
+
+    def test_pipeline(self):
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        pipeline = self.PS.force_pipeline
+        self.assertIsInstance(pipeline, ForcePipeline)
+        pipeline.add(GravityForce())
+        pipeline.add(PressureForce(100))
+        pipeline.add(OFC)
+
+        forces = pipeline.force_value()
+        expected = (GravityForce().force_value(GeometryCache(self.PS))
+                    + 100*self.PS.find_surface()
+                    + OFC.force_value())
+        self.assertEqual(forces.shape, (self.PS.n, 3))
+        self.assertTrue(np.allclose(forces, expected))
+
+        net_force, net_moment = pipeline.calculate_restoring_forces(forces)
+        expected_force, expected_moment = OFC.calculate_restoring_forces(forces)
+        self.assertTrue(np.allclose(net_force, expected_force))
+        self.assertTrue(np.allclose(net_moment, expected_moment))
+
+    def test_shared_geometry(self):
+        find_surface = self.PS.find_surface
+        calls = []
+        def counting_find_surface(*args, **kwargs):
+            calls.append(1)
+            return find_surface(*args, **kwargs)
+        self.PS.find_surface = counting_find_surface
+
+        pipeline = ForcePipeline(self.PS, [PressureForce(100),
+                                           DragForce([0, 0, 10]),
+                                           OpticalForceCalculator(self.PS, self.LB)])
+        pipeline.force_value()
+        self.assertEqual(len(calls), 1)
+
+        pipeline.force_value()
+        self.assertEqual(len(calls), 2)
+
+    def test_read_only(self):
+        cache = GeometryCache(self.PS)
+        with self.assertRaises(ValueError):
+            cache.area_vectors[0] = 0
+        with self.assertRaises(ValueError):
+            cache.locations[0] = 0
+
+
+if __name__ == '__main__':
+    unittest.main()
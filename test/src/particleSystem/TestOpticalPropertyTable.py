@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the array-backed optical property table of the ParticleSystem
+"""
+import unittest
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+from src.particleSystem.OpticalPropertyTable import OpticalPropertyTable
+from src.ExternalForces.LaserBeam import LaserBeam
+from src.ExternalForces.OpticalForceCalculator import OpticalForceCalculator
+from src.ExternalForces.OpticalForceCalculator import ParticleOpticalPropertyType
+import src.Mesh.mesh_functions as MF
+
+
+class TestOpticalPropertyTable(unittest.TestCase):
+    def setUp(self):
+        self.table = OpticalPropertyTable(10)
+
+    def test_set_optical_type(self):
+        selection = np.arange(10) > 4
+        self.table.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        self.table.set_optical_type(ParticleOpticalPropertyType.AXICONGRATING, selection)
+
+        self.assertTrue(np.all(self.table.type_mask(ParticleOpticalPropertyType.AXICONGRATING) == selection))
+        self.assertTrue(np.all(self.table.type_mask(ParticleOpticalPropertyType.SPECULAR) == ~selection))
+        self.assertEqual(len(self.table.types), 2)
+        self.assertEqual(len(self.table.unset), 0)
+
+    def test_version_bumps(self):
+        version = self.table.version
+        self.table.set_optical_type(ParticleOpticalPropertyType.SPECULAR, [0, 1])
+        self.table.set_rotation(0.5, slice(2, 4))
+        self.table.set_axicon_matrix(np.identity(3), [3])
+        self.assertEqual(self.table.version, version + 3)
+
+    def test_crystal_masks(self):
+        crystal_a = lambda x: x
+        crystal_b = lambda x: x
+        self.table.set_crystal(crystal_a, np.arange(10) < 3, rotation=0.1)
+        self.table.set_crystal(crystal_b, np.arange(10) >= 3)
+
+        masks = self.table.crystal_masks()
+        self.assertEqual(np.sum(masks[crystal_a]), 3)
+        self.assertEqual(np.sum(masks[crystal_b]), 7)
+        self.assertTrue(np.allclose(self.table.rotation[:3], 0.1))
+
+        masks = self.table.crystal_masks(np.arange(10) < 2)
+        self.assertNotIn(crystal_b, masks)
+
+    def test_bad_selection(self):
+        with self.assertRaises(AttributeError):
+            self.table.set_optical_type(ParticleOpticalPropertyType.SPECULAR, np.ones(3, dtype=bool))
+
+
+class TestOpticalPropertyTableForces(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e4,  # [-]       maximum number of iterations
+            "convergence_threshold": 1e-4, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+        self.LB = LaserBeam(lambda x, y: np.ones(np.shape(x)),
+                            lambda x, y: np.outer(np.ones(np.shape(x)), [0, 1]))
+
+    def test_no_properties(self):
+        with self.assertRaises(AttributeError):
+            OpticalForceCalculator(self.PS, self.LB)
+
+    def test_legacy_particle_attributes(self):
+        for p in self.PS.particles:
+            p.optical_type = ParticleOpticalPropertyType.SPECULAR
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+
+        table = self.PS.optical_properties
+        self.assertEqual(len(table.unset), 0)
+        forces = OFC.force_value()
+        self.assertTrue(np.all(forces[:,2] > 0))
+
+    def test_mask_rebuild_on_change(self):
+        table = self.PS.optical_properties
+        table.set_optical_type(ParticleOpticalPropertyType.SPECULAR)
+        OFC = OpticalForceCalculator(self.PS, self.LB)
+        OFC.force_value()
+        self.assertEqual(np.sum(OFC.optical_type_mask[ParticleOpticalPropertyType.SPECULAR]),
+                         self.PS.n)
+
+        selection = np.arange(self.PS.n) % 2 == 0
+        table.set_optical_type(ParticleOpticalPropertyType.AXICONGRATING, selection)
+        OFC.force_value()
+        self.assertTrue(np.all(OFC.optical_type_mask[ParticleOpticalPropertyType.AXICONGRATING] == selection))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for reusing the nodal area vectors through rigid displacements
+"""
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+import src.Mesh.mesh_functions as MF
+
+
+class TestRigidAreaCache(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+            }
+        self.connectivity_matrix, self.initial_conditions = MF.mesh_square(1, 1, 0.1, self.params)
+        for initial_condition in self.initial_conditions:
+            x, y, _ = initial_condition[0]
+            initial_condition[0][2] = 0.1*(x-0.5)**2 + 0.05*x*y
+
+        self.PS = ParticleSystem(self.connectivity_matrix,
+                                 self.initial_conditions,
+                                 self.params,
+                                 clean_particles = False)
+
+    def recalculate(self):
+        """Area vectors of the current locations without the cache"""
+        self.PS._ParticleSystem__area_cache = None
+        return self.PS.find_surface()
+
+    def test_displace(self):
+        self.PS.find_surface()
+        self.PS.displace([0.1, -0.2, 0.3, 5, -10, 20])
+
+        with mock.patch('src.particleSystem.ParticleSystem.np.cross') as cross:
+            area_vectors = self.PS.find_surface()
+            cross.assert_not_called()
+        self.assertTrue(np.allclose(area_vectors, self.recalculate()))
+
+        self.PS.find_surface()
+        self.PS.un_displace()
+        with mock.patch('src.particleSystem.ParticleSystem.np.cross') as cross:
+            area_vectors = self.PS.find_surface()
+            cross.assert_not_called()
+        self.assertTrue(np.allclose(area_vectors, self.recalculate()))
+
+    def test_deformation_invalidates(self):
+        self.PS.find_surface()
+        self.PS.particles[12].x[2] += 0.1
+        self.PS.displace([0, 0, 0, 0, 10, 0])
+
+        area_vectors = self.PS.find_surface()
+        self.assertTrue(np.all(area_vectors == self.recalculate()))
+
+    def test_returns_copy(self):
+        area_vectors = self.PS.find_surface()
+        area_vectors[:] = 0
+        self.assertTrue(np.any(self.PS.find_surface() != 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
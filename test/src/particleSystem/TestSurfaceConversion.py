@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the matrix that divides the triangle areas over the nodes in find_surface
+"""
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from src.particleSystem.ParticleSystem import ParticleSystem
+import src.Mesh.mesh_functions as MF
+
+
+class TestSurfaceConversion(unittest.TestCase):
+    def setUp(self):
+        self.params = {
+            # model parameters
+            "k": 1,  # [N/m]   spring stiffness
+            "k_d": 1,  # [N/m] spring stiffness for diagonal elements
+            "c": 10,  # [N s/m] damping coefficient
+            "m_segment": 1, # [kg] mass of each node
+
+            # simulation settings
+            "dt": 0.1,  # [s]       simulation timestep
+            "t_steps": 1000,  # [-]      number of simulated time steps
+            "abs_tol": 1e-50,  # [m/s]     absolute error tolerance iterative solver
+            "rel_tol": 1e-5,  # [-]       relative error tolerance iterative solver
+            "max_iter": 1e5,  # [-]       maximum number of iterations]
+            "convergence_threshold": 1e-6, # [-]
+            "min_iterations": 10, # [-]
+
+            # photonic crystal parameters
+            "E_x": 100e9, # [Pa]
+            "E_y": 100e9, # [Pa]
+            "G": 0, # [Pa]
+            "thickness": 100e-9, # [m]
+            }
+
+    def loop_conversion_matrix(self, PS, simplices):
+        # Construction of the conversion matrix before it was vectorised
+        points, _ = PS.x_v_current_3D
+        v1 = points[simplices[:,0]]-points[simplices[:,1]]
+        v2 = points[simplices[:,0]]-points[simplices[:,2]]
+        v1_length = np.linalg.norm(v1, axis=1)
+        v2_length = np.linalg.norm(v2, axis=1)
+        v3_length = np.linalg.norm(v2-v1, axis=1)
+        angle_1 = np.arccos(np.sum(v1*v2, axis = 1)/(v1_length*v2_length))
+        inp = v2_length/v3_length * np.sin(angle_1)
+        inp[inp>1] = 1
+        angle_2 = np.arcsin(inp)
+        angle_3 = np.pi - angle_1 - angle_2
+        angle_iterator = np.column_stack((angle_1, angle_2, angle_3)).flatten()/np.pi
+
+        rows = []
+        cols = []
+        data = []
+        for j, indices in enumerate(simplices):
+            for k, i in enumerate(indices):
+                for l in range(3):
+                    rows.append(3*i+l)
+                    cols.append(3*j+l)
+                    data.append(angle_iterator[3*j+k])
+        return sps.csr_matrix((data, (rows, cols)), shape=(PS.n*3, len(simplices)*3))
+
+    def test_round_phc(self):
+        # Trimmed mesh, triangulated by Delaunay and by the mesh function
+        for return_triangles in [False, True]:
+            mesh = MF.mesh_round_phc_square_cross(1, 0.1, self.params, return_triangles = return_triangles)
+            triangles = mesh[2] if return_triangles else None
+            for initial_condition in mesh[1]:
+                x, y, _ = initial_condition[0]
+                initial_condition[0][2] = 0.1*x**2 + 0.05*x*y
+
+            PS = ParticleSystem(mesh[0], mesh[1], self.params, triangles = triangles)
+            simplices, conversion_matrix = PS.initialize_find_surface()
+            reference = self.loop_conversion_matrix(PS, simplices)
+
+            self.assertEqual(conversion_matrix.shape, reference.shape)
+            self.assertEqual((conversion_matrix != reference).nnz, 0)
+            # The weights of the corners of every triangle add up to one
+            self.assertTrue(np.allclose(conversion_matrix.sum(axis=0), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()